@@ -0,0 +1,66 @@
+"""Measure the latency of reads from the latest values API
+
+The store holds the latest values of `--series` controllers, each written by a point
+shaped like the collector's, and is read over one kept-alive connection the way a
+polling status panel would. Run from the aggregator directory:
+
+    python -m benchmarks.latest --series 16 256
+"""
+
+import argparse
+from http.client import HTTPConnection
+import time
+
+from benchmarks.service import make_message
+from latest import LatestValues, LatestValuesServer, extract_latest
+from main import decode_data
+
+QUERIES = {
+    "one field": "/latest?unit={unit}&port=/dev/serial{port}&field=battery_voltage",
+    "one series": "/latest?unit={unit}&port=/dev/serial{port}",
+    "everything": "/latest",
+}
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--series", type=int, nargs="+", default=[16, 256])
+    parser.add_argument("--reads", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'series':>7} {'query':<11} {'p50 (ms)':>9} {'p99 (ms)':>9} {'bytes':>7}")
+    for series in args.series:
+        latest = LatestValues()
+        for index in range(series):
+            points = decode_data(make_message(index, 1))
+            # One controller per port and unit
+            points[0]["tags"]["port"] = f"/dev/serial{index // 4}"
+            points[0]["tags"]["unit"] = str(1 + index % 4)
+            latest.update(extract_latest(points, "telemetry", "ms"))
+
+        server = LatestValuesServer(latest)
+        server.start()
+        connection = HTTPConnection(*server.address)
+        for name, query in QUERIES.items():
+            durations = []
+            for read in range(args.reads):
+                index = read % series
+                path = query.format(unit=1 + index % 4, port=index // 4)
+                started = time.perf_counter()
+                connection.request("GET", path)
+                body = connection.getresponse().read()
+                durations.append(time.perf_counter() - started)
+            print(
+                f"{series:>7} {name:<11} {percentile(durations, 0.5) * 1000:>9.3f} {percentile(durations, 0.99) * 1000:>9.3f} {len(body):>7}"
+            )
+        connection.close()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Compare the aggregator's line protocol serializer with the influxdb client's
+
+Run from the aggregator directory:
+
+    python -m benchmarks.line_protocol
+"""
+
+from datetime import datetime, timedelta
+import time
+
+from influxdb.line_protocol import make_lines as influxdb_make_lines
+
+from line_protocol import make_lines
+
+BATCH_SIZES = (1, 10, 100, 1000, 10000)
+PRECISION = "ms"
+
+
+def make_points(count: int):
+    start = datetime(2019, 5, 3, 23, 25, 43, 511000)
+    return [
+        {
+            "measurement": "solar_controller",
+            "time": (start + timedelta(minutes=i)).isoformat("T") + "Z",
+            "tags": {"type": "epsolar_tracer", "model": "Tracer4215BN"},
+            "fields": {
+                "pv_voltage": 35.12 + i % 100 / 100,
+                "pv_current": 1.5,
+                "pv_power": 52.68,
+                "battery_voltage": 13.21,
+                "battery_temperature": 25.0,
+                "generated_today": 0.42,
+                "generated_total": 125.8,
+                "charging_mode": "MPPT",
+                "output_current": 3.9,
+                "output_power": 51.5,
+                "equipment_temperature": 27.5,
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def points_per_second(fn, points, min_seconds: float = 0.5) -> float:
+    iterations = 0
+    started = time.perf_counter()
+    while True:
+        fn(points)
+        iterations += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return iterations * len(points) / elapsed
+
+
+def main():
+    print(
+        f"{'points':>8} {'influxdb (pts/s)':>18} {'aggregator (pts/s)':>20} {'speedup':>8}"
+    )
+    for size in BATCH_SIZES:
+        points = make_points(size)
+        baseline = points_per_second(
+            lambda p: influxdb_make_lines({"points": p}, PRECISION), points
+        )
+        optimized = points_per_second(lambda p: make_lines(p, PRECISION), points)
+        print(
+            f"{size:>8} {baseline:>18,.0f} {optimized:>20,.0f} {optimized / baseline:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
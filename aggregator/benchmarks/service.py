@@ -0,0 +1,106 @@
+"""Measure the service's throughput from a Pub/Sub stand-in to an InfluxDB stand-in
+
+Messages shaped like the collector's are published up front, then the service runs
+until every one of them was acknowledged. Each run publishes messages of its own, so
+that none are left out as already written. Run from the aggregator directory:
+
+    python -m benchmarks.service --messages 20000 --workers 1 4
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import threading
+import time
+
+from standins import InfluxStandIn, PubSubStandIn
+
+
+def make_message(index: int, points: int) -> bytes:
+    start = datetime(2019, 5, 3, 23, 25, 43, 511000) + timedelta(minutes=index)
+    return json.dumps(
+        [
+            {
+                "measurement": "solar_controller",
+                "time": (start + timedelta(seconds=i)).isoformat("T") + "Z",
+                "tags": {
+                    "type": "epsolar_tracer",
+                    "model": "Tracer4215BN",
+                    "port": "/dev/serial485",
+                    "unit": str(1 + i % 4),
+                },
+                "fields": {
+                    "pv_voltage": 35.12 + index % 100 / 100,
+                    "pv_current": 1.5,
+                    "pv_power": 52.68,
+                    "battery_voltage": 13.21,
+                    "battery_temperature": 21.5,
+                    "generated_today": 0.42,
+                    "generated_total": 1234.56,
+                    "output_current": 3.2,
+                    "output_power": 42.27,
+                    "equipment_temperature": 24.0,
+                    "charging_mode": "MPPT",
+                },
+            }
+            for i in range(points)
+        ]
+    ).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--points", type=int, default=1, help="points per message")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count()])
+    args = parser.parse_args()
+
+    influx = InfluxStandIn()
+    influx.start()
+    pubsub = PubSubStandIn()
+    pubsub.start()
+    os.environ["INFLUXDB_HOST"], port = influx.address
+    os.environ["INFLUXDB_PORT"] = str(port)
+    os.environ["PUBSUB_EMULATOR_HOST"] = "%s:%d" % pubsub.address
+
+    # Imported once the environment points at the stand-ins
+    from main import make_rollups
+    from service import AggregatorService
+    from sources import PubSubPullSource
+
+    print(
+        f"{'workers':>8} {'seconds':>8} {'messages/s':>11} {'points/s':>10} {'writes':>7}"
+    )
+    for run, workers in enumerate(args.workers):
+        first = run * args.messages
+        for index in range(first, first + args.messages):
+            pubsub.publish(make_message(index, args.points))
+        writes_before = influx.get_stats()["writes"]
+
+        service = AggregatorService(
+            PubSubPullSource("projects/benchmark/subscriptions/benchmark"),
+            workers=workers,
+            pull_messages=1000,
+            rollups=make_rollups(),
+        )
+        started = time.perf_counter()
+        runner = threading.Thread(target=service.run)
+        runner.start()
+        while pubsub.pending():
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        service.stop()
+        runner.join()
+
+        stats = service.get_stats()
+        print(
+            f"{workers:>8} {elapsed:>8.2f} {stats['messages'] / elapsed:>11,.0f} {stats['points'] / elapsed:>10,.0f} {influx.get_stats()['writes'] - writes_before:>7}"
+        )
+
+    pubsub.stop()
+    influx.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Decoder for the compact payload encoding used by the collectors
+
+See collectors/machinon/encoding.py for a description of the format. Payloads are
+recognized by their leading MAGIC byte, anything else is treated as JSON.
+
+The constants and layout are copied from the encoder. Any change to them must bump
+VERSION there and SUPPORTED_VERSIONS here. tests/test_compact.py round-trips
+payloads through both.
+"""
+
+from datetime import datetime, timedelta
+import struct
+from typing import List, Tuple
+
+MAGIC = 0xE5
+SUPPORTED_VERSIONS = (1,)
+
+KIND_STRING = 0
+KIND_FLOAT = 1
+KIND_SCALED = 2
+KIND_INTEGER = 3
+KIND_BOOLEAN = 4
+
+EPOCH = datetime(1970, 1, 1)
+
+_double = struct.Struct("<d")
+
+
+def is_compact(data: bytes) -> bool:
+    return len(data) > 0 and data[0] == MAGIC
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offset = 0
+
+    def read_byte(self) -> int:
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def read_bytes(self, size: int) -> bytes:
+        value = self.data[self.offset : self.offset + size]
+        if len(value) != size:
+            raise ValueError("Truncated compact payload")
+        self.offset += size
+        return value
+
+    def read_varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def read_svarint(self) -> int:
+        value = self.read_varint()
+        return (value >> 1) ^ -(value & 1)
+
+    def read_str(self) -> str:
+        return self.read_bytes(self.read_varint()).decode("utf-8")
+
+    def read_double(self) -> float:
+        return _double.unpack(self.read_bytes(_double.size))[0]
+
+
+def _format_time(milliseconds: int) -> str:
+    time = EPOCH + timedelta(milliseconds=milliseconds)
+    return time.isoformat("T", timespec="milliseconds") + "Z"
+
+
+def _decode_block(reader: _Reader) -> List[dict]:
+    measurement = reader.read_str()
+    tags = {}
+    for _ in range(reader.read_varint()):
+        key = reader.read_str()
+        tags[key] = reader.read_str()
+
+    fields: List[Tuple[str, int, int]] = []
+    for _ in range(reader.read_varint()):
+        name = reader.read_str()
+        kind = reader.read_byte()
+        multiplier = reader.read_varint() if kind == KIND_SCALED else 1
+        fields.append((name, kind, multiplier))
+
+    strings = [reader.read_str() for _ in range(reader.read_varint())]
+
+    points = []
+    row_count = reader.read_varint()
+    time = reader.read_varint()
+    bitmap_size = (len(fields) + 7) // 8
+    for _ in range(row_count):
+        time += reader.read_svarint()
+        bitmap = int.from_bytes(reader.read_bytes(bitmap_size), "little")
+
+        values = {}
+        for i, (name, kind, multiplier) in enumerate(fields):
+            if not bitmap & (1 << i):
+                continue
+            if kind == KIND_SCALED:
+                values[name] = float(reader.read_svarint()) / multiplier
+            elif kind == KIND_FLOAT:
+                values[name] = reader.read_double()
+            elif kind == KIND_INTEGER:
+                values[name] = reader.read_svarint()
+            elif kind == KIND_BOOLEAN:
+                values[name] = bool(reader.read_byte())
+            elif kind == KIND_STRING:
+                values[name] = strings[reader.read_varint()]
+            else:
+                raise ValueError(f"Unknown field kind {kind}")
+
+        points.append(
+            {
+                "measurement": measurement,
+                "tags": dict(tags),
+                "time": _format_time(time),
+                "fields": values,
+            }
+        )
+
+    return points
+
+
+def decode_compact(data: bytes) -> List[dict]:
+    """Decode a compact payload into InfluxDB points"""
+    reader = _Reader(data)
+    if reader.read_byte() != MAGIC:
+        raise ValueError("Not a compact payload")
+
+    version = reader.read_byte()
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported compact payload version {version}")
+
+    points = []
+    for _ in range(reader.read_varint()):
+        points += _decode_block(reader)
+    return points
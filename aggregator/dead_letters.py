@@ -0,0 +1,64 @@
+"""Sinks for the points that could not be written, see validation.py
+
+DEAD_LETTER_PATH names a file that rejected points are appended to, one JSON object
+per line. Without it they are only logged.
+"""
+
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import threading
+from typing import List, Optional
+
+from validation import Rejected
+
+
+class LogSink:
+    """Log every rejected point with the reason, as a warning"""
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+    def send(self, rejected: List[Rejected], database: Optional[str] = None):
+        for item in rejected:
+            self.logger.warning(
+                f"Rejected point for database {database}: {item.reason}: {item.data!r}"
+            )
+
+
+class JsonLinesSink:
+    """Append rejected points to a file, with the database, reason and time rejected"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, rejected: List[Rejected], database: Optional[str] = None):
+        if not rejected:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        records = "".join(
+            json.dumps(
+                {
+                    "rejected_at": now,
+                    "database": database,
+                    "reason": item.reason,
+                    # A point, a line when InfluxDB rejected it, or the payload of
+                    # a message that could not be decoded
+                    "data": item.data,
+                },
+                default=repr,
+            )
+            + "\n"
+            for item in rejected
+        )
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(records)
+
+
+def make_dead_letter_sink():
+    path = os.environ.get("DEAD_LETTER_PATH")
+    if path:
+        return JsonLinesSink(path)
+    return LogSink()
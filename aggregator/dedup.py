@@ -0,0 +1,64 @@
+"""Drop points that were already written, as sent again by at-least-once delivery
+
+Both MQTT QoS 1 and Pub/Sub may deliver a message more than once, so the same points
+often arrive twice. Deduplicator remembers the lines most recently written and filters
+repeats out before they are written again. Whole lines are compared, not only their
+series and time: InfluxDB merges the fields of points sharing a series and time, so
+those are not repeats unless their fields are the same too.
+"""
+
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Tuple
+
+
+class Deduplicator:
+    """Remember the last `max_entries` lines written, 0 disables deduplication
+
+    Lines are remembered by their hash, in about 200 bytes each.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self.stats, entries=len(self._seen))
+
+    def filter(self, scope: Hashable, lines: List[str]) -> Tuple[List[str], List[int]]:
+        """Get the lines that weren't written yet, and the keys to remember() them by
+
+        `scope` tells apart the same line written to different places. Repeats within
+        `lines` are dropped as well.
+        """
+        if not self.max_entries:
+            return lines, []
+
+        seen = self._seen
+        keys: List[int] = []
+        pending = set()
+        new_lines = []
+        for line in lines:
+            key = hash((scope, line))
+            if key in seen:
+                seen.move_to_end(key)
+            elif key not in pending:
+                pending.add(key)
+                keys.append(key)
+                new_lines.append(line)
+        self.stats["hits"] += len(lines) - len(new_lines)
+        self.stats["misses"] += len(new_lines)
+        return new_lines, keys
+
+    def remember(self, keys: List[int]):
+        """Remember lines once they were written, forgetting the least recent ones"""
+        if not keys:
+            return
+        seen = self._seen
+        for key in keys:
+            seen[key] = None
+        excess = len(seen) - self.max_entries
+        if excess > 0:
+            for _ in range(excess):
+                seen.popitem(last=False)
+            self.stats["evictions"] += excess
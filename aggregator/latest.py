@@ -0,0 +1,273 @@
+"""Keep the latest value of every field of every series, and serve them over HTTP
+
+Status panels and alerts read a device's current battery voltage or charging mode
+from here instead of running last() queries against InfluxDB. Each field keeps the
+value with the newest time, since points may only carry the fields that changed, and
+redelivered or late points don't replace newer values.
+
+Workers reduce the points of each pull with extract_latest(), and the service merges
+the result into LatestValues, which can be saved to and loaded from a JSON file.
+LatestValuesServer answers GET requests on /latest:
+
+    /latest                                         every series
+    /latest?measurement=solar_controller&unit=1     filtered by measurement and tags
+    /latest?unit=1&field=battery_voltage            only some fields
+
+and with a JSON list of {"database", "measurement", "tags", "fields"}, where each
+field is {"value": ..., "time": "<RFC3339>"}.
+"""
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from line_protocol import tag_set, time_ns
+
+# (database, measurement, tags)
+SeriesKey = Tuple[Optional[str], str, Tuple[Tuple[str, str], ...]]
+# Field -> (time in ns, value)
+SeriesFields = Dict[str, Tuple[int, Any]]
+Updates = Dict[SeriesKey, SeriesFields]
+
+
+def merge_fields(fields: SeriesFields, updates: SeriesFields) -> bool:
+    """Merge newer values into `fields`, returning whether any were"""
+    changed = False
+    for name, update in updates.items():
+        current = fields.get(name)
+        if current is None or update[0] >= current[0]:
+            if current != update:
+                fields[name] = update
+                changed = True
+    return changed
+
+
+def merge_updates(updates: Updates, more: Updates):
+    for key, fields in more.items():
+        current = updates.get(key)
+        if current is None:
+            updates[key] = dict(fields)
+        else:
+            merge_fields(current, fields)
+
+
+def extract_latest(
+    points: Iterable[dict], database: Optional[str], precision: Optional[str]
+) -> Updates:
+    """Get the latest value of every field of every series in the points"""
+    updates: Updates = {}
+    for point in points:
+        try:
+            ns = time_ns(point.get("time"), precision)
+        except (KeyError, TypeError, ValueError):
+            continue
+        tags = point.get("tags")
+        key = (
+            database,
+            point["measurement"],
+            tag_set(tuple(tags.items())) if tags else (),
+        )
+        fields = updates.get(key)
+        if fields is None:
+            fields = updates[key] = {}
+        for name, value in point["fields"].items():
+            if value is None or value == "":
+                continue
+            current = fields.get(name)
+            if current is None or ns >= current[0]:
+                fields[name] = (ns, value)
+    return updates
+
+
+def format_time(ns: int) -> str:
+    seconds, remainder = divmod(ns, 10**9)
+    moment = datetime.fromtimestamp(seconds, timezone.utc)
+    return (
+        moment.strftime("%Y-%m-%dT%H:%M:%S")
+        + f".{remainder:09d}".rstrip("0").rstrip(".")
+        + "Z"
+    )
+
+
+class LatestValues:
+    """The latest values by series, saved to `path` when given
+
+    Reads take a lock only long enough to collect the series' JSON, which is rendered
+    once per change.
+    """
+
+    def __init__(self, path: Optional[str] = None, save_seconds: float = 5.0):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.save_seconds = save_seconds
+        self._lock = threading.Lock()
+        self._series: Dict[SeriesKey, SeriesFields] = {}
+        # Rendered JSON object of each series
+        self._rendered: Dict[SeriesKey, str] = {}
+        # (tag key, value) -> the series with that tag
+        self._by_tag: Dict[Tuple[str, str], Set[SeriesKey]] = {}
+        self._dirty = False
+        self._saved = time.monotonic()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._series)
+
+    def update(self, updates: Updates):
+        for key, updated in updates.items():
+            if not updated:
+                continue
+            with self._lock:
+                fields = self._series.get(key)
+                if fields is None:
+                    fields = self._series[key] = {}
+                    for tag in key[2]:
+                        self._by_tag.setdefault(tag, set()).add(key)
+                if merge_fields(fields, updated):
+                    self._rendered[key] = json.dumps(self._entry(key, fields))
+                    self._dirty = True
+
+    @staticmethod
+    def _entry(key: SeriesKey, fields: SeriesFields, names=None) -> dict:
+        database, measurement, tags = key
+        return {
+            "database": database,
+            "measurement": measurement,
+            "tags": dict(tags),
+            "fields": {
+                name: {"value": value, "time": format_time(ns)}
+                for name, (ns, value) in sorted(fields.items())
+                if names is None or name in names
+            },
+        }
+
+    def query(
+        self,
+        measurement: Optional[str] = None,
+        tags: Optional[Dict[str, str]] = None,
+        fields: Optional[List[str]] = None,
+        database: Optional[str] = None,
+    ) -> str:
+        """Get the matching series as a JSON list"""
+        wanted = set((tags or {}).items())
+        with self._lock:
+            candidates: Iterable[SeriesKey] = self._series
+            if wanted:
+                candidates = min(
+                    (self._by_tag.get(tag, set()) for tag in wanted), key=len
+                )
+            keys = [
+                key
+                for key in candidates
+                if (measurement is None or key[1] == measurement)
+                and (database is None or key[0] == database)
+                and wanted.issubset(key[2])
+            ]
+            if not fields:
+                return "[" + ",".join(self._rendered[key] for key in keys) + "]"
+            entries = [self._entry(key, self._series[key], fields) for key in keys]
+        return json.dumps([entry for entry in entries if entry["fields"]])
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as file:
+            entries = json.load(file)
+        for entry in entries:
+            key = (
+                entry["database"],
+                entry["measurement"],
+                tuple(sorted(entry["tags"].items())),
+            )
+            self.update(
+                {key: {name: tuple(field) for name, field in entry["fields"].items()}}
+            )
+        self._dirty = False
+        self.logger.info(f"Loaded the latest values of {len(entries)} series")
+
+    def save(self):
+        """Replace the file with the current values, if they changed"""
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            entries = [
+                {
+                    "database": database,
+                    "measurement": measurement,
+                    "tags": dict(tags),
+                    "fields": dict(fields),
+                }
+                for (database, measurement, tags), fields in self._series.items()
+            ]
+            self._dirty = False
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(entries, file)
+        os.replace(temporary, self.path)
+        self._saved = time.monotonic()
+
+    def save_if_due(self):
+        if time.monotonic() - self._saved >= self.save_seconds:
+            self.save()
+
+
+class LatestValuesServer:
+    """Serve the latest values on `host`:`port`, 0 picks a free port"""
+
+    def __init__(self, latest: LatestValues, host: str = "127.0.0.1", port: int = 0):
+        self.logger = logging.getLogger(__name__)
+
+        class Handler(BaseHTTPRequestHandler):
+            # Kept alive, so that a client polling doesn't reconnect for every read
+            protocol_version = "HTTP/1.1"
+            # The headers and body are separate writes, which Nagle's algorithm would
+            # hold back until the client's delayed acknowledgement
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path.rstrip("/") != "/latest":
+                    self.reply(404, '{"error": "not found"}')
+                    return
+                params = parse_qs(url.query)
+                fields = params.pop("field", None)
+                measurement = params.pop("measurement", [None])[-1]
+                database = params.pop("database", [None])[-1]
+                # The other parameters are tags
+                tags = {name: values[-1] for name, values in params.items()}
+                self.reply(200, latest.query(measurement, tags, fields, database))
+
+            def reply(self, status: int, body: str):
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server.server_address[:2]
+
+    def start(self):
+        self.logger.info(f"Serving the latest values on {self.address}")
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="latest-values", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,170 @@
+"""Serialize points to the InfluxDB line protocol
+
+This produces the same lines as influxdb.line_protocol.make_lines, but avoids most of
+its per-point work: escaped names and sorted tag sets are cached, timestamps are
+parsed without dateutil and converted with integer arithmetic.
+"""
+
+from datetime import datetime, timezone
+from functools import lru_cache
+import re
+import time
+from typing import Iterable, List, Optional, Tuple
+
+PRECISION_DIVISORS = {
+    None: 1,
+    "n": 1,
+    "u": 10**3,
+    "ms": 10**6,
+    "s": 10**9,
+    "m": 60 * 10**9,
+    "h": 3600 * 10**9,
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_time_pattern = re.compile(
+    r"(\d{4}-\d{2}-\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?"
+    r"(Z|[+-]\d{2}:?\d{2})?$"
+)
+
+
+@lru_cache(maxsize=4096)
+def escape_key(key: str) -> str:
+    """Escape a measurement, tag key or field key"""
+    return (
+        str(key)
+        .replace("\\", "\\\\")
+        .replace(" ", "\\ ")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+    )
+
+
+@lru_cache(maxsize=4096)
+def escape_tag_value(value) -> str:
+    escaped = escape_key(value)
+    if escaped.endswith("\\"):
+        escaped += " "
+    return escaped
+
+
+@lru_cache(maxsize=1024)
+def series_key(measurement: str, tags: Tuple[Tuple[str, str], ...]) -> str:
+    """Get the escaped measurement and sorted tag set that start a line"""
+    elements = [escape_key(measurement)]
+    for key, value in sorted(tags):
+        if key == "" or value is None or value == "":
+            continue
+        elements.append(escape_key(key) + "=" + escape_tag_value(value))
+    return ",".join(elements)
+
+
+@lru_cache(maxsize=1024)
+def field_prefixes(keys: Tuple[str, ...]) -> List[Tuple[str, str]]:
+    """Get the sorted field keys of a point, each with its escaped "key=" prefix"""
+    return [(key, escape_key(key) + "=") for key in sorted(keys) if key != ""]
+
+
+def format_field_value(value) -> Optional[str]:
+    value_type = type(value)
+    if value_type is float:
+        return repr(value)
+    if value_type is bool:
+        return "true" if value else "false"
+    if value_type is int:
+        return f"{value}i"
+    if value_type is str:
+        if value == "":
+            return None
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    if value is None:
+        return None
+    return repr(float(value))
+
+
+@lru_cache(maxsize=64)
+def _days_since_epoch(date: str) -> int:
+    return datetime.strptime(date, "%Y-%m-%d").toordinal() - 719163
+
+
+def parse_time(value: str) -> int:
+    """Convert an RFC3339 timestamp to nanoseconds since the epoch"""
+    match = _time_pattern.match(value)
+    if match is None:
+        raise ValueError(f"Unsupported time {value!r}")
+
+    date, hours, minutes, seconds, fraction, offset = match.groups()
+    total = (
+        _days_since_epoch(date) * 86400
+        + int(hours) * 3600
+        + int(minutes) * 60
+        + int(seconds)
+    )
+    if offset and offset != "Z":
+        sign = -1 if offset[0] == "-" else 1
+        offset = offset[1:].replace(":", "")
+        total -= sign * (int(offset[:2]) * 3600 + int(offset[2:]) * 60)
+
+    ns = total * 10**9
+    if fraction:
+        ns += int(fraction.ljust(9, "0"))
+    return ns
+
+
+def convert_time(value, precision: Optional[str] = None) -> int:
+    if type(value) is int:
+        # Assume the precision is correct, like the influxdb client does
+        return value
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        ns = (value - EPOCH) // datetime.resolution * 1000
+    else:
+        ns = parse_time(value)
+    return ns // PRECISION_DIVISORS[precision]
+
+
+def time_ns(value, precision: Optional[str] = None) -> int:
+    """Get a point's time in nanoseconds, an int time being in `precision`"""
+    if value is None:
+        # Timestamped by InfluxDB on arrival
+        return time.time_ns()
+    if type(value) is int:
+        return value * PRECISION_DIVISORS[precision]
+    return convert_time(value)
+
+
+@lru_cache(maxsize=1024)
+def tag_set(tags: Tuple[Tuple[str, str], ...]) -> Tuple[Tuple[str, str], ...]:
+    """Get the tags a point is written with, as sorted (key, value) strings"""
+    return tuple(
+        sorted(
+            (str(key), str(value))
+            for key, value in tags
+            if key != "" and value is not None and value != ""
+        )
+    )
+
+
+def make_line(point: dict, precision: Optional[str] = None) -> str:
+    tags = point.get("tags")
+    line = series_key(point["measurement"], tuple(tags.items()) if tags else ())
+
+    values = point["fields"]
+    fields = []
+    for key, prefix in field_prefixes(tuple(values)):
+        formatted = format_field_value(values[key])
+        if formatted is not None:
+            fields.append(prefix + formatted)
+    line += " " + ",".join(fields)
+
+    time = point.get("time")
+    if time is not None:
+        line += " " + str(convert_time(time, precision))
+    return line
+
+
+def make_lines(points: Iterable[dict], precision: Optional[str] = None) -> List[str]:
+    """Serialize points, for use with write_points(..., protocol="line")"""
+    return [make_line(point, precision) for point in points]
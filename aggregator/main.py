@@ -2,9 +2,29 @@ import base64
 from datetime import datetime
 from enum import Enum
 import json
+import logging
 import os
+import random
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
 
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+import requests
+
+from compact import decode_compact, is_compact
+from dead_letters import make_dead_letter_sink
+from dedup import Deduplicator
+from latest import Updates, extract_latest, merge_updates
+from line_protocol import make_lines
+from rollups import Rollups, Sample, extract_samples
+from validation import (
+    INFLUX_FIELD_TYPES,
+    FieldTypeMap,
+    FieldTypes,
+    Rejected,
+    make_valid_lines,
+)
 
 
 class SslConfig(Enum):
@@ -28,21 +48,362 @@ influx_options = {
     "username": os.environ.get("INFLUXDB_USERNAME"),
     "password": os.environ.get("INFLUXDB_PASSWORD"),
     "database": os.environ.get("INFLUXDB_DATABASE"),
+    # Connections are kept alive in this pool and reused by later invocations
+    "pool_size": int(os.environ.get("INFLUXDB_POOL_SIZE", 4)),
+    "timeout": float(os.environ.get("INFLUXDB_TIMEOUT", 10)),
+    "retries": int(os.environ.get("INFLUXDB_RETRIES", 3)),
 }
 
+# Points are written in chunks of at most this many per request
+batch_size = int(os.environ.get("INFLUXDB_BATCH_SIZE", 5000))
+# Precision of the timestamps sent to InfluxDB, unless a batch specifies its own
+time_precision = os.environ.get("INFLUXDB_TIME_PRECISION", "ms")
+# Writes failing with a server or connection error are retried this many times, the
+# first time after this many seconds and then twice as long as the time before
+write_retries = int(os.environ.get("INFLUXDB_WRITE_RETRIES", 4))
+write_backoff = float(os.environ.get("INFLUXDB_WRITE_BACKOFF", 0.5))
+# Lines remembered to drop redelivered points, 0 writes every point received
+dedup_max_entries = int(os.environ.get("DEDUP_MAX_ENTRIES", 100000))
+# Measurement the service keeps hourly and daily rollups of, none when empty. The
+# function never does: its instances would overwrite each other's rollups.
+rollup_measurement = os.environ.get("ROLLUP_MEASUREMENT", "solar_controller")
+# Days start at midnight this many hours ahead of UTC
+rollup_utc_offset = float(os.environ.get("ROLLUP_UTC_OFFSET_HOURS", 0))
+# Level of the function's logs, the service has its own (see service.py)
+log_level = os.environ.get("LOG_LEVEL", "INFO")
+
+logger = logging.getLogger(__name__)
+
+# Created on first use and kept for as long as the function instance stays warm
+influx_client: Optional[InfluxDBClient] = None
+
+
+def get_influx_client() -> InfluxDBClient:
+    global influx_client
+    if influx_client is None:
+        influx_client = InfluxDBClient(**influx_options)
+    return influx_client
+
+
+def reset_influx_client() -> InfluxDBClient:
+    """Replace the shared client after a connection error and check that the new one is healthy"""
+    global influx_client
+    if influx_client is not None:
+        influx_client.close()
+    influx_client = None
+
+    client = get_influx_client()
+    version = client.ping()
+    logger.info(f"Reconnected to InfluxDB {version}")
+    return client
+
+
+def write_points(points, **kwargs):
+    try:
+        return get_influx_client().write_points(points, **kwargs)
+    except requests.exceptions.ConnectionError:
+        # Pooled connections may have been dropped while the instance sat idle
+        logger.warning("Connection to InfluxDB failed, rebuilding client")
+        return reset_influx_client().write_points(points, **kwargs)
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed write may succeed when retried"""
+    if isinstance(error, InfluxDBClientError):
+        # Too many requests, the other client errors are the request's fault
+        return error.code == 429
+    return isinstance(
+        error,
+        (
+            InfluxDBServerError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ),
+    )
+
+
+def write_with_retries(points, **kwargs):
+    """Write points, retrying transient errors with an exponential backoff"""
+    for attempt in range(write_retries + 1):
+        try:
+            return write_points(points, **kwargs)
+        except Exception as e:
+            if attempt == write_retries or not is_transient(e):
+                raise
+            # Jittered, so that instances failing together don't retry together
+            delay = write_backoff * 2**attempt * random.uniform(0.5, 1.0)
+            logger.warning(
+                f"Writing to InfluxDB failed ({e}), retrying in {delay:.2f}s"
+            )
+            time.sleep(delay)
+
+
+def write_isolating(lines: List[str], rejected: List[Rejected], **kwargs):
+    """Write lines, setting aside the ones InfluxDB rejects as a bad request
+
+    A rejected request is split in halves that are written on their own, down to the
+    single lines that are rejected. The valid lines of a rejected request were either
+    written anyway (a partial write) or are written again, overwriting the same points.
+    """
+    try:
+        write_with_retries(lines, **kwargs)
+    except InfluxDBClientError as e:
+        if e.code != 400:
+            raise
+        if len(lines) == 1:
+            try:
+                reason = json.loads(e.content)["error"]
+            except (ValueError, KeyError, TypeError):
+                reason = e.content
+            rejected.append(Rejected(lines[0], reason))
+            return
+        middle = len(lines) // 2
+        write_isolating(lines[:middle], rejected, **kwargs)
+        write_isolating(lines[middle:], rejected, **kwargs)
+
+
+class WriteGroup(NamedTuple):
+    """Points that can be written in the same request"""
+
+    database: Optional[str]
+    retention_policy: Optional[str]
+    precision: Optional[str]
+
+
+GroupLines = Dict[WriteGroup, List[str]]
+GroupRejected = Dict[WriteGroup, List[Rejected]]
+# Rollup samples by database
+DatabaseSamples = Dict[Optional[str], List[Sample]]
+
+
+def load_field_types(database: Optional[str]) -> FieldTypeMap:
+    """Get the types of the fields already in a database"""
+    result = get_influx_client().query("SHOW FIELD KEYS", database=database)
+    return {
+        (measurement, row["fieldKey"]): INFLUX_FIELD_TYPES[row["fieldType"]]
+        for (measurement, _), rows in result.items()
+        for row in rows
+    }
+
+
+# Loaded from each database once per instance, then learned from the points written
+field_types = FieldTypes(load_field_types)
+
+dead_letter_sink = make_dead_letter_sink()
+
+# Remembers what this instance wrote, for as long as it stays warm
+deduplicator = Deduplicator(dedup_max_entries)
+
+
+def load_rollups(database: Optional[str], measurement: str, start: int, end: int):
+    """Get the rollups written between two times, in seconds since the epoch"""
+    result = get_influx_client().query(
+        f'SELECT * FROM "{measurement}" WHERE time >= {start}s AND time < {end}s GROUP BY *',
+        database=database,
+        epoch="s",
+    )
+    return [
+        (tags, row["time"], row) for (_, tags), rows in result.items() for row in rows
+    ]
 
-def smarthome_telemetry_aggregator(event, context):
-    client = InfluxDBClient(**influx_options)
 
-    # Messages coming from PubSub will have the data base64 encoded in event['data']
-    if "data" in event:
-        data = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
+def make_rollups() -> Optional[Rollups]:
+    """Create the rollups of ROLLUP_MEASUREMENT, to be kept by a single process"""
+    if not rollup_measurement:
+        return None
+    return Rollups(rollup_measurement, load_rollups, int(rollup_utc_offset * 3600))
+
+
+def decode_data(data: bytes) -> Any:
+    """Decode the data of a message, in the compact encoding or JSON"""
+    if is_compact(data):
+        return decode_compact(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def decode_messages(event) -> List[Any]:
+    """Extract the payload(s) from an event holding one or more Pub/Sub messages"""
+    if "messages" in event:
+        # Several messages delivered together, either bare or in push format
+        messages = [message.get("message", message) for message in event["messages"]]
     else:
-        data = event
+        messages = [event]
+
+    payloads = []
+    for message in messages:
+        # Messages coming from PubSub will have the data base64 encoded in message['data']
+        if "data" in message:
+            payloads.append(decode_data(base64.b64decode(message["data"])))
+        else:
+            payloads.append(message)
+    return payloads
+
+
+def group_points(
+    payloads: Iterable[Any], default_group: WriteGroup
+) -> Dict[WriteGroup, List[dict]]:
+    """Group points by the database, retention policy and precision they are written with
+
+    A payload is either a single point, a list of payloads, or a batch of the form
+    {"database": ..., "retention_policy": ..., "precision": ..., "points": [...]}
+    where every key but "points" is optional.
+    """
+    groups: Dict[WriteGroup, List[dict]] = {}
+
+    def add(payload, group: WriteGroup):
+        if type(payload) is list:
+            for item in payload:
+                add(item, group)
+        elif "points" in payload:
+            batch_group = WriteGroup(
+                payload.get("database", group.database),
+                payload.get("retention_policy", group.retention_policy),
+                payload.get("precision", group.precision),
+            )
+            add(payload["points"], batch_group)
+        else:
+            groups.setdefault(group, []).append(payload)
+
+    for payload in payloads:
+        add(payload, default_group)
+
+    return groups
+
+
+class Serialized(NamedTuple):
+    groups: GroupLines
+    # Points that failed validation
+    rejected: GroupRejected
+    # Samples of the valid points for the rollups
+    samples: DatabaseSamples
+    # Latest values of the valid points, when asked for
+    latest: Updates
+
+
+def make_group_lines(
+    payloads: Iterable[Any],
+    latest: bool = False,
+    rollup_measurement: Optional[str] = None,
+) -> Serialized:
+    """Serialize the points of payloads to the line protocol, grouped as in group_points()
 
-    # InfluxDB client expects a list of data points
-    if type(data) is not list:
-        data = [data]
+    Points that fail validation are returned apart, by group. With
+    `rollup_measurement`, the samples of the others for its rollups are returned by
+    database, and with `latest`, the latest value of every field of every series.
+    """
+    default_group = WriteGroup(None, None, time_precision)
+    groups: GroupLines = {}
+    rejected: GroupRejected = {}
+    samples: DatabaseSamples = {}
+    latest_values: Updates = {}
+    for group, points in group_points(payloads, default_group).items():
+        database = group.database or influx_options["database"]
+        types = field_types.for_database(database)
+        lines, group_rejected = make_valid_lines(points, group.precision, types)
+        if lines:
+            groups[group] = lines
+        if group_rejected:
+            rejected[group] = group_rejected
+            rejected_ids = {id(item.data) for item in group_rejected}
+            points = [point for point in points if id(point) not in rejected_ids]
+        if rollup_measurement:
+            group_samples = extract_samples(points, rollup_measurement, group.precision)
+            if group_samples:
+                samples.setdefault(database, []).extend(group_samples)
+        if latest:
+            merge_updates(
+                latest_values, extract_latest(points, database, group.precision)
+            )
+    return Serialized(groups, rejected, samples, latest_values)
+
+
+class Written(NamedTuple):
+    points: int
+    # Points left out as already written
+    duplicates: int
+    # Lines InfluxDB rejected
+    rejected: GroupRejected
+
+
+def write_groups(groups: GroupLines) -> Written:
+    """Write the lines of each group that weren't written yet"""
+    points = 0
+    duplicates = 0
+    rejected: GroupRejected = {}
+    for group, all_lines in groups.items():
+        lines, keys = deduplicator.filter(group, all_lines)
+        duplicates += len(all_lines) - len(lines)
+        group_rejected: List[Rejected] = []
+        for start in range(0, len(lines), batch_size):
+            write_isolating(
+                lines[start : start + batch_size],
+                group_rejected,
+                database=group.database,
+                retention_policy=group.retention_policy,
+                time_precision=group.precision,
+                protocol="line",
+            )
+        # Only once written, points of a failed write are written again when redelivered
+        deduplicator.remember(keys)
+        points += len(lines) - len(group_rejected)
+        if group_rejected:
+            rejected[group] = group_rejected
+    return Written(points, duplicates, rejected)
+
+
+def write_rollups(rollups: Rollups, samples: DatabaseSamples) -> int:
+    """Merge samples into the rollups and write the rollups that changed
+
+    Returns the number of rollup points written. Rollups InfluxDB rejects go to the
+    dead-letter sink rather than failing the write, they would fail it every time.
+    """
+    for database, database_samples in samples.items():
+        rollups.add(database, database_samples)
+
+    written = 0
+    for database, points in rollups.changed_points().items():
+        lines = make_lines(points, "s")
+        rejected: List[Rejected] = []
+        for start in range(0, len(lines), batch_size):
+            write_isolating(
+                lines[start : start + batch_size],
+                rejected,
+                database=database,
+                time_precision="s",
+                protocol="line",
+            )
+        if rejected:
+            dead_letter_sink.send(rejected, database or influx_options["database"])
+        written += len(lines) - len(rejected)
+    # Not reached if a write failed, the changed rollups are then written next time
+    rollups.written()
+    return written
+
+
+def send_dead_letters(rejected: GroupRejected):
+    for group, items in rejected.items():
+        dead_letter_sink.send(items, group.database or influx_options["database"])
+
+
+def configure_function_logging():
+    """Emit the function's logs at `log_level`, which the runtime leaves unconfigured"""
+    # Does nothing if the runtime already set up a handler
+    logging.basicConfig(level=log_level)
+    logger.setLevel(log_level)
+
+
+def smarthome_telemetry_aggregator(event, context):
+    configure_function_logging()
+    payloads = decode_messages(event)
 
     # In the future, this could process/transform data. For now, we're just relaying it to InfluxDB.
-    client.write_points(data)
+    groups, rejected, _, _ = make_group_lines(payloads)
+    written = write_groups(groups)
+    # Only once written, a redelivered message would send its rejected points again
+    send_dead_letters(rejected)
+    send_dead_letters(written.rejected)
+    dedup = deduplicator.get_stats()
+    logger.info(
+        f"Wrote {written.points} points, left out {written.duplicates} already written"
+        f" (dedup hits {dedup['hits']}, misses {dedup['misses']} since start)"
+    )
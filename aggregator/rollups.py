@@ -0,0 +1,222 @@
+"""Keep hourly and daily rollups of a measurement up to date as its points arrive
+
+Each series of the measurement (e.g. solar_controller, one series per controller)
+gets a rollup point per hour and per day, in the "<measurement>_rollup" measurement
+with the same tags plus window=1h or window=1d, timestamped at the window's start:
+
+    generated_total_min, generated_total_max   energy counter at both ends
+    energy_generated                           their difference
+    pv_power_max                               peak PV power
+    battery_voltage_min, battery_voltage_max   battery voltage range
+
+Sampled minimums and maximums (pv_power_max, battery_voltage_min, ...) are used when
+points carry them. Rollups only change by taking minimums and maximums, so a point
+delivered twice or out of order leaves them unchanged. energy_generated covers the
+readings within the window: energy generated between a window's last reading and the
+next window's first one is not counted in either.
+
+Workers extract samples from the points (see extract_samples()), and the writer merges
+them into Rollups, which loads each day's rollups already written from InfluxDB the
+first time that day is seen. The rollups of one series must be kept by a single
+process: two processes would each overwrite the other's rollups with their own.
+"""
+
+import logging
+import math
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from line_protocol import tag_set, time_ns
+
+# Name and length in seconds of each window
+WINDOWS = (("1h", 3600), ("1d", 86400))
+WINDOW_SECONDS = dict(WINDOWS)
+
+# Rollup fields, how two values are merged and the point fields they are taken from
+STATISTICS = (
+    ("generated_total_min", min, ("generated_total",)),
+    ("generated_total_max", max, ("generated_total",)),
+    ("pv_power_max", max, ("pv_power", "pv_power_max")),
+    ("battery_voltage_min", min, ("battery_voltage", "battery_voltage_min")),
+    ("battery_voltage_max", max, ("battery_voltage", "battery_voltage_max")),
+)
+MERGES = {name: merge for name, merge, _ in STATISTICS}
+MINIMUMS = frozenset(name for name, merge, _ in STATISTICS if merge is min)
+
+Tags = Tuple[Tuple[str, str], ...]
+# (database, tags, window, start)
+WindowKey = Tuple[Optional[str], Tags, str, int]
+# Rollups already written between two times, as (tags with the window, start, fields)
+LoadFn = Callable[
+    [Optional[str], str, int, int], Iterable[Tuple[Dict[str, str], int, dict]]
+]
+
+
+class Sample(NamedTuple):
+    """The values of one point that go into the rollups"""
+
+    tags: Tags
+    # Seconds since the epoch
+    time: int
+    values: Dict[str, float]
+
+
+def _is_number(value) -> bool:
+    return (type(value) is float or type(value) is int) and math.isfinite(value)
+
+
+def extract_samples(
+    points: Iterable[dict], measurement: str, precision: Optional[str]
+) -> List[Sample]:
+    """Get the samples of the points of `measurement`, written with `precision`"""
+    samples = []
+    for point in points:
+        if point["measurement"] != measurement:
+            continue
+        fields = point["fields"]
+        values = {}
+        for name, merge, sources in STATISTICS:
+            for source in sources:
+                value = fields.get(source)
+                if value is not None and _is_number(value):
+                    values[name] = (
+                        merge(values[name], value) if name in values else value
+                    )
+        if not values:
+            continue
+
+        try:
+            seconds = time_ns(point.get("time"), precision) // 10**9
+        except (KeyError, TypeError, ValueError):
+            # Not written either
+            continue
+        tags = point.get("tags")
+        samples.append(
+            Sample(tag_set(tuple(tags.items())) if tags else (), seconds, values)
+        )
+    return samples
+
+
+class Rollups:
+    """Rollups of every series of `measurement`, by database
+
+    Windows start at midnight and on the hour `utc_offset` seconds ahead of UTC. The
+    rollups of the last `keep_days` days seen are kept in memory, older ones are
+    loaded again with `load_fn` if a late point needs them.
+    """
+
+    def __init__(
+        self,
+        measurement: str,
+        load_fn: LoadFn,
+        utc_offset: int = 0,
+        keep_days: int = 2,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.measurement = measurement
+        self.rollup_measurement = f"{measurement}_rollup"
+        self.load_fn = load_fn
+        self.utc_offset = utc_offset
+        self.keep_days = keep_days
+
+        self._windows: Dict[WindowKey, Dict[str, float]] = {}
+        # Days whose rollups were loaded, by database
+        self._days: Dict[Optional[str], Set[int]] = {}
+        # Windows that changed since they were last written
+        self._changed: Set[WindowKey] = set()
+
+    def _start(self, seconds: int, length: int) -> int:
+        return (seconds + self.utc_offset) // length * length - self.utc_offset
+
+    def add(self, database: Optional[str], samples: Iterable[Sample]):
+        loaded = self._days.setdefault(database, set())
+        for sample in samples:
+            day = self._start(sample.time, 86400)
+            if day not in loaded:
+                self._load(database, day)
+                loaded.add(day)
+            for window, length in WINDOWS:
+                key = (database, sample.tags, window, self._start(sample.time, length))
+                if self._merge(key, sample.values):
+                    self._changed.add(key)
+        self._evict(database)
+
+    def _merge(self, key: WindowKey, values: Dict[str, float]) -> bool:
+        """Merge values into a window's rollups, returning whether they changed"""
+        rollups = self._windows.setdefault(key, {})
+        changed = False
+        for name, value in values.items():
+            current = rollups.get(name)
+            if current is None or (
+                value < current if name in MINIMUMS else value > current
+            ):
+                rollups[name] = value
+                changed = True
+        return changed
+
+    def _load(self, database: Optional[str], day: int):
+        """Merge in the rollups already written for a day"""
+        count = 0
+        for tags, start, fields in self.load_fn(
+            database, self.rollup_measurement, day, day + 86400
+        ):
+            tags = dict(tags)
+            window = tags.pop("window", None)
+            if window not in WINDOW_SECONDS:
+                continue
+            values = {
+                name: fields[name] for name in MERGES if _is_number(fields.get(name))
+            }
+            self._merge((database, tuple(sorted(tags.items())), window, start), values)
+            count += 1
+        self.logger.debug(f"Loaded {count} rollups of day {day} from {database}")
+
+    def _evict(self, database: Optional[str]):
+        loaded = self._days[database]
+        if len(loaded) <= self.keep_days:
+            return
+        oldest = sorted(loaded)[-self.keep_days]
+        loaded.difference_update([day for day in loaded if day < oldest])
+        for key in [
+            key
+            for key in self._windows
+            if key[0] == database
+            and self._start(key[3], 86400) < oldest
+            and key not in self._changed
+        ]:
+            del self._windows[key]
+
+    def changed_points(self) -> Dict[Optional[str], List[dict]]:
+        """Get the rollups that changed as points by database, to be written
+
+        They are reported again until written() is called.
+        """
+        points: Dict[Optional[str], List[dict]] = {}
+        for key in self._changed:
+            database, tags, window, start = key
+            # Floats whatever the points carried, as a field's type can't change
+            fields = {name: float(value) for name, value in self._windows[key].items()}
+            if "generated_total_min" in fields and "generated_total_max" in fields:
+                fields["energy_generated"] = round(
+                    fields["generated_total_max"] - fields["generated_total_min"], 6
+                )
+            points.setdefault(database, []).append(
+                {
+                    "measurement": self.rollup_measurement,
+                    "tags": {**dict(tags), "window": window},
+                    "time": start,
+                    "fields": fields,
+                }
+            )
+        return points
+
+    def written(self):
+        self._changed.clear()
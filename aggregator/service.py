@@ -0,0 +1,396 @@
+"""Run the aggregator as a long-lived service rather than a Cloud Function
+
+Messages are pulled from a source (see sources.py), decoded and serialized to the line
+protocol by a pool of worker processes, and written to InfluxDB in batches spanning
+many messages. A batch's messages are acknowledged together once all of its points
+were written, and handed back for redelivery if the write failed. Points that fail
+validation or are rejected by InfluxDB go to the dead-letter sink instead (see
+dead_letters.py) and don't hold back the others. Settings are read
+from the environment like main.py's, e.g.:
+
+    AGGREGATOR_SOURCE=stdin python service.py < points.jsonl
+"""
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from latest import LatestValues, LatestValuesServer, Updates, merge_updates
+from main import (
+    DatabaseSamples,
+    GroupLines,
+    GroupRejected,
+    batch_size,
+    dead_letter_sink,
+    decode_data,
+    deduplicator,
+    make_group_lines,
+    make_rollups,
+    send_dead_letters,
+    write_groups,
+    write_rollups,
+)
+from rollups import Rollups
+from sources import JsonLinesSource, Message, MqttSource, PubSubPullSource
+from validation import Rejected
+
+
+def count_rejected(rejected: GroupRejected) -> int:
+    return sum(len(items) for items in rejected.values())
+
+
+class Decoded(NamedTuple):
+    """The points of several messages, serialized and grouped"""
+
+    groups: GroupLines
+    points: int
+    # Index of each message that could not be decoded, and why
+    failed: List[Tuple[int, str]]
+    # Points that failed validation
+    rejected: GroupRejected
+    samples: DatabaseSamples
+    # Latest values, when asked for
+    latest: Updates
+
+
+def decode_messages(
+    datas: List[bytes], latest: bool = False, rollup_measurement: Optional[str] = None
+) -> Decoded:
+    """Decode and serialize the data of several messages, run in a worker process
+
+    A message that can't be decoded or serialized is left out, and its index listed
+    with the error.
+    See make_group_lines() for `latest` and `rollup_measurement`.
+    """
+    groups: GroupLines = {}
+    rejected: GroupRejected = {}
+    samples: DatabaseSamples = {}
+    latest_values: Updates = {}
+    failed = []
+    for index, data in enumerate(datas):
+        try:
+            serialized = make_group_lines(
+                [decode_data(data)], latest, rollup_measurement
+            )
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Undecodable message: {e!r}")
+            failed.append((index, repr(e)))
+            continue
+        for group, lines in serialized.groups.items():
+            groups.setdefault(group, []).extend(lines)
+        for group, items in serialized.rejected.items():
+            rejected.setdefault(group, []).extend(items)
+        for database, items in serialized.samples.items():
+            samples.setdefault(database, []).extend(items)
+        merge_updates(latest_values, serialized.latest)
+
+    return Decoded(
+        groups,
+        sum(len(lines) for lines in groups.values()),
+        failed,
+        rejected,
+        samples,
+        latest_values,
+    )
+
+
+class Batch:
+    def __init__(self):
+        self.messages: List[Message] = []
+        self.groups: GroupLines = {}
+        self.rejected: GroupRejected = {}
+        self.samples: DatabaseSamples = {}
+        # Payloads of the messages that could not be decoded
+        self.undecodable: List[Rejected] = []
+        self.points = 0
+        self.started = time.monotonic()
+
+    def add(self, messages: List[Message], decoded: Decoded):
+        self.messages += messages
+        for group, lines in decoded.groups.items():
+            self.groups.setdefault(group, []).extend(lines)
+        for group, items in decoded.rejected.items():
+            self.rejected.setdefault(group, []).extend(items)
+        for database, items in decoded.samples.items():
+            self.samples.setdefault(database, []).extend(items)
+        for index, error in decoded.failed:
+            self.undecodable.append(
+                Rejected(messages[index].data, f"undecodable message: {error}")
+            )
+        self.points += decoded.points
+
+
+class AggregatorService:
+    """Pull, decode and write messages until the source runs dry or stop() is called
+
+    A batch is written once it holds `batch_points` points or its first message has
+    waited `batch_seconds`. Up to `max_pending` pulls are decoded ahead of the writes.
+    The latest values of the points received are kept in `latest`, and rollups in
+    `rollups`, if given. The stats are logged every `stats_seconds`. Failed pulls are
+    retried until the source ends.
+    """
+
+    def __init__(
+        self,
+        source,
+        workers: int = os.cpu_count() or 1,
+        pull_messages: int = 100,
+        pull_timeout: float = 1.0,
+        batch_points: int = batch_size,
+        batch_seconds: float = 1.0,
+        max_pending: Optional[int] = None,
+        latest: Optional[LatestValues] = None,
+        rollups: Optional[Rollups] = None,
+        stats_seconds: float = 60.0,
+        min_pull_backoff: float = 1.0,
+        max_pull_backoff: float = 60.0,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.source = source
+        self.workers = workers
+        self.pull_messages = pull_messages
+        self.pull_timeout = pull_timeout
+        self.batch_points = batch_points
+        self.batch_seconds = batch_seconds
+        self.latest = latest
+        self.rollups = rollups
+        self.stats_seconds = stats_seconds
+        self.min_pull_backoff = min_pull_backoff
+        self.max_pull_backoff = max_pull_backoff
+        self._stats_logged = time.monotonic()
+
+        # (messages, decoding) in the order they were pulled, None once the source ended
+        self._pending: "queue.Queue[Optional[Tuple[List[Message], Future]]]" = (
+            queue.Queue(maxsize=max_pending or 2 * workers)
+        )
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+        self.stats: Dict[str, int] = {
+            "messages": 0,
+            "points": 0,
+            "batches": 0,
+            "decode_failures": 0,
+            "pull_failures": 0,
+            "write_failures": 0,
+            "rejected_points": 0,
+            "rollup_points": 0,
+        }
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.stats)
+        for name, value in deduplicator.get_stats().items():
+            stats[f"dedup_{name}"] = value
+        return stats
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] += value
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        if self.workers > 1:
+            executor: Executor = ProcessPoolExecutor(self.workers)
+        else:
+            # Decoding still overlaps with writing
+            executor = ThreadPoolExecutor(1)
+
+        reader = threading.Thread(
+            target=self._read, args=(executor,), name="aggregator-source", daemon=True
+        )
+        reader.start()
+        try:
+            self._write()
+        finally:
+            self._stopping.set()
+            executor.shutdown()
+            self.source.close()
+            if self.latest is not None:
+                self.latest.save()
+
+    def _read(self, executor: Executor):
+        """Pull messages and queue them for decoding, until the source ends or on stop()
+
+        A failed pull is tried again, after a delay doubling up to `max_pull_backoff`
+        seconds while the pulls keep failing.
+        """
+        backoff = self.min_pull_backoff
+        try:
+            while not self._stopping.is_set():
+                try:
+                    messages = self.source.pull(self.pull_messages, self.pull_timeout)
+                except Exception:
+                    self.logger.exception(
+                        f"Pulling from the source failed, trying again in {backoff:.1f}s"
+                    )
+                    self._count("pull_failures")
+                    self._stopping.wait(backoff)
+                    backoff = min(backoff * 2, self.max_pull_backoff)
+                    continue
+                backoff = self.min_pull_backoff
+                if messages is None:
+                    break
+                if messages:
+                    decoding = executor.submit(
+                        decode_messages,
+                        [message.data for message in messages],
+                        self.latest is not None,
+                        self.rollups.measurement if self.rollups else None,
+                    )
+                    self._put((messages, decoding))
+        except Exception:
+            self.logger.exception("Queueing messages for decoding failed")
+        finally:
+            self._put(None)
+
+    def _put(self, item):
+        # Blocks while the writer is behind, unless stopping
+        while True:
+            try:
+                self._pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self._stopping.is_set() and item is not None:
+                    return
+
+    def _write(self):
+        batch = Batch()
+        ended = False
+        while not ended:
+            timeout = max(0.0, batch.started + self.batch_seconds - time.monotonic())
+            try:
+                item = self._pending.get(timeout=timeout if batch.messages else 0.1)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                ended = True
+            elif item:
+                messages, decoding = item
+                decoded = decoding.result()
+                if not batch.messages:
+                    batch.started = time.monotonic()
+                batch.add(messages, decoded)
+                if decoded.failed:
+                    self._count("decode_failures", len(decoded.failed))
+                if self.latest is not None:
+                    # Right away, whether or not the batch is written
+                    self.latest.update(decoded.latest)
+
+            if batch.messages and (
+                ended
+                or batch.points >= self.batch_points
+                or time.monotonic() - batch.started >= self.batch_seconds
+            ):
+                self._commit(batch)
+                batch = Batch()
+            if self.latest is not None:
+                self.latest.save_if_due()
+            if time.monotonic() - self._stats_logged >= self.stats_seconds:
+                self._stats_logged = time.monotonic()
+                self.logger.info(f"Stats: {self.get_stats()}")
+
+    def _commit(self, batch: Batch):
+        try:
+            written = write_groups(batch.groups)
+            rollup_points = 0
+            if self.rollups is not None:
+                rollup_points = write_rollups(self.rollups, batch.samples)
+        except Exception:
+            self.logger.exception(
+                f"Writing {batch.points} points from {len(batch.messages)} messages failed"
+            )
+            self._count("write_failures")
+            self.source.nack(batch.messages)
+            return
+
+        # Only once written, redelivered messages would send their points again
+        for rejected in (batch.rejected, written.rejected):
+            if rejected:
+                send_dead_letters(rejected)
+                self._count("rejected_points", count_rejected(rejected))
+        if batch.undecodable:
+            dead_letter_sink.send(batch.undecodable)
+
+        try:
+            self.source.ack(batch.messages)
+        except Exception:
+            # The points are written, redelivered messages would only be written again
+            self.logger.exception(
+                f"Acknowledging {len(batch.messages)} messages failed"
+            )
+        self._count("batches")
+        self._count("messages", len(batch.messages))
+        self._count("points", written.points)
+        self._count("rollup_points", rollup_points)
+        self.logger.debug(
+            f"Wrote {written.points} points from {len(batch.messages)} messages"
+        )
+
+
+def make_source():
+    """Create the source named by AGGREGATOR_SOURCE"""
+    name = os.environ.get("AGGREGATOR_SOURCE", "stdin")
+    if name == "stdin":
+        return JsonLinesSource()
+    if name == "mqtt":
+        return MqttSource(
+            os.environ.get("MQTT_HOST", "localhost"),
+            int(os.environ.get("MQTT_PORT", 1883)),
+            os.environ.get("MQTT_TOPIC", "#"),
+            int(os.environ.get("MQTT_QOS", 1)),
+        )
+    if name == "pubsub":
+        return PubSubPullSource(os.environ["PUBSUB_SUBSCRIPTION"])
+    raise ValueError(f"Unknown source {name!r}, expected stdin, mqtt or pubsub")
+
+
+def main():
+    logging.basicConfig(level=os.environ.get("AGGREGATOR_LOG_LEVEL", "INFO"))
+
+    latest = None
+    server = None
+    latest_port = os.environ.get("AGGREGATOR_LATEST_PORT")
+    latest_path = os.environ.get("AGGREGATOR_LATEST_PATH")
+    if latest_port or latest_path:
+        latest = LatestValues(
+            latest_path,
+            float(os.environ.get("AGGREGATOR_LATEST_SAVE_SECONDS", 5.0)),
+        )
+    if latest_port:
+        server = LatestValuesServer(
+            latest,
+            os.environ.get("AGGREGATOR_LATEST_HOST", "127.0.0.1"),
+            int(latest_port),
+        )
+        server.start()
+
+    service = AggregatorService(
+        make_source(),
+        workers=int(os.environ.get("AGGREGATOR_WORKERS", os.cpu_count() or 1)),
+        pull_messages=int(os.environ.get("AGGREGATOR_PULL_MESSAGES", 100)),
+        batch_points=int(os.environ.get("AGGREGATOR_BATCH_POINTS", batch_size)),
+        batch_seconds=float(os.environ.get("AGGREGATOR_BATCH_SECONDS", 1.0)),
+        latest=latest,
+        rollups=make_rollups(),
+        stats_seconds=float(os.environ.get("AGGREGATOR_STATS_SECONDS", 60)),
+    )
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: service.stop())
+
+    service.run()
+    if server is not None:
+        server.stop()
+    logging.getLogger(__name__).info(f"Stopped: {service.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Sources of messages for the long-running aggregator, see service.py
+
+A source's pull() returns the next messages, waiting up to `timeout` seconds for at
+least one, and None once there will be no more. Messages are acknowledged, or handed
+back for redelivery, in bulk once their batch was written (or failed to be).
+"""
+
+import base64
+import logging
+import os
+import queue
+import sys
+from typing import List, NamedTuple, Optional, TextIO
+
+import requests
+
+
+class Message(NamedTuple):
+    data: bytes
+    # Identifies the message to the source when acknowledging it
+    ack_id: Optional[str] = None
+
+
+class JsonLinesSource:
+    """Read one payload (a point, a list of points or a batch) per line, e.g. from stdin"""
+
+    def __init__(self, stream: TextIO = sys.stdin):
+        self.stream = stream
+
+    def pull(self, max_messages: int, timeout: float) -> Optional[List[Message]]:
+        messages = []
+        while len(messages) < max_messages:
+            line = self.stream.readline()
+            if not line:
+                return messages or None
+            line = line.strip()
+            if line:
+                messages.append(Message(line.encode("utf-8")))
+        return messages
+
+    def ack(self, messages: List[Message]):
+        pass
+
+    def nack(self, messages: List[Message]):
+        pass
+
+    def close(self):
+        pass
+
+
+class MqttSource:
+    """Subscribe to a topic on an MQTT broker, e.g. a local one the collectors publish to
+
+    paho acknowledges QoS 1 messages as soon as they are received, so messages in
+    flight when the service stops are lost rather than redelivered.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 1883,
+        topic: str = "#",
+        qos: int = 1,
+        client_id: str = "",
+    ):
+        # Deferred, paho is only needed by this source
+        import paho.mqtt.client as mqtt
+
+        self.logger = logging.getLogger(__name__)
+        self.topic = topic
+        self.qos = qos
+        self._queue: "queue.Queue[Message]" = queue.Queue()
+
+        self.client = mqtt.Client(client_id=client_id)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.logger.info(f"Connected to MQTT broker, rc = {rc}")
+        # Subscribed on every connect, the session is not kept by the broker
+        client.subscribe(self.topic, self.qos)
+
+    def _on_message(self, client, userdata, message):
+        self._queue.put(Message(message.payload))
+
+    def pull(self, max_messages: int, timeout: float) -> Optional[List[Message]]:
+        try:
+            messages = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(messages) < max_messages:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def ack(self, messages: List[Message]):
+        pass
+
+    def nack(self, messages: List[Message]):
+        pass
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class PubSubPullSource:
+    """Pull from a Pub/Sub subscription over its REST API
+
+    `subscription` is "projects/<project>/subscriptions/<name>". When
+    PUBSUB_EMULATOR_HOST is set (as for the Pub/Sub emulator, or any compatible
+    stand-in), requests go there without authentication. Otherwise they go to Google
+    with the application default credentials, which needs the google-auth package.
+    """
+
+    SCOPES = ["https://www.googleapis.com/auth/pubsub"]
+    # Ack IDs per acknowledge or modifyAckDeadline request, well within Pub/Sub's
+    # limits on the number of IDs and the size of a request
+    MAX_ACK_IDS = 1000
+
+    def __init__(
+        self,
+        subscription: str,
+        endpoint: Optional[str] = None,
+        session: Optional[requests.Session] = None,
+    ):
+        self.logger = logging.getLogger(__name__)
+        emulator_host = os.environ.get("PUBSUB_EMULATOR_HOST")
+        if endpoint is None:
+            if emulator_host:
+                endpoint = f"http://{emulator_host}"
+            else:
+                endpoint = "https://pubsub.googleapis.com"
+        self.url = f"{endpoint}/v1/{subscription}"
+
+        if session is None:
+            if emulator_host:
+                session = requests.Session()
+            else:
+                # Deferred, only needed outside of the emulator
+                import google.auth
+                from google.auth.transport.requests import AuthorizedSession
+
+                credentials, _ = google.auth.default(scopes=self.SCOPES)
+                session = AuthorizedSession(credentials)
+        self.session = session
+
+    def _post(self, action: str, body: dict, timeout: float) -> dict:
+        response = self.session.post(f"{self.url}:{action}", json=body, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def pull(self, max_messages: int, timeout: float) -> Optional[List[Message]]:
+        # The server holds the request until messages arrive or its own deadline
+        # passes, the client timeout only guards against a stuck connection
+        response = self._post("pull", {"maxMessages": max_messages}, timeout + 60)
+        return [
+            Message(
+                base64.b64decode(received["message"].get("data", "")),
+                received["ackId"],
+            )
+            for received in response.get("receivedMessages", [])
+        ]
+
+    def _post_ack_ids(self, action: str, messages: List[Message], body: dict):
+        """Post the messages' ack IDs in requests of at most MAX_ACK_IDS
+
+        A failed request doesn't stop the others, so only its messages are
+        redelivered. The first error is raised once all were sent.
+        """
+        error = None
+        for start in range(0, len(messages), self.MAX_ACK_IDS):
+            ack_ids = [m.ack_id for m in messages[start : start + self.MAX_ACK_IDS]]
+            try:
+                self._post(action, {**body, "ackIds": ack_ids}, timeout=60)
+            except requests.exceptions.RequestException as e:
+                self.logger.warning(f"{action} of {len(ack_ids)} messages failed: {e}")
+                error = error or e
+        if error is not None:
+            raise error
+
+    def ack(self, messages: List[Message]):
+        self._post_ack_ids("acknowledge", messages, {})
+
+    def nack(self, messages: List[Message]):
+        """Make the messages available for redelivery right away"""
+        self._post_ack_ids("modifyAckDeadline", messages, {"ackDeadlineSeconds": 0})
+
+    def close(self):
+        self.session.close()
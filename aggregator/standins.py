@@ -0,0 +1,416 @@
+"""Local stand-ins for InfluxDB and Pub/Sub, to run the service without either
+
+InfluxStandIn accepts line protocol writes (and pings) the way InfluxDB 1.x does and
+keeps the lines it received. Like InfluxDB, it rejects the lines whose fields conflict
+with the types already written and merges points of the same series and time. It
+answers SHOW FIELD KEYS and selecting a measurement's points over a time range. PubSubStandIn implements the REST calls that
+sources.PubSubPullSource makes, for a single subscription, plus publishing to it.
+Point INFLUXDB_HOST/INFLUXDB_PORT and PUBSUB_EMULATOR_HOST at them.
+"""
+
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+class _StandIn:
+    def __init__(self, handler, host: str, port: int):
+        self.logger = logging.getLogger(__name__)
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server.server_address[:2]
+
+    def start(self):
+        self.logger.info(f"{type(self).__name__} listening on {self.address}")
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name=type(self).__name__, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    extra_headers: Dict[str, str] = {}
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def reply(self, status: int, body: bytes = b"", content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in self.extra_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The measurement and tags of a line, then the space before its fields
+_SERIES = re.compile(r"((?:[^,\s\\]|\\.)+)((?:,(?:[^\s\\]|\\.)+)?) ")
+# A tag and the separator before it
+_TAG = re.compile(r",((?:[^,=\\]|\\.)+)=((?:[^,\\]|\\.)+)")
+# A field and the separator after it
+_FIELD = re.compile(r'((?:[^,=\s\\]|\\.)+)=("(?:[^"\\]|\\.)*"|[^,\s]+)(,?)')
+_ESCAPED = re.compile(r"\\(.)")
+
+# Nanoseconds per unit of each precision a write may have
+_PRECISIONS = {
+    "ns": 1,
+    "n": 1,
+    "u": 10**3,
+    "ms": 10**6,
+    "s": 10**9,
+    "m": 60 * 10**9,
+    "h": 3600 * 10**9,
+}
+# The only SELECT statement the stand-in answers
+_SELECT = re.compile(
+    r'SELECT \* FROM "?([^"\s]+)"? WHERE time >= (\d+)s AND time < (\d+)s GROUP BY \*$',
+    re.IGNORECASE,
+)
+
+_BOOLEANS = {
+    **dict.fromkeys(("t", "T", "true", "True", "TRUE"), True),
+    **dict.fromkeys(("f", "F", "false", "False", "FALSE"), False),
+}
+
+
+def _unescape(text: str) -> str:
+    return _ESCAPED.sub(r"\1", text) if "\\" in text else text
+
+
+def _field_value(text: str) -> Tuple[str, object]:
+    """Get the type (as named by InfluxDB) and value of a field"""
+    if text.startswith('"'):
+        return "string", _unescape(text[1:-1])
+    if text in _BOOLEANS:
+        return "boolean", _BOOLEANS[text]
+    if text.endswith("i"):
+        return "integer", int(text[:-1])
+    return "float", float(text)
+
+
+class ParsedLine(NamedTuple):
+    measurement: str
+    tags: Tuple[Tuple[str, str], ...]
+    # Field -> (type, value)
+    fields: Dict[str, Tuple[str, object]]
+    # In the precision it was written with
+    time: Optional[int]
+
+
+def parse_line(line: str) -> ParsedLine:
+    series = _SERIES.match(line)
+    if series is None:
+        raise ValueError("missing measurement")
+    tags = tuple(
+        (_unescape(key), _unescape(value))
+        for key, value in _TAG.findall(series.group(2))
+    )
+    fields = {}
+    position = series.end()
+    while True:
+        field = _FIELD.match(line, position)
+        if field is None:
+            raise ValueError("invalid field")
+        fields[_unescape(field.group(1))] = _field_value(field.group(2))
+        position = field.end()
+        if not field.group(3):
+            break
+    rest = line[position:].strip()
+    return ParsedLine(
+        _unescape(series.group(1)), tags, fields, int(rest) if rest else None
+    )
+
+
+class InfluxStandIn(_StandIn):
+    """Accept writes on /write, queries on /query and pings on /ping
+
+    `port` 0 picks a free one. fail_writes() makes the next writes fail, e.g. with
+    503 Service Unavailable.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        stand_in = self
+        self._lock = threading.Lock()
+        # (database, precision, line) of every point written
+        self.lines: List[Tuple[str, str, str]] = []
+        # database -> {(measurement, field): type as named by InfluxDB}
+        self.field_types: Dict[str, Dict[Tuple[str, str], str]] = {}
+        # database -> {(measurement, tags, time in ns): fields}, merged like InfluxDB
+        self.points: Dict[str, Dict[tuple, Dict[str, object]]] = {}
+        self.stats: Dict[str, int] = {"writes": 0, "points": 0, "rejected": 0}
+        self._failures: List[int] = []
+
+        class Handler(_Handler):
+            extra_headers = {"X-Influxdb-Version": "1.8.10"}
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == "/ping":
+                    self.reply(204)
+                elif url.path == "/query":
+                    self.query(parse_qs(url.query))
+                else:
+                    self.reply(404)
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                body = self.read_body()
+                query = parse_qs(url.query)
+                if url.path == "/query":
+                    query.update(parse_qs(body.decode("utf-8")))
+                    self.query(query)
+                elif url.path == "/write":
+                    lines = [line for line in body.decode("utf-8").split("\n") if line]
+                    status, error = stand_in._write(
+                        query.get("db", [""])[0],
+                        query.get("precision", ["ns"])[0],
+                        lines,
+                    )
+                    if error:
+                        self.reply(status, json.dumps({"error": error}).encode("utf-8"))
+                    else:
+                        self.reply(status)
+                else:
+                    self.reply(404)
+
+            def query(self, query: Dict[str, List[str]]):
+                result = stand_in._query(
+                    query.get("q", [""])[0],
+                    query.get("db", [""])[0],
+                    query.get("epoch", ["ns"])[0],
+                )
+                self.reply(200, json.dumps({"results": [result]}).encode("utf-8"))
+
+        super().__init__(Handler, host, port)
+
+    def fail_writes(self, count: int, status: int = 503):
+        """Answer the next `count` writes with `status` without writing anything"""
+        with self._lock:
+            self._failures += [status] * count
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+    def _write(
+        self, database: str, precision: str, lines: List[str]
+    ) -> Tuple[int, Optional[str]]:
+        with self._lock:
+            if self._failures:
+                status = self._failures.pop(0)
+                return status, f"injected failure {status}"
+
+            self.stats["writes"] += 1
+            types = self.field_types.setdefault(database, {})
+            points = self.points.setdefault(database, {})
+            errors = []
+            for line in lines:
+                try:
+                    parsed = parse_line(line)
+                except ValueError as e:
+                    errors.append(f"unable to parse '{line}': {e}")
+                    continue
+                measurement = parsed.measurement
+                conflict = next(
+                    (
+                        (name, line_type, types[measurement, name])
+                        for name, (line_type, _) in parsed.fields.items()
+                        if types.get((measurement, name), line_type) != line_type
+                    ),
+                    None,
+                )
+                if conflict:
+                    errors.append(
+                        'partial write: field type conflict: input field "%s" on measurement "%s" is type %s, already exists as type %s'
+                        % (conflict[0], measurement, conflict[1], conflict[2])
+                    )
+                    continue
+                for name, (line_type, _) in parsed.fields.items():
+                    types[measurement, name] = line_type
+                if parsed.time is None:
+                    ns = time.time_ns()
+                else:
+                    ns = parsed.time * _PRECISIONS[precision]
+                points.setdefault((measurement, parsed.tags, ns), {}).update(
+                    (name, value) for name, (_, value) in parsed.fields.items()
+                )
+                self.lines.append((database, precision, line))
+                self.stats["points"] += 1
+
+            if errors:
+                self.stats["rejected"] += len(errors)
+                return 400, f"{errors[0]} dropped={len(errors)}"
+            return 204, None
+
+    def _query(self, statement: str, database: str, epoch: str) -> dict:
+        """Answer SHOW FIELD KEYS, and selecting every series of a measurement by time"""
+        result: dict = {"statement_id": 0}
+        select = _SELECT.match(statement.strip())
+        if select:
+            result["series"] = self._select(
+                database,
+                select.group(1),
+                int(select.group(2)) * 10**9,
+                int(select.group(3)) * 10**9,
+                _PRECISIONS.get(epoch, 1),
+            )
+        elif statement.strip().upper() == "SHOW FIELD KEYS":
+            with self._lock:
+                measurements: Dict[str, list] = {}
+                for (measurement, name), field_type in sorted(
+                    self.field_types.get(database, {}).items()
+                ):
+                    measurements.setdefault(measurement, []).append([name, field_type])
+            result["series"] = [
+                {"name": name, "columns": ["fieldKey", "fieldType"], "values": values}
+                for name, values in measurements.items()
+            ]
+        return result
+
+    def _select(
+        self, database: str, measurement: str, start: int, end: int, divisor: int
+    ) -> List[dict]:
+        series: Dict[tuple, List[Tuple[int, Dict[str, object]]]] = {}
+        with self._lock:
+            for (name, tags, ns), fields in self.points.get(database, {}).items():
+                if name == measurement and start <= ns < end:
+                    series.setdefault(tags, []).append((ns, dict(fields)))
+        results = []
+        for tags, rows in sorted(series.items()):
+            columns = sorted({name for _, fields in rows for name in fields})
+            results.append(
+                {
+                    "name": measurement,
+                    "tags": dict(tags),
+                    "columns": ["time"] + columns,
+                    "values": [
+                        [ns // divisor] + [fields.get(name) for name in columns]
+                        for ns, fields in sorted(rows, key=lambda row: row[0])
+                    ],
+                }
+            )
+        return results
+
+
+class PubSubStandIn(_StandIn):
+    """Serve one subscription's pull, acknowledge and modifyAckDeadline calls
+
+    Messages are published with publish(). A pulled message is leased for
+    `ack_deadline` seconds and delivered again if it is not acknowledged by then.
+    """
+
+    def __init__(
+        self, host: str = "127.0.0.1", port: int = 0, ack_deadline: float = 10.0
+    ):
+        stand_in = self
+        self.ack_deadline = ack_deadline
+        self._lock = threading.Condition()
+        self._ids = itertools.count(1)
+        # ack id -> (data, time its lease expires, 0 when not leased)
+        self._messages: Dict[str, Tuple[bytes, float]] = {}
+        self.stats: Dict[str, int] = {
+            "published": 0,
+            "delivered": 0,
+            "acknowledged": 0,
+            "nacked": 0,
+        }
+
+        class Handler(_Handler):
+            def do_POST(self):
+                action = urlsplit(self.path).path.rpartition(":")[2]
+                body = json.loads(self.read_body() or b"{}")
+                if action == "pull":
+                    response = stand_in._pull(body.get("maxMessages", 100))
+                elif action == "acknowledge":
+                    response = stand_in._acknowledge(body["ackIds"])
+                elif action == "modifyAckDeadline":
+                    response = stand_in._modify(
+                        body["ackIds"], body["ackDeadlineSeconds"]
+                    )
+                else:
+                    self.reply(404)
+                    return
+                self.reply(200, json.dumps(response).encode("utf-8"))
+
+        super().__init__(Handler, host, port)
+
+    def publish(self, data: bytes):
+        with self._lock:
+            self._messages[str(next(self._ids))] = (data, 0.0)
+            self.stats["published"] += 1
+            self._lock.notify_all()
+
+    def pending(self) -> int:
+        """Messages that were not acknowledged yet"""
+        with self._lock:
+            return len(self._messages)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+    def _pull(self, max_messages: int, wait: float = 1.0) -> dict:
+        deadline = time.monotonic() + wait
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                available = [
+                    ack_id
+                    for ack_id, (_, leased_until) in self._messages.items()
+                    if leased_until <= now
+                ][:max_messages]
+                if available or now >= deadline:
+                    break
+                self._lock.wait(min(0.05, deadline - now))
+
+            received = []
+            for ack_id in available:
+                data, _ = self._messages[ack_id]
+                self._messages[ack_id] = (data, now + self.ack_deadline)
+                received.append(
+                    {
+                        "ackId": ack_id,
+                        "message": {"data": base64.b64encode(data).decode("ascii")},
+                    }
+                )
+            self.stats["delivered"] += len(received)
+        return {"receivedMessages": received} if received else {}
+
+    def _acknowledge(self, ack_ids: List[str]) -> dict:
+        with self._lock:
+            for ack_id in ack_ids:
+                if self._messages.pop(ack_id, None) is not None:
+                    self.stats["acknowledged"] += 1
+        return {}
+
+    def _modify(self, ack_ids: List[str], seconds: float) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            for ack_id in ack_ids:
+                if ack_id in self._messages:
+                    data, _ = self._messages[ack_id]
+                    self._messages[ack_id] = (data, now + seconds)
+                    if seconds == 0:
+                        self.stats["nacked"] += 1
+            self._lock.notify_all()
+        return {}
@@ -0,0 +1,101 @@
+"""Round trips between the collector's encoder and this decoder
+
+The compact format is written by collectors/machinon/encoding.py and read by
+compact.py, which each keep their own copy of its constants and layout.
+"""
+
+import importlib.util
+import json
+import os
+
+import compact
+
+ENCODING_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "collectors", "machinon", "encoding.py"
+)
+_spec = importlib.util.spec_from_file_location("collector_encoding", ENCODING_PATH)
+encoding = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(encoding)
+
+MULTIPLIERS = {"battery_voltage": 100, "battery_current": 100, "pv_power": 100}
+
+
+def collection(time, fields, measurement="solar_controller", unit="1"):
+    return {
+        "measurement": measurement,
+        "tags": {"type": "epsolar_tracer", "unit": unit},
+        "time": time,
+        "fields": fields,
+    }
+
+
+def decode(payload):
+    if compact.is_compact(payload):
+        return compact.decode_compact(payload)
+    return json.loads(payload)
+
+
+def round_trip(collections):
+    encode = encoding.get_encoder("compact", MULTIPLIERS)
+    payload = encode([json.dumps(c) for c in collections])
+    return payload, decode(payload)
+
+
+def ordered(points):
+    return sorted(
+        points, key=lambda p: (p["measurement"], p["tags"]["unit"], p["time"])
+    )
+
+
+def test_constants_agree():
+    assert encoding.MAGIC == compact.MAGIC
+    assert encoding.VERSION in compact.SUPPORTED_VERSIONS
+    for kind in ("STRING", "FLOAT", "SCALED", "INTEGER", "BOOLEAN"):
+        assert getattr(encoding, f"KIND_{kind}") == getattr(compact, f"KIND_{kind}")
+
+
+def test_mixed_measurements_sparse_fields_and_negative_scaled_values():
+    collections = [
+        collection(
+            "2019-05-03T23:25:43.511Z",
+            {
+                "battery_voltage": 13.21,
+                "battery_current": -2.5,
+                "pv_power": 52.68,
+                "charging_mode": "MPPT",
+                "load_on": True,
+            },
+        ),
+        # Sparse: only the fields that changed
+        collection("2019-05-03T23:26:43.511Z", {"battery_current": -0.01}),
+        collection(
+            "2019-05-03T23:26:44.000Z",
+            {"battery_voltage": 12.9, "charging_mode": "Float", "load_on": False},
+            unit="2",
+        ),
+        collection(
+            "2019-05-03T23:25:00.000Z",
+            {"collect_seconds": 0.123456789, "collections": 42, "resets": -1},
+            measurement="collector_stats",
+        ),
+        # Earlier than the previous row of its block
+        collection("2019-05-03T23:20:43.511Z", {"battery_current": -327.68}),
+    ]
+    payload, points = round_trip(collections)
+    assert compact.is_compact(payload)
+    assert ordered(points) == ordered(collections)
+    for point in points:
+        for name in MULTIPLIERS:
+            if name in point["fields"]:
+                assert type(point["fields"][name]) is float
+
+
+def test_collections_that_cant_be_compact_fall_back_to_json():
+    collections = [
+        collection("2019-05-03T23:25:43.511Z", {"battery_voltage": 13.21}),
+        # Mixed value types for a field
+        collection("2019-05-03T23:26:43.511Z", {"battery_voltage": "n/a"}),
+    ]
+    payload, points = round_trip(collections)
+    assert not compact.is_compact(payload)
+    assert points == collections
@@ -0,0 +1,83 @@
+import math
+
+import pytest
+
+from validation import InvalidPoint, coerce_point, make_valid_lines
+
+
+def point(fields, time=1556925943, measurement="solar_controller"):
+    return {"measurement": measurement, "time": time, "fields": fields}
+
+
+def test_numbers_are_coerced_to_the_stored_type():
+    types = {("solar_controller", "a"): float, ("solar_controller", "b"): int}
+    coerced = coerce_point(point({"a": 1, "b": 2.0, "c": "x"}), types)
+    assert coerced["fields"] == {"a": 1.0, "b": 2, "c": "x"}
+    assert type(coerced["fields"]["a"]) is float
+    assert type(coerced["fields"]["b"]) is int
+
+
+def test_new_types_are_collected_apart():
+    types = {}
+    new_types = {}
+    coerce_point(point({"a": 1, "b": True}), types, new_types)
+    assert types == {}
+    assert new_types == {
+        ("solar_controller", "a"): int,
+        ("solar_controller", "b"): bool,
+    }
+
+
+@pytest.mark.parametrize(
+    "fields, reason",
+    [
+        ({"a": math.nan}, "Field a is nan"),
+        ({"a": math.inf}, "Field a is inf"),
+        ({"a": [1]}, "Field a is a list"),
+        ({"a": None, "b": ""}, "No fields"),
+        ({"x": 1.5}, "Field x is a float, stored as int"),
+        ({"s": 1}, "Field s is a int, stored as str"),
+    ],
+)
+def test_invalid_points_are_rejected(fields, reason):
+    types = {("solar_controller", "x"): int, ("solar_controller", "s"): str}
+    with pytest.raises(InvalidPoint, match=reason):
+        coerce_point(point(fields), types)
+
+
+def test_missing_measurement_is_rejected():
+    with pytest.raises(InvalidPoint, match="Missing measurement"):
+        coerce_point(point({"a": 1}, measurement=""), {})
+
+
+def test_rejected_points_dont_fix_field_types():
+    types = {}
+    lines, rejected = make_valid_lines(
+        [
+            point({"a": 1, "b": math.nan}),
+            point({"c": 1}, time="not a time"),
+            point({"a": 1.5, "c": 2.5}),
+        ],
+        "s",
+        types,
+    )
+    assert [item.data["fields"] for item in rejected] == [
+        {"a": 1, "b": math.nan},
+        {"c": 1},
+    ]
+    assert lines == ["solar_controller a=1.5,c=2.5 1556925943"]
+    assert types == {
+        ("solar_controller", "a"): float,
+        ("solar_controller", "c"): float,
+    }
+
+
+def test_types_learned_from_a_point_apply_to_the_next():
+    lines, rejected = make_valid_lines(
+        [point({"a": 1.5}), point({"a": 2}), point({"a": "x"})], "s", {}
+    )
+    assert lines == [
+        "solar_controller a=1.5 1556925943",
+        "solar_controller a=2.0 1556925943",
+    ]
+    assert [item.reason for item in rejected] == ["Field a is a str, stored as float"]
@@ -0,0 +1,140 @@
+"""Check and coerce points before they are written
+
+A point InfluxDB would reject makes it fail the whole request, so points are checked
+while they are serialized and the bad ones are set aside with the reason. Integer and
+float values are coerced to the type their field already has in the database: the
+collector sends every register value as a float, and a later integer value (or the
+reverse) would otherwise be a field type conflict.
+"""
+
+import logging
+import math
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from line_protocol import make_line
+
+# (measurement, field key) -> type of the field's values
+FieldTypeMap = Dict[Tuple[str, str], type]
+
+# Field types as reported by SHOW FIELD KEYS
+INFLUX_FIELD_TYPES = {"float": float, "integer": int, "string": str, "boolean": bool}
+
+
+class InvalidPoint(ValueError):
+    pass
+
+
+class Rejected(NamedTuple):
+    """A point (or its line, if InfluxDB rejected it) that was not written
+
+    The service also sets aside the payloads of messages it could not decode.
+    """
+
+    data: Any
+    reason: str
+
+
+class FieldTypes:
+    """The type of every field by database, loaded once per database and then learned
+
+    `load_fn(database)` returns the types already stored in a database.
+    """
+
+    def __init__(self, load_fn: Optional[Callable[[Optional[str]], FieldTypeMap]]):
+        self.logger = logging.getLogger(__name__)
+        self.load_fn = load_fn
+        self._databases: Dict[Optional[str], FieldTypeMap] = {}
+
+    def for_database(self, database: Optional[str]) -> FieldTypeMap:
+        types = self._databases.get(database)
+        if types is None:
+            types = {}
+            if self.load_fn is not None:
+                try:
+                    types = self.load_fn(database)
+                except Exception as e:
+                    # Types are then only learned from the points themselves
+                    self.logger.warning(f"Loading the field types failed: {e!r}")
+            self._databases[database] = types
+        return types
+
+
+def coerce_point(
+    point: dict, types: FieldTypeMap, new_types: Optional[FieldTypeMap] = None
+) -> dict:
+    """Get the point with its numbers coerced to their fields' types
+
+    The types of fields not in `types` yet are added to `new_types`, to be learned
+    once the point was accepted. Raises InvalidPoint for anything InfluxDB would
+    reject.
+    """
+    measurement = point["measurement"]
+    if type(measurement) is not str or not measurement:
+        raise InvalidPoint("Missing measurement")
+
+    fields = point["fields"]
+    coerced = None
+    written = 0
+    for key, value in fields.items():
+        value_type = type(value)
+        if value is None or value == "":
+            # Left out by make_line
+            continue
+        if value_type is float:
+            if not math.isfinite(value):
+                raise InvalidPoint(f"Field {key} is {value}")
+        elif value_type not in (int, str, bool):
+            raise InvalidPoint(f"Field {key} is a {value_type.__name__}")
+        written += 1
+
+        expected = types.get((measurement, key))
+        if expected is None:
+            if new_types is not None:
+                new_types[(measurement, key)] = value_type
+            continue
+        if expected is value_type:
+            continue
+        if expected is float and value_type is int:
+            value = float(value)
+        elif expected is int and value_type is float and value.is_integer():
+            value = int(value)
+        else:
+            raise InvalidPoint(
+                f"Field {key} is a {value_type.__name__}, stored as {expected.__name__}"
+            )
+        if coerced is None:
+            coerced = dict(fields)
+        coerced[key] = value
+
+    if not written:
+        raise InvalidPoint("No fields")
+    if coerced is not None:
+        point = {**point, "fields": coerced}
+    return point
+
+
+def make_valid_lines(
+    points: Iterable[dict], precision: Optional[str], types: FieldTypeMap
+) -> Tuple[List[str], List[Rejected]]:
+    """Serialize the valid points, setting the others aside
+
+    The types of the fields of valid points are learned into `types`.
+    """
+    lines = []
+    rejected = []
+    for point in points:
+        new_types: FieldTypeMap = {}
+        try:
+            lines.append(make_line(coerce_point(point, types, new_types), precision))
+        except (
+            InvalidPoint,
+            AttributeError,
+            KeyError,
+            OverflowError,
+            TypeError,
+            ValueError,
+        ) as e:
+            rejected.append(Rejected(point, str(e) or repr(e)))
+            continue
+        types.update(new_types)
+    return lines, rejected
@@ -0,0 +1,252 @@
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+import paho.mqtt.client as mqtt
+
+from encoding import encode_json
+
+
+class MemoryStore:
+    """Keep collections waiting to be published in memory
+
+    Collections are taken in the order they were added and only removed once their
+    delivery is confirmed. They are lost if the collector restarts.
+    """
+
+    def __init__(self, max_collections: int = 10000):
+        self.logger = logging.getLogger(__name__)
+        self.max_collections = max_collections
+
+        self._lock = threading.Lock()
+        self._next_key = 0
+        # key -> (created, payload), kept in insertion order
+        self._pending: Dict[int, Tuple[float, str]] = OrderedDict()
+        self._taken: Dict[int, Tuple[float, str]] = {}
+        self.pending_bytes = 0
+
+    def __len__(self):
+        return len(self._pending) + len(self._taken)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def oldest_pending_time(self):
+        with self._lock:
+            for created, _ in self._pending.values():
+                return created
+
+    def append(self, payload: str):
+        with self._lock:
+            self._pending[self._next_key] = (time.time(), payload)
+            self._next_key += 1
+            self.pending_bytes += len(payload)
+
+            while len(self._pending) + len(self._taken) > self.max_collections:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        if self._taken:
+            del self._taken[min(self._taken)]
+        else:
+            _, (_, payload) = self._pending.popitem(last=False)
+            self.pending_bytes -= len(payload)
+        self.logger.warning("Store is full, dropped the oldest collection")
+
+    def take(self, max_count: int, max_bytes: int) -> List[Tuple[int, str]]:
+        """Take the oldest pending collections, they are not returned again unless released"""
+        taken = []
+        size = 0
+        with self._lock:
+            for key, (_, payload) in self._pending.items():
+                if len(taken) >= max_count or (
+                    taken and size + len(payload) > max_bytes
+                ):
+                    break
+                taken.append((key, payload))
+                size += len(payload)
+
+            for key, _ in taken:
+                self._taken[key] = self._pending.pop(key)
+            self.pending_bytes -= size
+
+        return taken
+
+    def release(self, keys: Iterable[int]):
+        """Make taken collections pending again, e.g. when publishing them failed"""
+        with self._lock:
+            for key in keys:
+                if key in self._taken:
+                    self._pending[key] = self._taken.pop(key)
+                    self.pending_bytes += len(self._pending[key][1])
+            # Keep pending collections in the order they were added
+            self._pending = OrderedDict(sorted(self._pending.items()))
+
+    def remove(self, keys: Iterable[int]):
+        with self._lock:
+            for key in keys:
+                self._taken.pop(key, None)
+
+    def close(self):
+        pass
+
+
+class CollectionBatcher:
+    """Publish stored collections together in one message
+
+    Collections are stored serialized as JSON, `encode_fn` turns a list of them into
+    a payload, by default a JSON array.
+
+    Every collection is stored first. While connected, stored collections are
+    published once `max_collections` are waiting, the oldest has waited `max_seconds`,
+    or they add up to `max_bytes`, which also caps the size of a message. Collections
+    stay in the store until the broker acknowledges their message. Anything stored
+    while disconnected is drained in larger messages of up to `drain_collections` once
+    the connection is back, at most `drain_rate` messages per second.
+    """
+
+    def __init__(
+        self,
+        publish_fn: Callable[[str], mqtt.MQTTMessageInfo],
+        store=None,
+        encode_fn: Callable[[List[str]], Union[str, bytes]] = encode_json,
+        max_collections: int = 1,
+        max_seconds: float = 300,
+        max_bytes: int = 200000,
+        drain_collections: int = 100,
+        drain_rate: float = 2,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.publish_fn = publish_fn
+        self.store = store if store is not None else MemoryStore()
+        self.encode_fn = encode_fn
+        self.max_collections = max_collections
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.drain_collections = drain_collections
+        self.drain_rate = drain_rate
+
+        self.connected = False
+        self._publish_lock = threading.Lock()
+        self._drain_thread = None
+
+        # Messages waiting for a PUBACK, mid -> store keys. The acknowledgement can be
+        # handled before publish() returns, so early ones are kept until the mid is known.
+        self._ack_lock = threading.Lock()
+        self._inflight: Dict[int, List[int]] = {}
+        self._early_acks = set()
+
+        self.stats = {"published": 0, "acknowledged": 0, "publish_failures": 0}
+
+    def add(self, collection):
+        self.store.append(json.dumps(collection))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Publish the waiting collections in one message, if they are due
+
+        More than a message's worth, e.g. what was stored while disconnected, is left
+        to the drain, which publishes it in larger messages at a limited rate.
+        """
+        if not self.connected or self._draining() or not self._due():
+            return
+        if self.store.pending_count() > self.max_collections:
+            self.start_drain()
+        else:
+            self._publish_next(self.max_collections)
+
+    def _draining(self) -> bool:
+        return self._drain_thread is not None and self._drain_thread.is_alive()
+
+    def flush(self):
+        """Publish everything that is stored, returning the info of the last message"""
+        message = None
+        while self.store.pending_count():
+            message = self._publish_next(self.max_collections)
+            if message is None:
+                break
+        return message
+
+    def _due(self) -> bool:
+        oldest = self.store.oldest_pending_time()
+        return oldest is not None and (
+            self.store.pending_count() >= self.max_collections
+            or self.store.pending_bytes >= self.max_bytes
+            or time.time() - oldest >= self.max_seconds
+        )
+
+    def _publish_next(self, max_count: int):
+        with self._publish_lock:
+            taken = self.store.take(max_count, self.max_bytes)
+            if not taken:
+                return None
+
+            keys = [key for key, _ in taken]
+            payload = self.encode_fn([payload for _, payload in taken])
+            self.logger.debug(f"Publishing {len(taken)} collection(s)")
+
+            message = self.publish_fn(payload)
+            if message.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                # Anything else means paho did not queue the message
+                self.logger.warning(f"Publish failed: {mqtt.error_string(message.rc)}")
+                self.stats["publish_failures"] += 1
+                self.store.release(keys)
+                return None
+            self.stats["published"] += 1
+
+        with self._ack_lock:
+            if message.mid in self._early_acks:
+                self._early_acks.discard(message.mid)
+                self.store.remove(keys)
+            else:
+                self._inflight[message.mid] = keys
+
+        return message
+
+    def published(self, mid: int):
+        """Called once the broker acknowledged a message"""
+        with self._ack_lock:
+            self.stats["acknowledged"] += 1
+            keys = self._inflight.pop(mid, None)
+            if keys is None:
+                self._early_acks.add(mid)
+                return
+        self.store.remove(keys)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get the publish counters, and how many messages and collections are waiting"""
+        with self._ack_lock:
+            inflight = len(self._inflight)
+        return {
+            **self.stats,
+            "inflight_messages": inflight,
+            "pending_collections": self.store.pending_count(),
+            "pending_bytes": self.store.pending_bytes,
+        }
+
+    def set_connected(self, connected: bool):
+        self.connected = connected
+
+    def start_drain(self):
+        """Publish everything stored while disconnected, in a background thread"""
+        self.connected = True
+        if self._draining():
+            return
+
+        self._drain_thread = threading.Thread(
+            target=self._drain, name="collection-drain", daemon=True
+        )
+        self._drain_thread.start()
+
+    def _drain(self):
+        if self.store.pending_count():
+            self.logger.info(f"Draining {self.store.pending_count()} collection(s)")
+
+        while self.connected and self.store.pending_count():
+            started = time.monotonic()
+            if self._publish_next(self.drain_collections) is None:
+                break
+            time.sleep(max(0, 1 / self.drain_rate - (time.monotonic() - started)))
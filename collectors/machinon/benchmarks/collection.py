@@ -0,0 +1,199 @@
+"""Run collection cycles against simulated controllers and report what they cost
+
+Every bus is a simulator on its own port with the given number of units. The first
+cycle also reads each device's identification and is reported on its own. With
+--mqtt, collections are published through a CollectionBatcher to a local MQTT
+stand-in. Run from the collectors/machinon directory:
+
+    python -m benchmarks.collection --buses 2 --units 3 --latency 0.01 --mqtt
+"""
+
+import argparse
+import datetime
+from functools import partial
+import time
+from typing import Dict, List
+
+import paho.mqtt.client as mqtt
+
+from batching import CollectionBatcher
+from encoding import get_encoder
+from epsolar_tracer.client import (
+    ModbusSettings,
+    close_shared_clients,
+    configure_shared_clients,
+)
+from epsolar_tracer.collector import (
+    FIELD_REGISTERS,
+    collect,
+    field_multipliers,
+    get_bus_stats,
+)
+from simulator.epsolar import Conditions, EpsolarDevice, Simulator
+from simulator.mqtt import MqttStandIn
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def total_stats(stats: List[Dict[str, float]]) -> Dict[str, float]:
+    totals: Dict[str, float] = {}
+    for fields in stats:
+        for name, value in fields.items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--buses", type=int, default=1)
+    parser.add_argument("--units", type=int, default=1, help="units per bus")
+    parser.add_argument("--cycles", type=int, default=50)
+    parser.add_argument("--framing", choices=("rtu", "tcp"), default="rtu")
+    parser.add_argument("--strict", action="store_true", help="reject gapped reads")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--baudrate", type=int)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--crc-error-rate", type=float, default=0.0)
+    parser.add_argument("--exception-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=ModbusSettings().timeout)
+    parser.add_argument("--retries", type=int, default=ModbusSettings().retries)
+    parser.add_argument("--deadline", type=float, help="cycle deadline in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--hour", type=float, default=12, help="simulated time of day")
+    parser.add_argument("--mqtt", action="store_true")
+    parser.add_argument("--encoding", choices=("json", "compact"), default="json")
+    parser.add_argument("--batch", type=int, default=1, help="collections per message")
+    args = parser.parse_args()
+
+    midnight = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    offset = midnight.timestamp() + args.hour * 3600 - time.time()
+    conditions = Conditions(
+        args.latency,
+        args.jitter,
+        args.baudrate,
+        args.timeout_rate,
+        args.crc_error_rate,
+        args.exception_rate,
+    )
+
+    configure_shared_clients(ModbusSettings(timeout=args.timeout, retries=args.retries))
+    simulators = [
+        Simulator(
+            {
+                unit: EpsolarDevice(
+                    strict=args.strict, clock=lambda: time.time() + offset
+                )
+                for unit in range(1, args.units + 1)
+            },
+            framing=args.framing,
+            conditions=conditions,
+            seed=args.seed + bus,
+        )
+        for bus in range(args.buses)
+    ]
+    for simulator in simulators:
+        simulator.start()
+    targets = [
+        (simulator.url, unit)
+        for simulator in simulators
+        for unit in range(1, args.units + 1)
+    ]
+
+    stand_in = mqtt_client = batcher = None
+    if args.mqtt:
+        stand_in = MqttStandIn()
+        stand_in.start()
+        mqtt_client = mqtt.Client(client_id="benchmark")
+        batcher = CollectionBatcher(
+            partial(mqtt_client.publish, "/devices/benchmark/events", qos=1),
+            encode_fn=get_encoder(args.encoding, field_multipliers(FIELD_REGISTERS)),
+            max_collections=args.batch,
+        )
+        mqtt_client.on_connect = lambda *_: batcher.start_drain()
+        mqtt_client.on_publish = lambda client, userdata, mid: batcher.published(mid)
+        mqtt_client.connect(*stand_in.address)
+        mqtt_client.loop_start()
+
+    def cycle():
+        started = time.perf_counter()
+        collections = collect(targets, deadline_seconds=args.deadline)
+        if batcher is not None:
+            for collection in collections:
+                batcher.add(collection)
+        return time.perf_counter() - started, len(collections)
+
+    try:
+        first_cycle, _ = cycle()
+        bus_before = total_stats([group["fields"] for group in get_bus_stats()])
+        wire_before = total_stats([s.get_stats() for s in simulators])
+
+        latencies = []
+        collected = 0
+        for _ in range(args.cycles):
+            seconds, count = cycle()
+            latencies.append(seconds)
+            collected += count
+
+        bus = total_stats([group["fields"] for group in get_bus_stats()])
+        wire = total_stats([s.get_stats() for s in simulators])
+
+        if batcher is not None:
+            batcher.flush()
+            deadline = time.monotonic() + 10
+            while (
+                batcher.get_stats()["pending_collections"]
+                and time.monotonic() < deadline
+            ):
+                time.sleep(0.01)
+    finally:
+        if mqtt_client is not None:
+            mqtt_client.disconnect()
+            mqtt_client.loop_stop()
+            stand_in.stop()
+        close_shared_clients()
+        for simulator in simulators:
+            simulator.stop()
+
+    cycles = args.cycles
+    print(f"{len(targets)} device(s) on {args.buses} bus(es), {cycles} cycles")
+    print(f"{'first cycle (ms)':<28}{first_cycle * 1000:>10.1f}")
+    for percent in (50, 90, 99, 100):
+        label = "max" if percent == 100 else f"p{percent}"
+        value = percentile(latencies, percent) * 1000
+        print(f"{f'cycle latency {label} (ms)':<28}{value:>10.1f}")
+    print(f"{'collections per cycle':<28}{collected / cycles:>10.2f}")
+    for name in (
+        "transactions",
+        "timeouts",
+        "retries",
+        "error_responses",
+        "block_fallbacks",
+        "deadline_skips",
+        "missing_values",
+    ):
+        value = (bus[name] - bus_before[name]) / cycles
+        print(f"{name + ' per cycle':<28}{value:>10.2f}")
+    for name, label in (("rx_bytes", "sent"), ("tx_bytes", "received")):
+        value = (wire[name] - wire_before[name]) / cycles
+        print(f"{'bytes ' + label + ' per cycle':<28}{value:>10.1f}")
+
+    if stand_in is not None:
+        mqtt_stats = stand_in.get_stats()
+        messages = mqtt_stats["messages"]
+        print(f"{'MQTT messages':<28}{messages:>10d}")
+        print(
+            f"{'MQTT bytes per message':<28}{mqtt_stats['payload_bytes'] / max(1, messages):>10.1f}"
+        )
+        print(
+            f"{'unacknowledged collections':<28}{batcher.get_stats()['pending_collections']:>10d}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Compare the block decoder with decoding each register of a block on its own
+
+Run from the collectors/machinon directory:
+
+    python -m benchmarks.decoding
+"""
+
+import random
+import time
+
+from epsolar_tracer.client import plan_block_reads
+from epsolar_tracer.collector import FIELD_REGISTERS
+from epsolar_tracer.registers import RealtimeStatus, StatisticalParameter
+
+
+def decode_individually(block, words):
+    return {
+        register: register.decode_registers(words[offset : offset + register.size])
+        for register, offset in zip(block.registers, block.offsets)
+    }
+
+
+def decode_block(block, words):
+    return block.decoder.decode(words)
+
+
+def blocks_per_second(fn, block, words, min_seconds: float = 0.5) -> float:
+    iterations = 0
+    started = time.perf_counter()
+    while True:
+        fn(block, words)
+        iterations += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return iterations / elapsed
+
+
+def main():
+    registers = [
+        *FIELD_REGISTERS.values(),
+        RealtimeStatus.ChargingEquipmentStatus,
+        *(
+            register
+            for register in vars(StatisticalParameter).values()
+            if hasattr(register, "decode_registers")
+        ),
+    ]
+    blocks = plan_block_reads(registers)
+
+    print(
+        f"{'block':>8} {'registers':>10} {'individual (/s)':>16} {'block (/s)':>12} {'speedup':>8}"
+    )
+    for block in sorted(blocks, key=lambda b: b.address):
+        words = [random.randrange(0x10000) for _ in range(block.size)]
+        assert {
+            register: (value.raw_value, value.value)
+            for register, value in decode_individually(block, words).items()
+        } == {
+            register: (value.raw_value, value.value)
+            for register, value in decode_block(block, words).items()
+        }
+
+        baseline = blocks_per_second(decode_individually, block, words)
+        optimized = blocks_per_second(decode_block, block, words)
+        print(
+            f"{block.address:>#8x} {len(block.registers):>10} {baseline:>16,.0f} {optimized:>12,.0f} {optimized / baseline:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Report the import time and memory footprint of the collector's modules
+
+Every module is imported in a fresh interpreter, so the numbers include everything
+it pulls in. Run from the collectors/machinon directory:
+
+    python -m benchmarks.startup
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+
+# Everything main.py needs before its first collection (config.py is not tracked)
+MODULES = (
+    "epsolar_tracer.registers",
+    "epsolar_tracer.collector",
+    "paho.mqtt.client",
+    "batching",
+    "deadband",
+    "encoding",
+    "runtime",
+    "spool",
+    "jwt",
+)
+STARTUP = "startup (all of the above)"
+
+RUNS = 5
+
+_MEASURE = """
+import json, resource, sys, time
+baseline_modules = len(sys.modules)
+started = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+if len(sys.argv) > 2:
+    from epsolar_tracer.collector import DEFAULT_FIELDS, resolve_fields
+    resolve_fields(DEFAULT_FIELDS)
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    "seconds": elapsed,
+    "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules) - baseline_modules,
+}))
+"""
+
+
+def measure(*modules: str) -> dict:
+    runs = [
+        json.loads(
+            subprocess.run(
+                [sys.executable, "-c", _MEASURE, *modules],
+                check=True,
+                stdout=subprocess.PIPE,
+            ).stdout
+        )
+        for _ in range(RUNS)
+    ]
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def main():
+    baseline = measure()
+    print(f"interpreter: {baseline['max_rss_kib'] / 1024:.1f} MiB max RSS")
+    print(f"{'module':<28} {'import (ms)':>12} {'max RSS (MiB)':>14} {'modules':>8}")
+    for name, result in [(name, measure(name)) for name in MODULES] + [
+        (STARTUP, measure(*MODULES))
+    ]:
+        print(
+            f"{name:<28} {result['seconds'] * 1000:>12.1f} {result['max_rss_kib'] / 1024:>14.1f} {result['modules']:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
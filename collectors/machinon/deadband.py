@@ -0,0 +1,74 @@
+import logging
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+class Deadband(NamedTuple):
+    """How far a field has to move before it is published again
+
+    A numeric field is published once it differs from the last published value by
+    more than `absolute`, or by more than `relative` times that value, whichever is
+    larger. Other fields are published whenever they change.
+    """
+
+    absolute: float = 0
+    relative: float = 0
+
+
+class DeadbandFilter:
+    """Drop fields from collections while they stay within their deadband
+
+    Every field is still published at least every `heartbeat_seconds`, so the full
+    series can be rebuilt by carrying the last value forward, e.g. with fill(previous)
+    in InfluxQL. Fields without a deadband are always published.
+    """
+
+    def __init__(self, deadbands: Dict[str, Deadband], heartbeat_seconds: float = 900):
+        self.logger = logging.getLogger(__name__)
+        self.deadbands = deadbands
+        self.heartbeat_seconds = heartbeat_seconds
+
+        # (measurement, tags) -> field -> (published value, monotonic time published)
+        self._published: Dict[tuple, Dict[str, Tuple[object, float]]] = {}
+
+    def reset(self):
+        """Publish every field again on the next collection"""
+        self._published.clear()
+
+    def _exceeded(self, deadband: Deadband, previous, value) -> bool:
+        if type(value) not in (int, float) or type(previous) not in (int, float):
+            return value != previous
+        threshold = max(deadband.absolute, deadband.relative * abs(previous))
+        return abs(value - previous) > threshold
+
+    def filter(self, collection: dict) -> Optional[dict]:
+        """Get the collection with unchanged fields removed, or None if none are left"""
+        if not self.deadbands:
+            return collection
+
+        key = (
+            collection["measurement"],
+            tuple(sorted(collection.get("tags", {}).items())),
+        )
+        published = self._published.setdefault(key, {})
+        now = time.monotonic()
+
+        fields = {}
+        for field, value in collection["fields"].items():
+            deadband = self.deadbands.get(field)
+            if deadband is not None and field in published:
+                previous, published_at = published[field]
+                if now - published_at < self.heartbeat_seconds and not self._exceeded(
+                    deadband, previous, value
+                ):
+                    continue
+
+            fields[field] = value
+            published[field] = (value, now)
+
+        skipped = len(collection["fields"]) - len(fields)
+        if skipped:
+            self.logger.debug(f"Skipped {skipped} field(s) within their deadband")
+        if not fields:
+            return None
+        return {**collection, "fields": fields}
@@ -0,0 +1,197 @@
+"""Payload encodings for batches of collections
+
+JSON is the default, and is always used when a batch cannot be represented in the
+compact encoding. The compact encoding is a binary format that the aggregator
+recognizes by its leading MAGIC byte (it can never start a JSON document):
+
+    message  := MAGIC VERSION varint(block count) block*
+    block    := str(measurement) varint(tag count) (str(key) str(value))*
+                varint(field count) field*
+                varint(string count) str* varint(row count) varint(base time) row*
+    field    := str(name) kind [varint(multiplier) if kind is SCALED]
+    row      := svarint(time delta) presence-bitmap value*
+
+Collections with the same measurement and tags share a block, so names and tags are
+sent once per message. Times are milliseconds since the epoch, the first row is
+relative to the block's base time and each other row to the previous one. The
+presence bitmap has one bit per field (least significant bit first) and is followed
+by the values of the fields that are present. Values of SCALED fields are the raw
+register words, i.e. the value times the register's multiplier.
+
+The layout is identified by VERSION. aggregator/compact.py decodes it with its own
+copy of the constants and layout. Any change must bump VERSION here and add it to
+SUPPORTED_VERSIONS there. aggregator/tests/test_compact.py checks that the two still
+agree.
+"""
+
+from datetime import datetime, timezone
+import json
+import struct
+from typing import Dict, List
+
+MAGIC = 0xE5
+VERSION = 1
+
+KIND_STRING = 0
+KIND_FLOAT = 1
+KIND_SCALED = 2
+KIND_INTEGER = 3
+KIND_BOOLEAN = 4
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_double = struct.Struct("<d")
+
+
+def encode_json(collections: List[str]) -> str:
+    """Join already serialized collections into a JSON array"""
+    return "[" + ",".join(collections) + "]"
+
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_svarint(out: bytearray, value: int):
+    # Zigzag encoding keeps small negative numbers small
+    _write_varint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)
+
+
+def _write_str(out: bytearray, value: str):
+    data = value.encode("utf-8")
+    _write_varint(out, len(data))
+    out += data
+
+
+def _parse_time(value) -> int:
+    if not isinstance(value, str) or not value.endswith("Z"):
+        raise ValueError(f"Unsupported time {value!r}")
+    parsed = datetime.fromisoformat(value[:-1]).replace(tzinfo=timezone.utc)
+    return (parsed - EPOCH) // datetime.resolution // 1000
+
+
+def _field_kind(values: list, multiplier: int):
+    if all(type(v) is bool for v in values):
+        return KIND_BOOLEAN
+    if all(type(v) is str for v in values):
+        return KIND_STRING
+    if all(type(v) is int for v in values):
+        return KIND_INTEGER
+    if all(type(v) is float for v in values):
+        if multiplier and all(round(v * multiplier) / multiplier == v for v in values):
+            return KIND_SCALED
+        return KIND_FLOAT
+    raise ValueError(f"Mixed value types {set(type(v) for v in values)}")
+
+
+def _encode_block(out: bytearray, points: List[dict], multipliers: Dict[str, int]):
+    measurement = points[0]["measurement"]
+    tags = points[0].get("tags", {})
+
+    field_names = []
+    for point in points:
+        for name in point["fields"]:
+            if name not in field_names:
+                field_names.append(name)
+
+    _write_str(out, measurement)
+    _write_varint(out, len(tags))
+    for key, value in tags.items():
+        _write_str(out, key)
+        _write_str(out, value)
+
+    kinds = []
+    strings: Dict[str, int] = {}
+    _write_varint(out, len(field_names))
+    for name in field_names:
+        values = [p["fields"][name] for p in points if name in p["fields"]]
+        kind = _field_kind(values, multipliers.get(name, 0))
+        kinds.append(kind)
+
+        _write_str(out, name)
+        out.append(kind)
+        if kind == KIND_SCALED:
+            _write_varint(out, multipliers[name])
+        elif kind == KIND_STRING:
+            for value in values:
+                strings.setdefault(value, len(strings))
+
+    _write_varint(out, len(strings))
+    for value in strings:
+        _write_str(out, value)
+
+    times = [_parse_time(point.get("time")) for point in points]
+    _write_varint(out, len(points))
+    _write_varint(out, times[0])
+
+    previous_time = times[0]
+    bitmap_size = (len(field_names) + 7) // 8
+    for point, point_time in zip(points, times):
+        _write_svarint(out, point_time - previous_time)
+        previous_time = point_time
+
+        fields = point["fields"]
+        bitmap = 0
+        for i, name in enumerate(field_names):
+            if name in fields:
+                bitmap |= 1 << i
+        out += bitmap.to_bytes(bitmap_size, "little")
+
+        for name, kind in zip(field_names, kinds):
+            if name not in fields:
+                continue
+            value = fields[name]
+            if kind == KIND_SCALED:
+                _write_svarint(out, round(value * multipliers[name]))
+            elif kind == KIND_FLOAT:
+                out += _double.pack(value)
+            elif kind == KIND_INTEGER:
+                _write_svarint(out, value)
+            elif kind == KIND_BOOLEAN:
+                out.append(value)
+            else:
+                _write_varint(out, strings[value])
+
+
+def encode_compact(collections: List[dict], multipliers: Dict[str, int]) -> bytes:
+    """Encode collections in the compact binary format
+
+    `multipliers` maps field names to the multiplier of the register they were read
+    from, fields without one are sent as floats. Raises ValueError when the collections
+    cannot be represented.
+    """
+    blocks: Dict[tuple, List[dict]] = {}
+    for collection in collections:
+        key = (
+            collection["measurement"],
+            tuple(sorted(collection.get("tags", {}).items())),
+        )
+        blocks.setdefault(key, []).append(collection)
+
+    out = bytearray([MAGIC, VERSION])
+    _write_varint(out, len(blocks))
+    for points in blocks.values():
+        _encode_block(out, points, multipliers)
+
+    return bytes(out)
+
+
+def get_encoder(encoding: str, multipliers: Dict[str, int]):
+    """Get a function encoding a list of serialized collections into a payload"""
+    if encoding == "json":
+        return encode_json
+
+    if encoding == "compact":
+
+        def encode(collections: List[str]):
+            try:
+                return encode_compact([json.loads(c) for c in collections], multipliers)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                return encode_json(collections)
+
+        return encode
+
+    raise ValueError(f"Unknown payload encoding {encoding!r}")
@@ -1,46 +1,478 @@
 from collections import defaultdict
 import datetime
+from functools import lru_cache, partial
 import logging
-from typing import Dict, Callable
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import urlsplit
 
-from pymodbus.register_read_message import (
-    ReadInputRegistersResponse,
-    ReadHoldingRegistersResponse,
-)
 from pymodbus.mei_message import ReadDeviceInformationRequest
-from pymodbus.client.sync import BaseModbusClient, ModbusSerialClient as ModbusClient
+from pymodbus.client.sync import (
+    BaseModbusClient,
+    ModbusSerialClient as ModbusClient,
+    ModbusTcpClient,
+)
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.factory import ClientDecoder
+from pymodbus.framer.rtu_framer import ModbusRtuFramer
+from pymodbus.pdu import ModbusExceptions
 
+from .decoding import BlockDecoder
 from .registers import Register, RegisterType, RegisterValue, SettingParameter
 
+DEFAULT_PORT = "/dev/serial485"
+DEFAULT_BAUDRATE = 115200
+
+# A response normally takes a few milliseconds, pymodbus would otherwise wait 3 seconds
+DEFAULT_TIMEOUT = 1.0
+
+# The MODBUS specification limits a single register read request to 125 registers
+MAX_READ_SIZE = 125
+
+# Number of unrequested registers that may be read (and discarded) in order to merge
+# two nearby blocks into a single transaction. A round trip on the RS485 bus costs far
+# more than a few extra words in the response.
+MAX_READ_GAP = 8
+
+# Identification of a device that didn't answer its identification request yet
+UNKNOWN_DEVICE_INFO = {
+    "manufacturer": "unknown",
+    "model": "unknown",
+    "version": "unknown",
+}
+
 
 def unsupported_register_type(*args, **kwargs):
     raise Exception("Unsupported register type for operation")
 
 
+class ModbusSettings(NamedTuple):
+    """Settings of the connections made by get_shared_client()"""
+
+    baudrate: int = DEFAULT_BAUDRATE
+    # Seconds to wait for each response
+    timeout: float = DEFAULT_TIMEOUT
+    # Times a transaction without a (valid) response is retried
+    retries: int = 1
+
+
+class ReadBlock(NamedTuple):
+    """A single read transaction covering one or more registers of the same type"""
+
+    type: RegisterType
+    address: int
+    size: int
+    registers: List[Register]
+    # Where each register's words start in the response
+    offsets: List[int]
+    decoder: BlockDecoder
+
+
+def plan_block_reads(
+    registers: Iterable[Register],
+    max_gap: int = MAX_READ_GAP,
+    max_size: int = MAX_READ_SIZE,
+) -> List[ReadBlock]:
+    """Group registers by type and merge nearby address ranges into as few reads as possible"""
+    by_type: Dict[RegisterType, List[Register]] = defaultdict(list)
+    for register in set(registers):
+        by_type[register.type].append(register)
+
+    blocks = []
+    for register_type, members in by_type.items():
+        members.sort(key=lambda r: r.address)
+
+        start = end = None
+        block_registers = []
+        for register in members:
+            register_end = register.address + register.size
+            if (
+                block_registers
+                and register.address - end <= max_gap
+                and max(end, register_end) - start <= max_size
+            ):
+                end = max(end, register_end)
+                block_registers.append(register)
+                continue
+
+            if block_registers:
+                blocks.append(_make_block(register_type, start, end, block_registers))
+            start, end = register.address, register_end
+            block_registers = [register]
+
+        if block_registers:
+            blocks.append(_make_block(register_type, start, end, block_registers))
+
+    return blocks
+
+
+def _make_block(register_type: RegisterType, start: int, end: int, registers):
+    offsets = [register.address - start for register in registers]
+    decoder = BlockDecoder(end - start, registers, offsets)
+    return ReadBlock(register_type, start, end - start, registers, offsets, decoder)
+
+
+def _make_block_of(register: Register) -> ReadBlock:
+    return _make_block(
+        register.type, register.address, register.address + register.size, [register]
+    )
+
+
+@lru_cache(maxsize=64)
+def compile_read_plan(registers: Tuple[Register, ...]) -> List[ReadBlock]:
+    """Get the block reads for a set of registers, planned once and then reused"""
+    return plan_block_reads(registers)
+
+
+class CountingRtuFramer(ModbusRtuFramer):
+    """An RTU framer counting the frames it discards, most often because of a bad CRC"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.crc_errors = 0
+
+    def checkFrame(self):
+        valid = super().checkFrame()
+        if not valid:
+            self.crc_errors += 1
+        return valid
+
+
+def _retryable(response) -> bool:
+    return (
+        isinstance(response, ModbusIOException)
+        or getattr(response, "exception_code", None) == ModbusExceptions.SlaveBusy
+    )
+
+
+class ModbusBus:
+    """A MODBUS connection shared by every device attached to one serial port
+
+    The port is opened lazily by the first transaction and re-opened after errors,
+    backing off exponentially while it stays unavailable. Every transaction on the bus
+    is made while holding `lock`, which callers may also hold to group transactions.
+    """
+
+    def __init__(
+        self,
+        modbus_client: BaseModbusClient,
+        min_reconnect_delay: float = 1.0,
+        max_reconnect_delay: float = 60.0,
+        max_consecutive_errors: int = 3,
+        retries: int = 0,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.modbus_client = modbus_client
+        self.lock = threading.RLock()
+
+        self.min_reconnect_delay = min_reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_consecutive_errors = max_consecutive_errors
+        self.retries = retries
+
+        self.connected = False
+        # Incremented on every (re)connect, lets devices notice that they may have been swapped
+        self.generation = 0
+        self._reconnect_delay = min_reconnect_delay
+        self._next_connect_time = 0.0
+        self._consecutive_errors = 0
+
+        # Counters, see get_stats(). They have their own lock so that reading them
+        # doesn't wait for a slow or hung transaction holding `lock`.
+        self._stats_lock = threading.Lock()
+        self.stats: Dict[str, Union[int, float]] = {
+            "transactions": 0,
+            "error_responses": 0,
+            "timeouts": 0,
+            "retries": 0,
+            "deadline_skips": 0,
+            "missing_values": 0,
+            "failures": 0,
+            "resets": 0,
+            "connects": 0,
+            "block_fallbacks": 0,
+            "transaction_seconds_total": 0.0,
+            "transaction_seconds_max": 0.0,
+        }
+
+    def connect(self):
+        with self.lock:
+            if self.connected:
+                return
+
+            now = time.monotonic()
+            if now < self._next_connect_time:
+                raise ConnectionException(
+                    f"{self.modbus_client} unavailable, next attempt in {self._next_connect_time - now:.1f}s"
+                )
+
+            if not self.modbus_client.connect():
+                self._schedule_reconnect()
+                raise ConnectionException(f"Failed to connect to {self.modbus_client}")
+
+            self.logger.info(f"Connected to {self.modbus_client}")
+            self.connected = True
+            self.generation += 1
+            self.count("connects")
+
+    def close(self):
+        with self.lock:
+            self.modbus_client.close()
+            self.connected = False
+
+    def reset(self):
+        """Close the connection after an error, it will be re-opened by a later transaction"""
+        with self.lock:
+            self.logger.warning(f"Resetting connection to {self.modbus_client}")
+            self.count("resets")
+            self.close()
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        self._next_connect_time = time.monotonic() + self._reconnect_delay
+        self._reconnect_delay = min(self._reconnect_delay * 2, self.max_reconnect_delay)
+        self._consecutive_errors = 0
+
+    def execute(self, fn: Callable, *args, deadline: Optional[float] = None, **kwargs):
+        """Run a single transaction on the bus, connecting first if needed
+
+        A transaction without a (valid) response, or answered by a busy device, is
+        retried up to `retries` times, but not once the monotonic `deadline` has passed.
+        """
+        with self.lock:
+            attempt = 0
+            while True:
+                response = self._execute_once(fn, *args, **kwargs)
+                if (
+                    not _retryable(response)
+                    or attempt >= self.retries
+                    or not self.connected
+                    or (deadline is not None and time.monotonic() >= deadline)
+                ):
+                    return response
+                attempt += 1
+                self.count("retries")
+                self.logger.debug(f"Retrying transaction after: {response}")
+
+    def _execute_once(self, fn: Callable, *args, **kwargs):
+        self.connect()
+
+        started = time.monotonic()
+        try:
+            response = fn(*args, **kwargs)
+        except (ConnectionException, OSError):
+            self.count("failures")
+            self.reset()
+            raise
+        finally:
+            self._record_transaction(time.monotonic() - started)
+
+        if isinstance(response, ModbusIOException):
+            self.count("timeouts")
+            # pymodbus returns (rather than raises) serial errors and timeouts. A single
+            # one is most likely an unresponsive device, but a run of them on the same
+            # bus points to a problem with the port itself.
+            self._consecutive_errors += 1
+            if self._consecutive_errors >= self.max_consecutive_errors:
+                self.reset()
+        else:
+            if response.isError():
+                self.count("error_responses")
+            self._consecutive_errors = 0
+            self._reconnect_delay = self.min_reconnect_delay
+
+        return response
+
+    def count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _record_transaction(self, seconds: float):
+        with self._stats_lock:
+            stats = self.stats
+            stats["transactions"] += 1
+            stats["transaction_seconds_total"] += seconds
+            if seconds > stats["transaction_seconds_max"]:
+                stats["transaction_seconds_max"] = seconds
+
+    def get_stats(self) -> Dict[str, Union[int, float]]:
+        """Get the bus counters
+
+        Timeouts count transactions without a (valid) response, crc_errors the
+        discarded frames behind some of them, error_responses the exceptions returned
+        by devices and failures the transactions that raised. Retries are included in
+        the transactions, deadline_skips count reads given up on at a cycle deadline
+        and missing_values the registers left without a value.
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        crc_errors = getattr(
+            getattr(self.modbus_client, "framer", None), "crc_errors", None
+        )
+        if crc_errors is not None:
+            stats["crc_errors"] = crc_errors
+        return stats
+
+
 class EpsolarTracerClient:
-    def __init__(self, modbus_client: BaseModbusClient = None, unit: int = 1):
+    def __init__(
+        self,
+        modbus_client: BaseModbusClient = None,
+        unit: int = 1,
+        bus: ModbusBus = None,
+    ):
         self.logger = logging.getLogger(__name__)
         self.unit = unit
-        self.modbus_client = modbus_client or ModbusClient(
-            method="rtu", port="/dev/serial485", baudrate=115200
+        self.bus = bus or ModbusBus(
+            modbus_client
+            or ModbusClient(method="rtu", port=DEFAULT_PORT, baudrate=DEFAULT_BAUDRATE)
         )
+        self.modbus_client = self.bus.modbus_client
 
         client = self.modbus_client
+        execute = self._execute
 
         self._read_helpers: Dict[Callable] = defaultdict(unsupported_register_type)
-        self._read_helpers[RegisterType.COIL] = client.read_coils
-        self._read_helpers[RegisterType.DISCRETE] = client.read_discrete_inputs
-        self._read_helpers[RegisterType.INPUT] = client.read_input_registers
-        self._read_helpers[RegisterType.HOLDING] = client.read_holding_registers
+        self._read_helpers[RegisterType.COIL] = partial(execute, client.read_coils)
+        self._read_helpers[RegisterType.DISCRETE] = partial(
+            execute, client.read_discrete_inputs
+        )
+        self._read_helpers[RegisterType.INPUT] = partial(
+            execute, client.read_input_registers
+        )
+        self._read_helpers[RegisterType.HOLDING] = partial(
+            execute, client.read_holding_registers
+        )
 
         self._write_helpers: Dict[Callable] = defaultdict(unsupported_register_type)
-        self._write_helpers[RegisterType.COIL] = client.write_coils
-        self._write_helpers[RegisterType.HOLDING] = client.write_registers
+        self._write_helpers[RegisterType.COIL] = partial(execute, client.write_coils)
+        self._write_helpers[RegisterType.HOLDING] = partial(
+            execute, client.write_registers
+        )
+
+        # Block reads go straight to the bus: a device rejecting a block that spans
+        # undefined addresses is expected and handled by falling back to single reads
+        self._block_read_functions: Dict[RegisterType, Callable] = {
+            RegisterType.INPUT: client.read_input_registers,
+            RegisterType.HOLDING: client.read_holding_registers,
+        }
+
+        # Blocks this device rejected -> the smaller blocks read instead
+        self._split_blocks: Dict[Tuple[int, Tuple[Register, ...]], List[ReadBlock]] = {}
+
+        self._device_info = None
+        self._device_info_generation = None
+
+    def _execute(self, fn: Callable, *args, **kwargs):
+        response = self.bus.execute(fn, *args, **kwargs)
+        if getattr(response, "exception_code", None) in (
+            ModbusExceptions.IllegalFunction,
+            ModbusExceptions.IllegalAddress,
+        ):
+            # A register the device used to answer being rejected may mean a different
+            # controller is now attached. A timeout or busy device doesn't: reconnects
+            # are noticed through the bus generation instead.
+            self.invalidate_device_info()
+        return response
+
+    def read_register(
+        self, register: Register, deadline: Optional[float] = None
+    ) -> RegisterValue:
+        """Read a register, its value is None if the device did not (validly) answer"""
+        if deadline is not None and time.monotonic() >= deadline:
+            self.bus.count("deadline_skips")
+            return self._missing(register)
 
-    def read_register(self, register: Register) -> RegisterValue:
         helper = self._read_helpers[register.type]
-        value = helper(register.address, register.size, unit=self.unit)
-        return register.decode(value)
+        response = helper(
+            register.address, register.size, unit=self.unit, deadline=deadline
+        )
+        if not hasattr(response, "registers") and not hasattr(response, "bits"):
+            self.logger.info(f"No value for {register.description}: {response}")
+            return self._missing(register)
+        return register.decode(response)
+
+    def _missing(self, register: Register) -> RegisterValue:
+        self.bus.count("missing_values")
+        return RegisterValue(register, None)
+
+    def read_registers(
+        self, registers: List[Register], deadline: Optional[float] = None
+    ) -> List[RegisterValue]:
+        """Read several registers using as few transactions as possible
+
+        Values are returned in the same order as the requested registers. Registers
+        that could not be read, or were not read before the monotonic `deadline`, have
+        a value of None.
+        """
+        plan = compile_read_plan(tuple(registers))
+        with self.bus.lock:
+            values = self._read_blocks(plan, deadline)
+
+        return [values[register] for register in registers]
+
+    def _read_blocks(
+        self, blocks: List[ReadBlock], deadline: Optional[float] = None
+    ) -> Dict[Register, RegisterValue]:
+        values: Dict[Register, RegisterValue] = {}
+
+        for block in blocks:
+            split = self._split_blocks.get((block.address, tuple(block.registers)))
+            if split is not None:
+                values.update(self._read_blocks(split, deadline))
+                continue
+
+            read = self._block_read_functions.get(block.type)
+            if read is None:
+                for register in block.registers:
+                    values[register] = self.read_register(register, deadline)
+                continue
+
+            if deadline is not None and time.monotonic() >= deadline:
+                self.bus.count("deadline_skips")
+                for register in block.registers:
+                    values[register] = self._missing(register)
+                continue
+
+            response = self.bus.execute(
+                read, block.address, block.size, unit=self.unit, deadline=deadline
+            )
+            words = getattr(response, "registers", None)
+
+            if isinstance(response, ModbusIOException):
+                # Already retried, reading the registers one by one would only time
+                # out again for each of them
+                self.logger.info(
+                    f"No response to block read of {block.size} registers at {block.address:#06x}: {response}"
+                )
+                for register in block.registers:
+                    values[register] = self._missing(register)
+                continue
+
+            if not words or len(words) < block.size:
+                self.logger.info(
+                    f"Block read of {block.size} registers at {block.address:#06x} failed: {response}"
+                )
+                if len(block.registers) == 1:
+                    values[block.registers[0]] = self._missing(block.registers[0])
+                    continue
+
+                # Some devices reject reads spanning undefined addresses. From now on,
+                # read the block's gap-free runs of registers instead, or its registers
+                # one at a time if it had no gaps.
+                self.bus.count("block_fallbacks")
+                split = plan_block_reads(block.registers, max_gap=0)
+                if len(split) == 1:
+                    split = [_make_block_of(register) for register in block.registers]
+                split.sort(key=lambda b: b.address)
+                self._split_blocks[(block.address, tuple(block.registers))] = split
+                values.update(self._read_blocks(split, deadline))
+                continue
+
+            values.update(block.decoder.decode(words))
+
+        return values
 
     def write_register(self, register: Register, value):
         self.logger.debug(f"write_register value: {value}")
@@ -50,9 +482,11 @@ class EpsolarTracerClient:
         helper(register.address, values, unit=self.unit)
 
     def read_device_info(self):
-        response = self.modbus_client.execute(
-            ReadDeviceInformationRequest(unit=self.unit)
+        response = self._execute(
+            self.modbus_client.execute, ReadDeviceInformationRequest(unit=self.unit)
         )
+        if not hasattr(response, "information"):
+            raise ModbusIOException(f"No device identification: {response}")
 
         return {
             "manufacturer": response.information[0].decode("utf-8"),
@@ -60,10 +494,113 @@ class EpsolarTracerClient:
             "version": response.information[2].decode("utf-8"),
         }
 
+    def get_device_info(self):
+        """Get the device identification, only reading it from the device when not cached
+
+        If the device doesn't answer, the last identification read is used until the
+        next attempt, or UNKNOWN_DEVICE_INFO before the first one succeeded.
+        """
+        with self.bus.lock:
+            # Connect first so that a reconnect is noticed before the cache is used
+            self.bus.connect()
+            if self._device_info_generation != self.bus.generation:
+                try:
+                    self._device_info = self.read_device_info()
+                except ModbusIOException as e:
+                    self.logger.info(f"Device identification failed: {e}")
+                    return self._device_info or UNKNOWN_DEVICE_INFO
+                self._device_info_generation = self.bus.generation
+            return self._device_info
+
+    def invalidate_device_info(self):
+        """Read the identification again on the next get_device_info()"""
+        self._device_info_generation = None
+
     def sync_rtc(self):
         self.logger.info("Syncing RTC")
-        device_time = self.read_register(SettingParameter.Clock).value
-        now = datetime.datetime.now()
-        self.write_register(SettingParameter.Clock, now)
-        self.logger.info(f"Device time was: {device_time.isoformat()}")
+        with self.bus.lock:
+            device_time = self.read_register(SettingParameter.Clock).value
+            now = datetime.datetime.now()
+            self.write_register(SettingParameter.Clock, now)
+        self.logger.info(
+            f"Device time was: {device_time.isoformat() if device_time else 'unknown'}"
+        )
         self.logger.info(f"System time now: {now.isoformat()}")
+
+
+def make_modbus_client(
+    port: str, settings: ModbusSettings = ModbusSettings()
+) -> BaseModbusClient:
+    """Create the MODBUS client for a port
+
+    A port is a serial device, or a TCP address: "tcp://host:port" for MODBUS TCP or
+    "rtu+tcp://host:port" for RTU frames over TCP (e.g. a serial device server, or
+    the simulator).
+    """
+    url = urlsplit(port)
+    if url.scheme == "tcp":
+        return ModbusTcpClient(url.hostname, url.port or 502, timeout=settings.timeout)
+    if url.scheme == "rtu+tcp":
+        return ModbusTcpClient(
+            url.hostname,
+            url.port or 502,
+            framer=CountingRtuFramer,
+            timeout=settings.timeout,
+        )
+    if url.scheme:
+        raise ValueError(f"Unsupported MODBUS port {port!r}")
+
+    modbus_client = ModbusClient(
+        method="rtu", port=port, baudrate=settings.baudrate, timeout=settings.timeout
+    )
+    modbus_client.framer = CountingRtuFramer(ClientDecoder(), modbus_client)
+    return modbus_client
+
+
+_shared_lock = threading.Lock()
+_shared_buses: Dict[str, ModbusBus] = {}
+_shared_clients: Dict[Tuple[str, int], EpsolarTracerClient] = {}
+_shared_settings = ModbusSettings()
+
+
+def configure_shared_clients(settings: ModbusSettings):
+    """Set the settings of shared clients, closing any that were made with others"""
+    global _shared_settings
+    close_shared_clients()
+    with _shared_lock:
+        _shared_settings = settings
+
+
+def get_shared_client(port: str = DEFAULT_PORT, unit: int = 1) -> EpsolarTracerClient:
+    """Get the process-wide client for a device, sharing one connection per port
+
+    See make_modbus_client() for the supported ports.
+    """
+    with _shared_lock:
+        client = _shared_clients.get((port, unit))
+        if client is None:
+            bus = _shared_buses.get(port)
+            if bus is None:
+                bus = ModbusBus(
+                    make_modbus_client(port, _shared_settings),
+                    retries=_shared_settings.retries,
+                )
+                _shared_buses[port] = bus
+            client = EpsolarTracerClient(unit=unit, bus=bus)
+            _shared_clients[(port, unit)] = client
+        return client
+
+
+def get_shared_bus_stats() -> Dict[str, Dict[str, Union[int, float]]]:
+    """Get the counters of every shared bus, by port"""
+    with _shared_lock:
+        buses = dict(_shared_buses)
+    return {port: bus.get_stats() for port, bus in buses.items()}
+
+
+def close_shared_clients():
+    with _shared_lock:
+        for bus in _shared_buses.values():
+            bus.close()
+        _shared_buses.clear()
+        _shared_clients.clear()
@@ -1,10 +1,27 @@
 #!/usr/bin/env python3.7
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from enum import Enum
+from functools import partial
 import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from .registers import *
-from .client import EpsolarTracerClient
+from .client import (
+    DEFAULT_PORT,
+    close_shared_clients,
+    get_shared_bus_stats,
+    get_shared_client,
+)
+from .sampling import SAMPLED_REGISTERS, RealtimeSampler
+
+# (port, unit) of each device that is polled
+DEFAULT_TARGETS = [(DEFAULT_PORT, 1)]
+
+# Separate serial buses are polled in parallel, up to this many at a time
+MAX_PARALLEL_BUSES = 8
 
 
 class ChargingMode(Enum):
@@ -17,51 +34,222 @@ class ChargingMode(Enum):
         return ChargingMode((int(charging_equipment_status) & 0x000C) >> 2)
 
 
-def _collect_values(client):
-    return {
-        "pv_voltage": float(client.read_register(RealtimeData.PvArrayInputVoltage)),
-        "pv_current": float(client.read_register(RealtimeData.PvArrayInputCurrent)),
-        "pv_power": float(client.read_register(RealtimeData.PvArrayInputPower)),
-        "battery_voltage": float(client.read_register(RealtimeData.BatteryVoltage)),
-        "battery_temperature": float(
-            client.read_register(RealtimeData.BatteryTemperature)
-        ),
-        "generated_today": float(
-            client.read_register(StatisticalParameter.GeneratedEnergyToday)
-        ),
-        "generated_total": float(
-            client.read_register(StatisticalParameter.TotalGeneratedEnergy)
-        ),
-        "charging_mode": ChargingMode.parse(
-            client.read_register(RealtimeStatus.ChargingEquipmentStatus)
-        ).name,
-        "output_current": float(client.read_register(RealtimeData.BatteryCurrent)),
-        "output_power": float(client.read_register(RealtimeData.BatteryPower)),
-        "equipment_temperature": float(
-            client.read_register(RealtimeData.EquipmentTemperature)
-        ),
+# Register read for each field of a collection, by name or address (see
+# registers.find_register)
+DEFAULT_FIELDS = {
+    "pv_voltage": "RealtimeData.PvArrayInputVoltage",
+    "pv_current": "RealtimeData.PvArrayInputCurrent",
+    "pv_power": "RealtimeData.PvArrayInputPower",
+    "battery_voltage": "RealtimeData.BatteryVoltage",
+    "battery_temperature": "RealtimeData.BatteryTemperature",
+    "generated_today": "StatisticalParameter.GeneratedEnergyToday",
+    "generated_total": "StatisticalParameter.TotalGeneratedEnergy",
+    "output_current": "RealtimeData.BatteryCurrent",
+    "output_power": "RealtimeData.BatteryPower",
+    "equipment_temperature": "RealtimeData.EquipmentTemperature",
+}
+
+
+def resolve_fields(fields: Dict[str, Union[str, int]]) -> Dict[str, Register]:
+    """Look up the register of each field, raising KeyError for unknown registers"""
+    return {field: find_register(name) for field, name in fields.items()}
+
+
+def field_multipliers(field_registers: Dict[str, Register]) -> Dict[str, int]:
+    """Get the multiplier of every register field, see encoding.encode_compact"""
+    multipliers = {
+        field: register.multiplier for field, register in field_registers.items()
     }
+    # The extremes of sampled fields are register values too (unlike their means)
+    multipliers.update(
+        {
+            f"{field}{suffix}": register.multiplier
+            for field, register in SAMPLED_REGISTERS.items()
+            for suffix in ("_min", "_max")
+        }
+    )
+    return multipliers
+
+
+FIELD_REGISTERS = resolve_fields(DEFAULT_FIELDS)
+
+_lock = threading.Lock()
+_bus_executor = None
+# Set by start_sampling(), (port, unit) -> sampler
+_samplers: Dict[Tuple[str, int], RealtimeSampler] = {}
+
+
+def _field_value(value: RegisterValue):
+    if value.value is None:
+        return None
+    if isinstance(value.value, datetime.datetime):
+        return value.value.isoformat()
+    return float(value)
+
+
+def _collect_values(
+    client, field_registers: Dict[str, Register], deadline: Optional[float] = None
+):
+    """Read the fields, leaving out the ones that could not be read"""
+    # The registers all go in one read plan, which is compiled on the first collection
+    *values, charging_equipment_status = client.read_registers(
+        [*field_registers.values(), RealtimeStatus.ChargingEquipmentStatus], deadline
+    )
+
+    results = {}
+    for field, value in zip(field_registers, values):
+        value = _field_value(value)
+        if value is not None:
+            results[field] = value
+    if charging_equipment_status.value is not None:
+        results["charging_mode"] = ChargingMode.parse(charging_equipment_status).name
+    return results
+
+
+def _poll_bus(fn: Callable, port: str, units: List[int]) -> list:
+    logger = logging.getLogger(__name__)
+    results = []
+    for unit in units:
+        client = get_shared_client(port, unit)
+        try:
+            with client.bus.lock:
+                results.append(fn(client, port, unit))
+        except Exception:
+            logger.exception(f"Polling unit {unit} on {port} failed")
+            results.append(None)
+    return results
+
 
+def _map_targets(fn: Callable, targets: List[Tuple[str, int]]) -> list:
+    """Call fn(client, port, unit) for every target, returning the results in order
 
-def sync_rtc():
-    EpsolarTracerClient().sync_rtc()
+    Units on the same port are polled one after another holding the bus lock, while
+    separate ports are polled in parallel. Targets that failed yield None.
+    """
+    global _bus_executor
 
+    units_by_port: Dict[str, List[int]] = {}
+    for port, unit in targets:
+        units_by_port.setdefault(port, []).append(unit)
 
-def collect():
-    logger = logging.getLogger("epsolar_tracer_collect")
-    client = EpsolarTracerClient()
-    device_info = client.read_device_info()
+    if len(units_by_port) == 1:
+        ((port, units),) = units_by_port.items()
+        results_by_port = {port: _poll_bus(fn, port, units)}
+    else:
+        with _lock:
+            if _bus_executor is None:
+                _bus_executor = ThreadPoolExecutor(
+                    max_workers=MAX_PARALLEL_BUSES, thread_name_prefix="epsolar-bus"
+                )
+            futures = {
+                port: _bus_executor.submit(_poll_bus, fn, port, units)
+                for port, units in units_by_port.items()
+            }
+        results_by_port = {port: future.result() for port, future in futures.items()}
 
-    results = _collect_values(client)
+    results = {}
+    for port, units in units_by_port.items():
+        for unit, result in zip(units, results_by_port[port]):
+            results[(port, unit)] = result
+    return [results[target] for target in targets]
+
+
+def sync_rtc(targets: List[Tuple[str, int]] = DEFAULT_TARGETS):
+    _map_targets(lambda client, port, unit: client.sync_rtc(), targets)
+
+
+def start_sampling(rate_hz: float, targets: List[Tuple[str, int]] = DEFAULT_TARGETS):
+    """Sample the realtime registers of each target at `rate_hz` between collections
+
+    Collections then report the last sample of each sampled field along with its
+    minimum, maximum and mean since the previous collection.
+    """
+    for port, unit in targets:
+        if (port, unit) not in _samplers:
+            sampler = RealtimeSampler(partial(get_shared_client, port, unit), rate_hz)
+            sampler.start()
+            _samplers[(port, unit)] = sampler
+
+
+def close():
+    """Stop sampling and release the serial port(s) held by the shared clients"""
+    global _bus_executor
+    for sampler in _samplers.values():
+        sampler.stop()
+    _samplers.clear()
+
+    with _lock:
+        if _bus_executor is not None:
+            _bus_executor.shutdown()
+            _bus_executor = None
+    close_shared_clients()
+
+
+def get_bus_stats() -> List[dict]:
+    """Get the counters of every serial bus, as {"tags": ..., "fields": ...} groups"""
+    return [
+        {"tags": {"type": "modbus_bus", "port": port}, "fields": fields}
+        for port, fields in get_shared_bus_stats().items()
+    ]
+
+
+def _collect_device(
+    field_registers: Dict[str, Register],
+    deadline: Optional[float],
+    client,
+    port: str,
+    unit: int,
+) -> Optional[dict]:
+    if deadline is not None and time.monotonic() >= deadline:
+        logging.getLogger(__name__).warning(
+            f"Collection deadline passed before unit {unit} on {port} was polled"
+        )
+        return None
+
+    device_info = client.get_device_info()
+
+    results = _collect_values(client, field_registers, deadline)
+    sampler = _samplers.get((port, unit))
+    if sampler is not None:
+        results.update(sampler.take_summary())
+    if not results:
+        return None
 
     return {
         "measurement": "solar_controller",
         "time": datetime.datetime.utcnow().isoformat("T") + "Z",
-        "tags": {"type": "epsolar_tracer", "model": device_info["model"]},
+        "tags": {
+            "type": "epsolar_tracer",
+            "model": device_info["model"],
+            "port": port,
+            "unit": str(unit),
+        },
         "fields": results,
     }
 
 
+def collect(
+    targets: List[Tuple[str, int]] = DEFAULT_TARGETS,
+    field_registers: Dict[str, Register] = FIELD_REGISTERS,
+    deadline_seconds: Optional[float] = None,
+) -> List[dict]:
+    """Collect from every target, leaving out the ones that could not be polled
+
+    `field_registers` maps the name of each collected field to its register, see
+    resolve_fields(). Fields that could not be read are left out of their
+    collection. After `deadline_seconds`, no further reads are started and the
+    remaining fields and targets are left out too.
+    """
+    deadline = None
+    if deadline_seconds is not None:
+        deadline = time.monotonic() + deadline_seconds
+
+    collections = _map_targets(
+        partial(_collect_device, field_registers, deadline), targets
+    )
+    return [collection for collection in collections if collection is not None]
+
+
 if __name__ == "__main__":
     logging.basicConfig()
     logger = logging.getLogger()
@@ -0,0 +1,81 @@
+"""Decode block read responses in one pass
+
+Registers are signed integers of one or more 16-bit words, least significant word
+first. Laid out as little-endian bytes, a whole block is therefore one struct format
+of 16, 32 and 64-bit signed integers with pad bytes for the words in between. That
+format is built once per block layout, and decoding a response is a single pack and
+unpack instead of a loop of shifts per register.
+"""
+
+import logging
+import struct
+from typing import Dict, List
+
+from .registers import Register, RegisterValue
+
+logger = logging.getLogger(__name__)
+
+# Register size in words -> struct format of a signed integer of that size
+_INTEGER_FORMATS = {1: "h", 2: "i", 4: "q"}
+
+
+class BlockDecoder:
+    """Decode the words of a block read into the values of its registers
+
+    Registers overriding decode_registers (e.g. the RTC), of a size without a struct
+    format, or overlapping another register are decoded one at a time as before.
+    """
+
+    def __init__(self, size: int, registers: List[Register], offsets: List[int]):
+        self.size = size
+        self._words = struct.Struct(f"<{size}H")
+
+        formats = ["<"]
+        position = 0
+        self._registers: List[Register] = []
+        self._divisors: List[int] = []
+        self._individual = []
+
+        for offset, register in sorted(
+            zip(offsets, registers), key=lambda pair: pair[0]
+        ):
+            integer_format = _INTEGER_FORMATS.get(register.size)
+            if (
+                integer_format is None
+                or offset < position
+                or type(register).decode_registers is not Register.decode_registers
+            ):
+                self._individual.append((register, offset))
+                continue
+
+            if offset > position:
+                formats.append(f"{(offset - position) * 2}x")
+            formats.append(integer_format)
+            position = offset + register.size
+
+            self._registers.append(register)
+            self._divisors.append(register.multiplier)
+
+        # Words after the last register decoded here, e.g. an RTC ending the block
+        if size > position:
+            formats.append(f"{(size - position) * 2}x")
+        self._values = struct.Struct("".join(formats))
+
+    def decode(self, words: List[int]) -> Dict[Register, RegisterValue]:
+        raw_values = self._values.unpack(self._words.pack(*words[: self.size]))
+
+        values = {}
+        for register, divisor, raw_value in zip(
+            self._registers, self._divisors, raw_values
+        ):
+            values[register] = RegisterValue(
+                register, raw_value, raw_value / divisor if divisor != 1 else raw_value
+            )
+
+        for register, offset in self._individual:
+            values[register] = register.decode_registers(
+                words[offset : offset + register.size]
+            )
+
+        logger.debug("Decoded %d registers from %s", len(values), words)
+        return values
@@ -1,8 +1,14 @@
 import datetime
 from enum import Enum, IntEnum
+from functools import lru_cache
 import logging
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
 
-from pymodbus.register_read_message import ReadRegistersResponseBase
+if TYPE_CHECKING:
+    from pymodbus.register_read_message import ReadRegistersResponseBase
+
+# Shared by every register, there are hundreds of them
+logger = logging.getLogger(__name__)
 
 
 class RegisterType(Enum):
@@ -31,11 +37,16 @@ class RegisterUnit(Enum):
 
 
 class RegisterValue:
-    def __init__(self, register, raw_value):
+    __slots__ = ("register", "raw_value", "value")
+
+    def __init__(self, register, raw_value, value=None):
         self.register = register
         self.raw_value = raw_value
 
-        if self.register.multiplier != 1 and raw_value is not None:
+        if value is not None:
+            # Already scaled by the caller, e.g. decoding.BlockDecoder
+            self.value = value
+        elif self.register.multiplier != 1 and raw_value is not None:
             self.value = float(raw_value) / self.register.multiplier
         else:
             self.value = raw_value
@@ -64,6 +75,8 @@ class RegisterValue:
 
 
 class Register:
+    __slots__ = ("address", "size", "description", "unit", "multiplier", "type")
+
     def __init__(
         self,
         address,
@@ -72,8 +85,6 @@ class Register:
         multiplier=1,
         size=1,
     ):
-        self.logger = logging.getLogger(__name__)
-
         self.address = address
         self.size = size
         self.description = description
@@ -96,33 +107,39 @@ class Register:
         values = []
         for i in range(self.size):
             values.append((raw_value >> (i * 16)) & 0xFFFF)
-        self.logger.debug(f"Encoded {value} to {values}")
+        logger.debug("Encoded %s to %s", value, values)
         return values
 
-    def decode(self, response: ReadRegistersResponseBase) -> RegisterValue:
+    def decode(self, response: "ReadRegistersResponseBase") -> RegisterValue:
         if not hasattr(response, "registers"):
-            self.logger.info(f"No value for register {self.description}")
+            logger.info(f"No value for register {self.description}")
             return RegisterValue(self, None)
 
+        return self.decode_registers(response.registers)
+
+    def decode_registers(self, registers: List[int]) -> RegisterValue:
+        """Decode the raw 16-bit words belonging to this register (least significant word first)"""
         raw_value = 0
-        for i in range(len(response.registers)):
-            raw_value |= response.registers[i] << (i * 16)
+        for i in range(len(registers)):
+            raw_value |= registers[i] << (i * 16)
 
         # If this is a negative number, it needs to be sign-extended for python to interpret it properly
-        if (response.registers[-1] & 0x8000) == 0x8000:
-            raw_value -= 1 << len(response.registers) * 16
+        if (registers[-1] & 0x8000) == 0x8000:
+            raw_value -= 1 << len(registers) * 16
 
-        self.logger.debug(f"Decoded {response.registers} to {raw_value}")
+        logger.debug("Decoded %s to %s", registers, raw_value)
 
         return RegisterValue(self, raw_value)
 
 
 class RTC(Register):
+    __slots__ = ()
+
     def __init__(self, address):
         super().__init__(address, "Real-time Clock", size=3)
 
-    def decode(self, response: ReadRegistersResponseBase) -> RegisterValue:
-        register_value = super().decode(response)
+    def decode_registers(self, registers: List[int]) -> RegisterValue:
+        register_value = super().decode_registers(registers)
 
         if register_value.value is not None:
             value = int(register_value.value)
@@ -154,15 +171,19 @@ class RTC(Register):
 
 
 class Coil(Register):
+    __slots__ = ()
+
     def decode(self, response):
         if not hasattr(response, "bits"):
-            self.logger.info("No value for coil " + repr(self.description))
+            logger.info("No value for coil " + repr(self.description))
             return RegisterValue(self, None)
 
         return RegisterValue(self, response.bits[0])
 
 
 class StatusRegister(Register):
+    __slots__ = ("describe",)
+
     def __init__(self, address, describe_fn, **kwargs):
         super().__init__(address, **kwargs)
         self.describe = describe_fn
@@ -838,3 +859,55 @@ class ControlCoil:
         NIGHT = 1
 
     DayNight = Register(0x200C, description="Day/night indicator")
+
+
+REGISTER_GROUPS = (
+    RatedData,
+    RealtimeData,
+    RealtimeStatus,
+    StatisticalParameter,
+    SettingParameter,
+    ControlCoil,
+)
+
+
+@lru_cache(maxsize=None)
+def get_registry() -> Tuple[Dict[str, Register], Dict[int, Register]]:
+    """Get every known register by name and by address, built on first use
+
+    Names are "Group.Name", or just "Name" where that is unambiguous.
+    """
+    by_name: Dict[str, Register] = {}
+    by_address: Dict[int, Register] = {}
+    short_names: Dict[str, List[Register]] = {}
+    for group in REGISTER_GROUPS:
+        for name, register in vars(group).items():
+            if isinstance(register, Register):
+                by_name[f"{group.__name__}.{name}"] = register
+                by_address.setdefault(register.address, register)
+                short_names.setdefault(name, []).append(register)
+
+    # Short names are only usable when they are unambiguous
+    for name, registers in short_names.items():
+        if len(registers) == 1:
+            by_name.setdefault(name, registers[0])
+
+    return by_name, by_address
+
+
+def find_register(name: Union[str, int]) -> Register:
+    """Look up a register by name, e.g. "RealtimeData.BatteryVoltage", or by address"""
+    by_name, by_address = get_registry()
+    if isinstance(name, str) and name not in by_name:
+        try:
+            name = int(name, 0)
+        except ValueError:
+            raise KeyError(f"Unknown register {name!r}") from None
+
+    if isinstance(name, int):
+        try:
+            return by_address[name]
+        except KeyError:
+            raise KeyError(f"Unknown register address {name:#06x}") from None
+
+    return by_name[name]
@@ -0,0 +1,128 @@
+from array import array
+import logging
+import threading
+import time
+from typing import Callable, Dict
+
+from .client import EpsolarTracerClient
+from .registers import RealtimeData
+
+# Realtime registers worth sampling faster than the collection interval, they sit next
+# to each other so each sample is a single transaction
+SAMPLED_REGISTERS = {
+    "pv_voltage": RealtimeData.PvArrayInputVoltage,
+    "pv_current": RealtimeData.PvArrayInputCurrent,
+    "pv_power": RealtimeData.PvArrayInputPower,
+    "battery_voltage": RealtimeData.BatteryVoltage,
+    "output_current": RealtimeData.BatteryCurrent,
+}
+
+
+class RingBuffer:
+    """Fixed-size buffer of the most recent samples, backed by an array of doubles"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._values = array("d", bytes(8 * size))
+        self._next = 0
+        self.count = 0
+        self.last = None
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, value: float):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        self.count += 1
+        self.last = value
+
+    def clear(self):
+        self._next = 0
+        self.count = 0
+        self.last = None
+
+    def summary(self):
+        """Get (min, max, mean, last) of the buffered samples"""
+        values = self._values[: len(self)]
+        return min(values), max(values), sum(values) / len(values), self.last
+
+
+class RealtimeSampler:
+    """Poll the realtime registers in a background thread and summarize them per window
+
+    Samples are taken every 1 / `rate_hz` seconds and kept in ring buffers holding up
+    to `max_window_seconds` worth of samples. Each call to `take_summary` ends the
+    current window.
+    """
+
+    def __init__(
+        self,
+        client_fn: Callable[[], EpsolarTracerClient],
+        rate_hz: float,
+        max_window_seconds: float = 120,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.client_fn = client_fn
+        self.interval = 1 / rate_hz
+
+        size = max(1, int(rate_hz * max_window_seconds))
+        self._buffers = {field: RingBuffer(size) for field in SAMPLED_REGISTERS}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="epsolar-tracer-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.warning(f"Sampling failed: {e}")
+
+            # Keep to a fixed schedule, skipping samples rather than bunching them up
+            deadline += self.interval
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            self._stop.wait(deadline - now)
+
+    def sample(self):
+        values = self.client_fn().read_registers(list(SAMPLED_REGISTERS.values()))
+        with self._lock:
+            for field, value in zip(SAMPLED_REGISTERS, values):
+                if value.value is not None:
+                    self._buffers[field].append(float(value))
+
+    def take_summary(self) -> Dict[str, float]:
+        """Summarize the samples taken since the last call and start a new window"""
+        results = {}
+        with self._lock:
+            sample_count = 0
+            for field, buffer in self._buffers.items():
+                if not buffer.count:
+                    continue
+                minimum, maximum, mean, last = buffer.summary()
+                results[field] = last
+                results[f"{field}_min"] = minimum
+                results[f"{field}_max"] = maximum
+                results[f"{field}_mean"] = mean
+                sample_count = max(sample_count, buffer.count)
+                buffer.clear()
+
+        if sample_count:
+            results["sample_count"] = sample_count
+        return results
@@ -1,5 +1,8 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
+from typing import Dict, List, Tuple
+
+from deadband import Deadband
 
 
 @dataclass
@@ -17,4 +20,100 @@ class Config:
 
     jwt_algorithm: str = "ES256"
     jwt_lifetime_minutes: int = 60
+    # The jwt is replaced (with a quick reconnect) this long before it expires
+    jwt_rotation_margin_minutes: float = 5
     jwt_private_key: str = os.path.join(os.path.dirname(__file__), f"{device_id}.pem")
+
+    # (serial port, MODBUS unit) of each charge controller. Controllers on separate
+    # ports are polled in parallel.
+    modbus_targets: List[Tuple[str, int]] = field(
+        default_factory=lambda: [("/dev/serial485", 1)]
+    )
+
+    # The fields of each collection and the register each is read from, by name (see
+    # epsolar_tracer/registers.py, e.g. "RealtimeData.BatteryVoltage") or address.
+    # However many are selected, they are read in as few transactions as possible.
+    fields: Dict[str, str] = field(
+        default_factory=lambda: {
+            "pv_voltage": "RealtimeData.PvArrayInputVoltage",
+            "pv_current": "RealtimeData.PvArrayInputCurrent",
+            "pv_power": "RealtimeData.PvArrayInputPower",
+            "battery_voltage": "RealtimeData.BatteryVoltage",
+            "battery_temperature": "RealtimeData.BatteryTemperature",
+            "generated_today": "StatisticalParameter.GeneratedEnergyToday",
+            "generated_total": "StatisticalParameter.TotalGeneratedEnergy",
+            "output_current": "RealtimeData.BatteryCurrent",
+            "output_power": "RealtimeData.BatteryPower",
+            "equipment_temperature": "RealtimeData.EquipmentTemperature",
+        }
+    )
+
+    # Serial line speed, seconds to wait for each MODBUS response, and how many times
+    # a transaction without a (valid) response is retried
+    modbus_baudrate: int = 115200
+    modbus_timeout_seconds: float = 1.0
+    modbus_retries: int = 1
+
+    # Collections are taken on wall-clock multiples of this interval, and given up on
+    # if they take longer than the timeout. No reads are started after the deadline,
+    # the fields not read by then are left out of the collection.
+    collection_interval_seconds: float = 60
+    collection_timeout_seconds: float = 30
+    collection_deadline_seconds: float = 20
+
+    # Collections are published together once this many have been buffered, the oldest
+    # has waited this long, or the batch would exceed this size
+    batch_max_collections: int = 1
+    batch_max_seconds: float = 300
+    batch_max_bytes: int = 200000
+
+    # Poll the realtime registers (PV and battery voltage/current) this many times per
+    # second and report their min/max/mean with each collection, 0 to disable
+    sample_rate_hz: float = 0
+
+    # Fields are only published when they moved past their deadband since they were
+    # last published, or at least every deadband_heartbeat_seconds. Fields without a
+    # deadband are published with every collection, so the default of an empty dict
+    # disables this. Points then only carry the fields that changed, so queries need
+    # fill(previous) to rebuild the full series (see README.md). For example:
+    #
+    #     deadbands: Dict[str, Deadband] = field(
+    #         default_factory=lambda: {
+    #             "pv_voltage": Deadband(absolute=0.2, relative=0.01),
+    #             "pv_current": Deadband(absolute=0.05, relative=0.02),
+    #             "pv_power": Deadband(absolute=1, relative=0.02),
+    #             "battery_voltage": Deadband(absolute=0.02),
+    #             "battery_temperature": Deadband(absolute=0.5),
+    #             "equipment_temperature": Deadband(absolute=0.5),
+    #             "generated_today": Deadband(),
+    #             "generated_total": Deadband(),
+    #             "output_current": Deadband(absolute=0.05, relative=0.02),
+    #             "output_power": Deadband(absolute=1, relative=0.02),
+    #             "charging_mode": Deadband(),
+    #         }
+    #     )
+    deadbands: Dict[str, Deadband] = field(default_factory=dict)
+    deadband_heartbeat_seconds: float = 900
+
+    # "json", or "compact" for a smaller binary encoding (see encoding.py)
+    payload_encoding: str = "json"
+
+    # Collections are stored here until their delivery is acknowledged, so that they
+    # survive restarts and outages. Set to None to only keep them in memory.
+    spool_path: str = os.path.join(os.path.dirname(__file__), "spool.sqlite3")
+    # The oldest collections are dropped once this many are stored
+    spool_max_collections: int = 100000
+    # After an outage, stored collections are published in messages of up to this
+    # many collections, at most this many messages per second
+    spool_drain_collections: int = 100
+    spool_drain_rate: float = 2
+
+    # The collector's own metrics (timings, MODBUS errors, publish backlog) are
+    # published as the collector_stats measurement this often, 0 to disable
+    stats_interval_seconds: float = 300
+    # And served as text on this address for scraping, set the port to 0 to disable
+    stats_http_host: str = "127.0.0.1"
+    stats_http_port: int = 9101
+
+    # How long to wait for buffered collections to be delivered when shutting down
+    shutdown_timeout_seconds: float = 10
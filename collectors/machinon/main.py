@@ -1,23 +1,37 @@
 #!/usr/bin/env python3.7
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import json
-import jwt
 import logging
-import schedule
 import ssl
 import time
 import paho.mqtt.client as mqtt
 
+from batching import CollectionBatcher, MemoryStore
 from config import Config
-
+from deadband import DeadbandFilter
+from encoding import get_encoder
+from rotation import TokenRotator, attach_rotator
+from runtime import Runtime
+from stats import Stats, StatsServer
+from tls import make_tls_context
+
+from epsolar_tracer.client import ModbusSettings, configure_shared_clients
 from epsolar_tracer.collector import (
+    close as epsolar_tracer_close,
     collect as epsolar_tracer_collect,
+    field_multipliers as epsolar_tracer_field_multipliers,
+    get_bus_stats as epsolar_tracer_get_bus_stats,
+    resolve_fields as epsolar_tracer_resolve_fields,
+    start_sampling as epsolar_tracer_start_sampling,
     sync_rtc as epsolar_tracer_sync_rtc,
 )
 
 
 def get_json_web_token(config: Config):
     """Generate a JSON web token (jwt) used for device authentication to Google Cloud IoT"""
+    # Deferred, jwt and cryptography are among the largest imports
+    import jwt
+
     token = {
         # The time that the token was issued at
         "iat": datetime.datetime.utcnow(),
@@ -33,7 +47,7 @@ def get_json_web_token(config: Config):
     return jwt.encode(token, private_key, algorithm=config.jwt_algorithm)
 
 
-def get_mqtt_client(config: Config) -> mqtt.Client:
+def get_mqtt_client(config: Config, tls_context: ssl.SSLContext) -> mqtt.Client:
     """Create an mqtt client instance and initiate connection"""
 
     # Google Cloud IoT Core expects the device ID to be in this specific format
@@ -41,7 +55,7 @@ def get_mqtt_client(config: Config) -> mqtt.Client:
 
     # Set userdata to our configuration object for use in callbacks
     mqtt_client = mqtt.Client(client_id=client_id, userdata=config)
-    mqtt_client.tls_set(ca_certs=config.mqtt_ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+    mqtt_client.tls_set_context(tls_context)
 
     mqtt_client.enable_logger()
     mqtt_client.on_connect = on_mqtt_connect
@@ -77,6 +91,23 @@ def on_mqtt_connect(client: mqtt.Client, config: Config, flags, rc):
     client.subscribe(mqtt_command_topic, qos=1)
 
 
+def attach_batcher(mqtt_client: mqtt.Client, batcher: CollectionBatcher):
+    """Let the batcher know when it can publish and when its messages were delivered"""
+
+    def on_connect(client, config, flags, rc):
+        on_mqtt_connect(client, config, flags, rc)
+        if rc == mqtt.CONNACK_ACCEPTED:
+            batcher.start_drain()
+
+    def on_disconnect(client, config, rc):
+        logger.debug(f"on_mqtt_disconnect() rc = {rc}")
+        batcher.set_connected(False)
+
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.on_publish = lambda client, config, mid: batcher.published(mid)
+
+
 def on_mqtt_config_message(client, config, message):
     """Handle config messages"""
     logger.debug(f"on_mqtt_config_message: {message}")
@@ -87,38 +118,174 @@ def on_mqtt_command_message(client, config, message):
     logger.debug(f"on_mqtt_command_message: {message}")
 
 
-def perform_and_upload_collection(collect_fn, config: Config, mqtt_client: mqtt.Client):
-    collection = collect_fn()
-    mqtt_client.publish(
-        f"/devices/{config.device_id}/events", json.dumps(collection), qos=1
-    )
+def publish_payload(config: Config, mqtt_client: mqtt.Client, payload):
+    return mqtt_client.publish(f"/devices/{config.device_id}/events", payload, qos=1)
+
+
+def perform_and_upload_collection(
+    collect_fn,
+    batcher: CollectionBatcher,
+    deadband_filter: DeadbandFilter,
+    stats: Stats,
+):
+    try:
+        with stats.timed("collect"):
+            collections = collect_fn()
+    except Exception:
+        stats.increment("collect_failures")
+        raise
+    stats.increment("collections", len(collections))
+
+    for collection in collections:
+        collection = deadband_filter.filter(collection)
+        if collection is not None:
+            batcher.add(collection)
+
+
+def publish_stats(stats: Stats, batcher: CollectionBatcher):
+    for collection in stats.collections():
+        batcher.add(collection)
+
+
+def flush_and_wait(batcher: CollectionBatcher, timeout: float):
+    """Publish anything still buffered and give it a chance to be delivered"""
+    message = batcher.flush()
+
+    deadline = time.monotonic() + timeout
+    while message and not message.is_published() and time.monotonic() < deadline:
+        time.sleep(0.1)
 
 
 def main():
     config = Config()
+    field_registers = epsolar_tracer_resolve_fields(config.fields)
+    configure_shared_clients(
+        ModbusSettings(
+            baudrate=config.modbus_baudrate,
+            timeout=config.modbus_timeout_seconds,
+            retries=config.modbus_retries,
+        )
+    )
 
-    mqtt_client = get_mqtt_client(config)
+    if config.spool_path:
+        from spool import Spool
+
+        store = Spool(config.spool_path, max_collections=config.spool_max_collections)
+    else:
+        store = MemoryStore(max_collections=config.spool_max_collections)
+
+    # Reused by every connection, so that reconnects can resume the TLS session
+    tls_context = make_tls_context(config.mqtt_ca_certs)
+    mqtt_client = get_mqtt_client(config, tls_context)
+    batcher = CollectionBatcher(
+        lambda payload: publish_payload(config, mqtt_client, payload),
+        store=store,
+        encode_fn=get_encoder(
+            config.payload_encoding, epsolar_tracer_field_multipliers(field_registers)
+        ),
+        max_collections=config.batch_max_collections,
+        max_seconds=config.batch_max_seconds,
+        max_bytes=config.batch_max_bytes,
+        drain_collections=config.spool_drain_collections,
+        drain_rate=config.spool_drain_rate,
+    )
+    attach_batcher(mqtt_client, batcher)
+    rotator = TokenRotator(
+        mqtt_client,
+        lambda: refresh_mqtt_client_token(config, mqtt_client),
+        config.mqtt_bridge_hostname,
+        config.mqtt_bridge_port,
+        lifetime_seconds=config.jwt_lifetime_minutes * 60,
+        margin_seconds=config.jwt_rotation_margin_minutes * 60,
+        tls_context=tls_context,
+        before_reconnect=lambda: flush_and_wait(
+            batcher, config.shutdown_timeout_seconds
+        ),
+    )
+    attach_rotator(mqtt_client, rotator)
+
+    stats = Stats()
+    stats.add_source(
+        lambda: [{"tags": {"type": "batcher"}, "fields": batcher.get_stats()}]
+    )
+    stats.add_source(epsolar_tracer_get_bus_stats)
+    stats_server = None
+    if config.stats_http_port:
+        stats_server = StatsServer(
+            stats, host=config.stats_http_host, port=config.stats_http_port
+        )
+        stats_server.start()
+    deadband_filter = DeadbandFilter(
+        config.deadbands, heartbeat_seconds=config.deadband_heartbeat_seconds
+    )
     mqtt_client.loop_start()
 
-    # jwt needs to be refreshed before it expires
-    # the client will be disconnected by the server after expiration and it will auto-reconnect with the new jwt
-    schedule.every(config.jwt_lifetime_minutes).minutes.do(
-        refresh_mqtt_client_token, config, mqtt_client
+    if config.sample_rate_hz:
+        epsolar_tracer_start_sampling(config.sample_rate_hz, config.modbus_targets)
+
+    # Modbus jobs get a thread of their own (collections fan out per serial port from
+    # there), so a slow or hung device can't hold up the jobs that don't touch a bus
+    modbus_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="modbus")
+    runtime = Runtime()
+
+    # jwt needs to be refreshed before it expires, the server would disconnect the
+    # client after expiration. It is rotated with a reconnect halfway between two
+    # collections, when there is nothing to publish.
+    runtime.add_job(
+        "rotate_jwt",
+        rotator.rotate_if_due,
+        interval=config.collection_interval_seconds,
+        timeout=config.shutdown_timeout_seconds + 10,
+        align=True,
+        offset=config.collection_interval_seconds / 2,
     )
 
-    schedule.every().day.do(epsolar_tracer_sync_rtc)
-    schedule.every().minute.do(
-        perform_and_upload_collection, epsolar_tracer_collect, config, mqtt_client
+    runtime.add_job(
+        "sync_rtc",
+        lambda: epsolar_tracer_sync_rtc(config.modbus_targets),
+        interval=24 * 60 * 60,
+        timeout=config.collection_timeout_seconds,
+        executor=modbus_executor,
+    )
+    runtime.add_job(
+        "collect",
+        lambda: perform_and_upload_collection(
+            lambda: epsolar_tracer_collect(
+                config.modbus_targets,
+                field_registers,
+                config.collection_deadline_seconds,
+            ),
+            batcher,
+            deadband_filter,
+            stats,
+        ),
+        interval=config.collection_interval_seconds,
+        timeout=config.collection_timeout_seconds,
+        executor=modbus_executor,
+        align=True,
     )
+    runtime.add_job("flush", batcher.flush_if_due, interval=5, timeout=30)
+    if config.stats_interval_seconds:
+        runtime.add_job(
+            "publish_stats",
+            lambda: publish_stats(stats, batcher),
+            interval=config.stats_interval_seconds,
+            timeout=30,
+            align=True,
+        )
 
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        runtime.run()
 
     finally:
+        if stats_server is not None:
+            stats_server.stop()
+        flush_and_wait(batcher, config.shutdown_timeout_seconds)
         mqtt_client.loop_stop()
         mqtt_client.disconnect()
+        modbus_executor.shutdown()
+        epsolar_tracer_close()
+        store.close()
 
 
 logging.basicConfig()
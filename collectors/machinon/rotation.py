@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import paho.mqtt.client as mqtt
+
+from tls import ResumingSSLContext
+
+
+class TokenRotator:
+    """Rotate the MQTT password (a JWT) ahead of its expiry
+
+    The bridge drops connections whose token has expired. Instead of waiting for
+    that, rotate_if_due() is called at quiet points between collections and, once
+    the token is within `margin_seconds` of expiring, sets a new one and reconnects
+    right away: `before_reconnect` is called first (e.g. to publish and await what
+    is buffered), and the TLS session is resumed if `tls_context` allows it. The gap
+    between disconnecting and the next CONNACK is measured and logged.
+    """
+
+    def __init__(
+        self,
+        mqtt_client: mqtt.Client,
+        refresh_fn: Callable[[], None],
+        host: str,
+        port: int,
+        lifetime_seconds: float,
+        margin_seconds: float,
+        tls_context: Optional[ResumingSSLContext] = None,
+        before_reconnect: Optional[Callable[[], None]] = None,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.mqtt_client = mqtt_client
+        self.refresh_fn = refresh_fn
+        self.host = host
+        self.port = port
+        self.lifetime_seconds = lifetime_seconds
+        self.margin_seconds = margin_seconds
+        self.tls_context = tls_context
+        self.before_reconnect = before_reconnect
+
+        self.connected = False
+        self.last_gap: Optional[float] = None
+        self._lock = threading.Lock()
+        # The client is expected to have been given a fresh token already
+        self._issued_at = time.monotonic()
+        self._disconnected_at = None
+
+    def refresh(self):
+        """Set a new token, used by the next (re)connect"""
+        self.refresh_fn()
+        self._issued_at = time.monotonic()
+
+    def due(self) -> bool:
+        age = time.monotonic() - self._issued_at
+        return age >= self.lifetime_seconds - self.margin_seconds
+
+    def rotate_if_due(self):
+        with self._lock:
+            if not self.due():
+                return
+
+            if not self.connected:
+                # paho reconnects on its own, it just needs a valid token to do so
+                self.refresh()
+                return
+
+            self.logger.info("Rotating the MQTT token")
+            if self.before_reconnect is not None:
+                self.before_reconnect()
+            self.refresh()
+            self._reconnect()
+
+    def _reconnect(self):
+        client = self.mqtt_client
+        self._disconnected_at = time.monotonic()
+
+        # A requested disconnect ends paho's network thread, start a new one that
+        # connects again
+        client.disconnect()
+        client.loop_stop()
+        client.connect_async(self.host, self.port)
+        client.loop_start()
+
+    def on_connect(self, client: mqtt.Client):
+        """Called once a connection has been accepted"""
+        self.connected = True
+
+        resumed = False
+        if self.tls_context is not None:
+            resumed = self.tls_context.remember_session(client.socket())
+
+        if self._disconnected_at is not None:
+            self.last_gap = time.monotonic() - self._disconnected_at
+            self._disconnected_at = None
+            self.logger.info(
+                f"Reconnected after {self.last_gap:.3f}s (TLS session resumed: {resumed})"
+            )
+
+    def on_disconnect(self):
+        self.connected = False
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+
+
+def attach_rotator(mqtt_client: mqtt.Client, rotator: TokenRotator):
+    """Keep the rotator informed of the connection state, on top of existing callbacks"""
+    previous_on_connect = mqtt_client.on_connect
+    previous_on_disconnect = mqtt_client.on_disconnect
+
+    def on_connect(client, userdata, flags, rc):
+        if previous_on_connect is not None:
+            previous_on_connect(client, userdata, flags, rc)
+        if rc == mqtt.CONNACK_ACCEPTED:
+            rotator.on_connect(client)
+
+    def on_disconnect(client, userdata, rc):
+        if previous_on_disconnect is not None:
+            previous_on_disconnect(client, userdata, rc)
+        rotator.on_disconnect()
+
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
@@ -0,0 +1,121 @@
+"""Run the collector's periodic jobs concurrently on an asyncio event loop
+
+Jobs are blocking functions run in executors, so a slow job only holds up jobs
+sharing its executor: Modbus I/O gets a dedicated thread, everything else runs in the
+loop's default executor. Each job has its own timeout, and a job that is still
+running when it is next due is skipped rather than queued up.
+"""
+
+import asyncio
+from concurrent.futures import Executor
+import logging
+import math
+import signal
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+
+class Job(NamedTuple):
+    name: str
+    fn: Callable[[], object]
+    interval: float
+    timeout: float
+    executor: Optional[Executor] = None
+    align: bool = False
+    offset: float = 0
+
+
+def next_aligned_deadline(interval: float, offset: float = 0) -> float:
+    """Get the monotonic time of the next wall-clock multiple of `interval` plus `offset`"""
+    wall = time.time() - offset
+    return time.monotonic() + (math.floor(wall / interval) + 1) * interval - wall
+
+
+class Runtime:
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.jobs: List[Job] = []
+        self._loop = None
+        self._stopping = None
+
+    def add_job(
+        self,
+        name: str,
+        fn: Callable[[], object],
+        interval: float,
+        timeout: float,
+        executor: Optional[Executor] = None,
+        align: bool = False,
+        offset: float = 0,
+    ):
+        """Run `fn` every `interval` seconds
+
+        Aligned jobs run on wall-clock multiples of their interval plus `offset` (e.g.
+        at the start of every minute), others first run one interval after the
+        runtime started.
+        """
+        self.jobs.append(Job(name, fn, interval, timeout, executor, align, offset))
+
+    def run(self):
+        """Run the jobs until stop() is called or SIGINT/SIGTERM is received"""
+        asyncio.run(self._run())
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._loop.add_signal_handler(signum, self._stopping.set)
+
+        try:
+            await asyncio.gather(*(self._run_job(job) for job in self.jobs))
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self._loop.remove_signal_handler(signum)
+            self._loop = None
+
+    def _call(self, job: Job):
+        try:
+            job.fn()
+        except Exception:
+            self.logger.exception(f"Job {job.name} failed")
+
+    async def _sleep_until(self, deadline: float) -> bool:
+        """Wait for a monotonic deadline, returns False if stopped in the meantime"""
+        try:
+            await asyncio.wait_for(
+                self._stopping.wait(), max(0, deadline - time.monotonic())
+            )
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+    async def _run_job(self, job: Job):
+        if job.align:
+            deadline = next_aligned_deadline(job.interval, job.offset)
+        else:
+            deadline = time.monotonic() + job.interval
+
+        running = None
+        while await self._sleep_until(deadline):
+            if running is not None and not running.done():
+                self.logger.warning(f"Job {job.name} is still running, skipping it")
+            else:
+                self.logger.debug(f"Running job {job.name}")
+                running = self._loop.run_in_executor(job.executor, self._call, job)
+                try:
+                    # Shielded so the future keeps tracking the job after a timeout
+                    await asyncio.wait_for(asyncio.shield(running), job.timeout)
+                except asyncio.TimeoutError:
+                    self.logger.warning(
+                        f"Job {job.name} did not finish within {job.timeout}s"
+                    )
+
+            # Deadlines advance by whole intervals, runs that were missed are skipped
+            deadline += job.interval
+            now = time.monotonic()
+            if deadline < now:
+                deadline += math.ceil((now - deadline) / job.interval) * job.interval
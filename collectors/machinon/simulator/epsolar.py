@@ -0,0 +1,394 @@
+"""A simulated EPsolar Tracer charge controller, served over TCP
+
+Every register of epsolar_tracer.registers is served, either as MODBUS RTU frames over
+TCP (the framing used on the RS485 bus, as carried by serial device servers) or as
+MODBUS TCP. Realtime values follow the sun over the day and energy accumulates, so
+repeated collections look like a real installation. Per-transaction latency, wire
+time and error rates are set with Conditions.
+
+Run from the collectors/machinon directory:
+
+    python -m simulator.epsolar --units 1 2 --latency 0.02
+"""
+
+import argparse
+import datetime
+import logging
+import math
+import random
+import socketserver
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from pymodbus.factory import ServerDecoder
+from pymodbus.framer.rtu_framer import ModbusRtuFramer
+from pymodbus.framer.socket_framer import ModbusSocketFramer
+from pymodbus.mei_message import (
+    ReadDeviceInformationRequest,
+    ReadDeviceInformationResponse,
+)
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+
+from epsolar_tracer.registers import (
+    RTC,
+    Coil,
+    RealtimeData,
+    RealtimeStatus,
+    RegisterType,
+    RegisterUnit,
+    SettingParameter,
+    StatisticalParameter,
+    get_registry,
+)
+
+# Value of every register not simulated below, by unit
+_DEFAULT_VALUES = {
+    RegisterUnit.VOLT: 12.0,
+    RegisterUnit.AMP: 10.0,
+    RegisterUnit.AH: 200,
+    RegisterUnit.WATT: 130.0,
+    RegisterUnit.CELSIUS: 25.0,
+    RegisterUnit.PERCENT: 80,
+}
+
+# Register type served by each function code
+_FUNCTION_TYPES = {
+    1: RegisterType.COIL,
+    2: RegisterType.DISCRETE,
+    3: RegisterType.HOLDING,
+    4: RegisterType.INPUT,
+    5: RegisterType.COIL,
+    6: RegisterType.HOLDING,
+    15: RegisterType.COIL,
+    16: RegisterType.HOLDING,
+}
+
+
+class Conditions(NamedTuple):
+    """How the simulated bus behaves, rates are per transaction"""
+
+    # Seconds before every response, plus up to `jitter` more
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Adds the time request and response take on a serial line at this rate
+    baudrate: Optional[int] = None
+    # No response at all, the client times out
+    timeout_rate: float = 0.0
+    # A response with a bad CRC (RTU framing only)
+    crc_error_rate: float = 0.0
+    # A "slave device busy" exception response
+    exception_rate: float = 0.0
+
+
+class EpsolarDevice:
+    """The register map of one controller, usable as a pymodbus datastore context"""
+
+    def __init__(
+        self,
+        model: str = "Tracer4215BN",
+        version: str = "V02.00+V01.00",
+        array_power: float = 400.0,
+        load_current: float = 0.5,
+        strict: bool = False,
+        clock: Callable[[], float] = time.time,
+    ):
+        """`strict` devices reject reads spanning undefined addresses, as some firmware does"""
+        self.information = {
+            0: b"EPsolar Tech co., Ltd",
+            1: model.encode("utf-8"),
+            2: version.encode("utf-8"),
+        }
+        self.array_power = array_power
+        self.load_current = load_current
+        self.strict = strict
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._types: Dict[int, RegisterType] = {}
+        self._words: Dict[int, int] = {}
+        self._bits: Dict[int, bool] = {}
+        self._last_update = None
+        self._energy = 0.0
+
+        for register in get_registry()[1].values():
+            if isinstance(register, Coil) or register.type is RegisterType.DISCRETE:
+                self._types[register.address] = register.type
+                self._bits[register.address] = False
+            elif not isinstance(register, RTC):
+                value = _DEFAULT_VALUES.get(register.unit, 0)
+                self._set(register, value)
+        self._set(StatisticalParameter.TotalGeneratedEnergy, 1234.56)
+        self.update()
+
+    def _set(self, register, value):
+        for offset, word in enumerate(register.encode(value)):
+            self._types[register.address + offset] = register.type
+            self._words[register.address + offset] = word
+
+    def _get(self, register) -> float:
+        raw_value = 0
+        for offset in range(register.size):
+            raw_value |= self._words[register.address + offset] << (offset * 16)
+        return raw_value / register.multiplier
+
+    def update(self):
+        """Move the realtime values and energy counters to the current time"""
+        now = self.clock()
+        local = datetime.datetime.fromtimestamp(now)
+        hour = local.hour + local.minute / 60 + local.second / 3600
+        sun = max(0.0, math.sin(math.pi * (hour - 6) / 12))
+        noise = self._random.uniform(0.97, 1.03)
+
+        pv_power = self.array_power * sun * noise
+        pv_voltage = 18.0 + 2.0 * sun * noise if sun > 0 else 0.4
+        battery_voltage = 12.4 + 1.4 * sun
+        battery_power = pv_power * 0.95
+        temperature = 20.0 + 12.0 * sun
+
+        self._set(RealtimeData.PvArrayInputVoltage, pv_voltage)
+        self._set(RealtimeData.PvArrayInputCurrent, pv_power / pv_voltage)
+        self._set(RealtimeData.PvArrayInputPower, pv_power)
+        self._set(RealtimeData.BatteryVoltage, battery_voltage)
+        self._set(RealtimeData.BatteryCurrent, battery_power / battery_voltage)
+        self._set(RealtimeData.BatteryPower, battery_power)
+        self._set(RealtimeData.LoadVoltage, battery_voltage)
+        self._set(RealtimeData.LoadCurrent, self.load_current)
+        self._set(RealtimeData.LoadPower, battery_voltage * self.load_current)
+        self._set(RealtimeData.BatteryTemperature, temperature)
+        self._set(RealtimeData.EquipmentTemperature, temperature + 3.0 * sun)
+        self._set(RealtimeData.PowerComponentsTemperature, temperature + 8.0 * sun)
+        self._set(RealtimeData.BatterySOC, round(60 + 35 * sun))
+
+        # Bit 0 running, bits 2-3 charging mode: MPPT while the sun is up, float after
+        status = (1 | (2 << 2)) if sun > 0.1 else (1 << 2) if sun > 0 else 0
+        self._set(RealtimeStatus.ChargingEquipmentStatus, status)
+
+        if self._last_update is not None:
+            kwh = pv_power * max(0.0, now - self._last_update) / 3600 / 1000
+            # Kept apart from the registers, which only hold hundredths
+            self._energy += kwh
+            if self._energy >= 0.01:
+                whole = math.floor(self._energy * 100) / 100
+                self._energy -= whole
+                for register in (
+                    StatisticalParameter.GeneratedEnergyToday,
+                    StatisticalParameter.GeneratedEnergyMonth,
+                    StatisticalParameter.GeneratedEnergyYear,
+                    StatisticalParameter.TotalGeneratedEnergy,
+                ):
+                    self._set(register, self._get(register) + whole)
+        self._last_update = now
+
+        self._set(SettingParameter.Clock, local)
+
+    # The pymodbus datastore context interface, see ModbusSlaveContext
+
+    def validate(self, fx: int, address: int, count: int = 1) -> bool:
+        register_type = _FUNCTION_TYPES.get(fx)
+        if self.strict:
+            addresses = range(address, address + count)
+        else:
+            addresses = (address, address + count - 1)
+        return all(self._types.get(a) is register_type for a in addresses)
+
+    def getValues(self, fx: int, address: int, count: int = 1) -> List:
+        with self._lock:
+            if _FUNCTION_TYPES[fx] in (RegisterType.COIL, RegisterType.DISCRETE):
+                return [
+                    self._bits.get(a, False) for a in range(address, address + count)
+                ]
+            self.update()
+            return [self._words.get(a, 0) for a in range(address, address + count)]
+
+    def setValues(self, fx: int, address: int, values: List):
+        with self._lock:
+            for a, value in enumerate(values, address):
+                if _FUNCTION_TYPES[fx] is RegisterType.COIL:
+                    self._bits[a] = bool(value)
+                else:
+                    self._words[a] = value
+
+
+class Simulator:
+    """Serve simulated devices, by unit, on a TCP port
+
+    `port` 0 picks a free port, see `url` for the address to collect from.
+    """
+
+    def __init__(
+        self,
+        devices: Dict[int, EpsolarDevice],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        framing: str = "rtu",
+        conditions: Conditions = Conditions(),
+        seed: Optional[int] = None,
+    ):
+        self.logger = logging.getLogger(__name__)
+        if framing not in ("rtu", "tcp"):
+            raise ValueError(f"Unknown framing {framing!r}, expected rtu or tcp")
+
+        self.devices = devices
+        self.framing = framing
+        self.conditions = conditions
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "transactions": 0,
+            "rx_bytes": 0,
+            "tx_bytes": 0,
+            "dropped": 0,
+            "corrupted": 0,
+            "exceptions": 0,
+        }
+
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                if simulator.framing == "rtu":
+                    framer = ModbusRtuFramer(ServerDecoder())
+                else:
+                    framer = ModbusSocketFramer(ServerDecoder())
+                units = list(simulator.devices)
+
+                while True:
+                    try:
+                        data = self.request.recv(1024)
+                    except OSError:
+                        break
+                    if not data:
+                        break
+                    simulator._count("rx_bytes", len(data))
+                    framer.processIncomingPacket(
+                        data,
+                        lambda request: simulator._respond(
+                            self.request, framer, request
+                        ),
+                        units,
+                    )
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        scheme = "rtu+tcp" if self.framing == "rtu" else "tcp"
+        return f"{scheme}://{host}:{port}"
+
+    def start(self):
+        self.logger.info(f"Simulating units {sorted(self.devices)} on {self.url}")
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="modbus-simulator", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] += value
+
+    def _respond(self, connection, framer, request):
+        conditions = self.conditions
+        device = self.devices[request.unit_id]
+        self._count("transactions")
+
+        with self._lock:
+            draw = self._random.random()
+            delay = conditions.latency + self._random.uniform(0, conditions.jitter)
+
+        if isinstance(request, ReadDeviceInformationRequest):
+            response = ReadDeviceInformationResponse(
+                request.read_code, device.information
+            )
+        elif draw < conditions.timeout_rate:
+            self._count("dropped")
+            return
+        elif draw < conditions.timeout_rate + conditions.exception_rate:
+            self._count("exceptions")
+            response = ExceptionResponse(
+                request.function_code, ModbusExceptions.SlaveBusy
+            )
+        else:
+            response = request.execute(device)
+
+        response.transaction_id = request.transaction_id
+        response.unit_id = request.unit_id
+        packet = framer.buildPacket(response)
+
+        if (
+            self.framing == "rtu"
+            and draw
+            < conditions.timeout_rate
+            + conditions.exception_rate
+            + conditions.crc_error_rate
+            and not isinstance(response, ExceptionResponse)
+        ):
+            self._count("corrupted")
+            packet = packet[:-1] + bytes([packet[-1] ^ 0xFF])
+
+        if conditions.baudrate:
+            # Request and response, 10 bits per byte with start and stop bits
+            request_size = len(framer.buildPacket(request))
+            delay += (request_size + len(packet)) * 10 / conditions.baudrate
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            connection.sendall(packet)
+        except OSError:
+            return
+        self._count("tx_bytes", len(packet))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--framing", choices=("rtu", "tcp"), default="rtu")
+    parser.add_argument("--units", type=int, nargs="+", default=[1])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--baudrate", type=int)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--crc-error-rate", type=float, default=0.0)
+    parser.add_argument("--exception-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    simulator = Simulator(
+        {unit: EpsolarDevice() for unit in args.units},
+        args.host,
+        args.port,
+        args.framing,
+        Conditions(
+            args.latency,
+            args.jitter,
+            args.baudrate,
+            args.timeout_rate,
+            args.crc_error_rate,
+            args.exception_rate,
+        ),
+    )
+    simulator.start()
+    try:
+        while True:
+            time.sleep(60)
+            simulator.logger.info(f"Stats: {simulator.get_stats()}")
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
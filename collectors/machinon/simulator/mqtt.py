@@ -0,0 +1,138 @@
+"""A local stand-in for the MQTT bridge, to publish to without a cloud project
+
+Only what the collector uses of MQTT 3.1.1 is implemented: every connection is
+accepted, QoS 0 and 1 publishes are counted and acknowledged, and subscriptions are
+acknowledged but never delivered to.
+"""
+
+import logging
+import socketserver
+import ssl
+import threading
+from typing import Callable, Dict, Optional
+
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def _read_exactly(connection, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def _read_packet(connection):
+    """Read a control packet, returns its first byte and the rest after the length"""
+    header = _read_exactly(connection, 1)[0]
+    length = 0
+    multiplier = 1
+    while True:
+        byte = _read_exactly(connection, 1)[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header, _read_exactly(connection, length)
+
+
+class MqttStandIn:
+    """Accept MQTT connections on a local port, `port` 0 picks a free one
+
+    `on_publish(topic, payload)` is called for every message received.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        tls_context: Optional[ssl.SSLContext] = None,
+        on_publish: Optional[Callable[[str, bytes], None]] = None,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "connections": 0,
+            "messages": 0,
+            "payload_bytes": 0,
+        }
+
+        stand_in = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                connection = self.request
+                if tls_context is not None:
+                    try:
+                        connection = tls_context.wrap_socket(
+                            connection, server_side=True
+                        )
+                    except (OSError, ssl.SSLError) as e:
+                        stand_in.logger.warning(f"TLS handshake failed: {e}")
+                        return
+
+                try:
+                    while stand_in._handle_packet(connection, on_publish):
+                        pass
+                except (EOFError, OSError):
+                    pass
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def start(self):
+        self.logger.info(f"MQTT stand-in listening on {self.address}")
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="mqtt-stand-in", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+    def _handle_packet(self, connection, on_publish) -> bool:
+        """Handle one control packet, returns False once the client disconnected"""
+        header, body = _read_packet(connection)
+        kind = header >> 4
+
+        if kind == CONNECT:
+            with self._lock:
+                self.stats["connections"] += 1
+            connection.sendall(bytes((0x20, 2, 0, 0)))
+        elif kind == PUBLISH:
+            qos = (header >> 1) & 3
+            topic_length = int.from_bytes(body[:2], "big")
+            topic = body[2 : 2 + topic_length].decode("utf-8")
+            payload = body[2 + topic_length + (2 if qos else 0) :]
+            with self._lock:
+                self.stats["messages"] += 1
+                self.stats["payload_bytes"] += len(payload)
+            if qos:
+                message_id = body[2 + topic_length : 4 + topic_length]
+                connection.sendall(bytes((0x40, 2)) + message_id)
+            if on_publish is not None:
+                on_publish(topic, payload)
+        elif kind == SUBSCRIBE:
+            # Grant QoS 1 to the single topic the collector subscribes to
+            connection.sendall(bytes((0x90, 3)) + body[:2] + b"\x01")
+        elif kind == PINGREQ:
+            connection.sendall(bytes((0xD0, 0)))
+        elif kind == DISCONNECT:
+            return False
+        return True
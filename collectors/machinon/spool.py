@@ -0,0 +1,151 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Tuple
+
+
+class Spool:
+    """Keep collections waiting to be published in an SQLite database on local disk
+
+    This is a drop-in replacement for `batching.MemoryStore` that survives restarts and
+    long outages. Rows are appended in order and read back from a cursor, rows that have
+    been taken but not yet removed are taken again after a restart. When the spool
+    holds more than `max_collections` rows the oldest ones are evicted.
+    """
+
+    def __init__(self, path: str, max_collections: int = 100000):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.max_collections = max_collections
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Every append is committed, but the database may lose the most recent appends
+        # after a power cut rather than syncing the SD card each time
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, payload TEXT)"
+        )
+
+        # Rows below the cursor have been taken and are waiting to be removed
+        self._cursor = 0
+        self._count, self.pending_bytes = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM spool"
+        ).fetchone()
+        self._pending = self._count
+
+        if self._count:
+            self.logger.info(f"Spool {path} holds {self._count} collection(s)")
+
+    def __len__(self):
+        return self._count
+
+    def pending_count(self) -> int:
+        return self._pending
+
+    def oldest_pending_time(self):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT created FROM spool WHERE id >= ? ORDER BY id LIMIT 1",
+                (self._cursor,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def append(self, payload: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO spool (created, payload) VALUES (?, ?)",
+                (time.time(), payload),
+            )
+            self._count += 1
+            self._pending += 1
+            self.pending_bytes += len(payload)
+
+            if self._count > self.max_collections:
+                self._evict(self._count - self.max_collections)
+
+    def _evict(self, count: int):
+        evicted = self._db.execute(
+            "SELECT id, LENGTH(payload) FROM spool ORDER BY id LIMIT ?", (count,)
+        ).fetchall()
+        last_id = evicted[-1][0]
+        self._db.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+
+        for row_id, size in evicted:
+            if row_id >= self._cursor:
+                self._pending -= 1
+                self.pending_bytes -= size
+        self._count -= len(evicted)
+        self._cursor = max(self._cursor, last_id + 1)
+
+        self.logger.warning(f"Spool is full, dropped {len(evicted)} collection(s)")
+
+    def take(self, max_count: int, max_bytes: int) -> List[Tuple[int, str]]:
+        """Take the oldest pending collections, they are not returned again unless released"""
+        taken = []
+        size = 0
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, payload FROM spool WHERE id >= ? ORDER BY id LIMIT ?",
+                (self._cursor, max_count),
+            )
+            for row_id, payload in rows:
+                if taken and size + len(payload) > max_bytes:
+                    break
+                taken.append((row_id, payload))
+                size += len(payload)
+
+            if taken:
+                self._cursor = taken[-1][0] + 1
+                self._pending -= len(taken)
+                self.pending_bytes -= size
+
+        return taken
+
+    def release(self, keys: Iterable[int]):
+        """Make taken collections pending again, e.g. when publishing them failed"""
+        keys = list(keys)
+        if not keys:
+            return
+
+        with self._lock:
+            first = min(keys)
+            if first >= self._cursor:
+                return
+            # Rewind, anything taken after these rows will be taken (and sent) again
+            released = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM spool "
+                "WHERE id >= ? AND id < ?",
+                (first, self._cursor),
+            ).fetchone()
+            self._cursor = first
+            self._pending += released[0]
+            self.pending_bytes += released[1]
+
+    def remove(self, keys: Iterable[int]):
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                removed = self._db.execute(
+                    f"SELECT id, LENGTH(payload) FROM spool WHERE id IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                self._db.execute(
+                    f"DELETE FROM spool WHERE id IN ({placeholders})", chunk
+                )
+
+                for row_id, size in removed:
+                    # Released rows can be acknowledged after the cursor was rewound
+                    if row_id >= self._cursor:
+                        self._pending -= 1
+                        self.pending_bytes -= size
+                self._count -= len(removed)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,136 @@
+"""Self-metrics of the collector
+
+Stats holds the collector's own counters and timers, and gathers the counters that
+other components keep (e.g. each MODBUS bus, the batcher) through sources. Snapshots
+are published as the collector_stats measurement, and can be served as plain text
+for scraping.
+"""
+
+from contextlib import contextmanager
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Union
+
+Number = Union[int, float]
+
+# A group of metrics sharing the same tags, the "type" tag names the group
+Group = Dict[str, Dict]
+
+
+class Timer:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+class Stats:
+    def __init__(self, group_type: str = "collector"):
+        self.group_type = group_type
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        self._timers: Dict[str, Timer] = {}
+        self._sources: List[Callable[[], List[Group]]] = []
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = Timer()
+            timer.observe(seconds)
+
+    @contextmanager
+    def timed(self, name: str):
+        """Time the body of a with statement, whether or not it raises"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started)
+
+    def add_source(self, fn: Callable[[], List[Group]]):
+        """Add a function returning groups of metrics, each as {"tags": ..., "fields": ...}"""
+        self._sources.append(fn)
+
+    def snapshot(self) -> List[Group]:
+        with self._lock:
+            fields: Dict[str, Number] = dict(self._counters)
+            for name, timer in self._timers.items():
+                fields[f"{name}_count"] = timer.count
+                fields[f"{name}_seconds_total"] = timer.total
+                fields[f"{name}_seconds_max"] = timer.max
+
+        groups = [{"tags": {"type": self.group_type}, "fields": fields}]
+        for source in self._sources:
+            groups += source()
+        return groups
+
+    def collections(self, measurement: str = "collector_stats") -> List[dict]:
+        """Get a snapshot as collections, to be published like any other"""
+        now = datetime.datetime.utcnow().isoformat("T") + "Z"
+        return [
+            {"measurement": measurement, "time": now, **group}
+            for group in self.snapshot()
+            if group["fields"]
+        ]
+
+    def to_text(self) -> str:
+        """Render a snapshot in the Prometheus text format, e.g. collector_collect_count 3"""
+        lines = []
+        for group in self.snapshot():
+            tags = dict(group["tags"])
+            prefix = tags.pop("type", self.group_type)
+            labels = ",".join(f'{key}="{value}"' for key, value in sorted(tags.items()))
+            labels = f"{{{labels}}}" if labels else ""
+            for name, value in sorted(group["fields"].items()):
+                lines.append(f"{prefix}_{name}{labels} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+class StatsServer:
+    """Serve a Stats snapshot as text over HTTP, on every path"""
+
+    def __init__(self, stats: Stats, host: str = "127.0.0.1", port: int = 9101):
+        self.logger = logging.getLogger(__name__)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = stats.to_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    def start(self):
+        self.logger.info(f"Serving stats on {self.server.server_address}")
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="stats-server", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from batching import CollectionBatcher
+
+
+class Publisher:
+    """Records the payloads published, as if paho queued every one of them"""
+
+    def __init__(self):
+        self.payloads = []
+        self.times = []
+        self._lock = threading.Lock()
+
+    def __call__(self, payload):
+        with self._lock:
+            self.payloads.append(payload)
+            self.times.append(time.monotonic())
+            return mqtt.MQTTMessageInfo(len(self.payloads))
+
+
+def collection(index: int) -> dict:
+    return {"measurement": "solar_controller", "fields": {"index": index}}
+
+
+def test_backlog_is_drained_in_rate_limited_batches_after_reconnect():
+    publisher = Publisher()
+    batcher = CollectionBatcher(
+        publisher, encode_fn=len, drain_collections=100, drain_rate=10
+    )
+    for index in range(1000):
+        batcher.add(collection(index))
+    assert not publisher.payloads
+
+    started = time.monotonic()
+    batcher.start_drain()
+    batcher.add(collection(1000))
+    batcher.flush_if_due()
+    time.sleep(0.25)
+
+    # Only the drain publishes, 100 collections at a time and 10 messages a second
+    assert 1 <= len(publisher.payloads) <= 4
+    assert all(count == 100 for count in publisher.payloads)
+    assert publisher.times[-1] - started >= 0.1 * (len(publisher.payloads) - 1)
+    batcher.set_connected(False)
+
+
+def test_collections_are_published_when_due_without_a_backlog():
+    publisher = Publisher()
+    batcher = CollectionBatcher(publisher, encode_fn=len, max_collections=2)
+    batcher.set_connected(True)
+    for index in range(5):
+        batcher.add(collection(index))
+    assert publisher.payloads == [2, 2]
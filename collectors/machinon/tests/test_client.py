@@ -0,0 +1,30 @@
+import pytest
+
+from epsolar_tracer.client import EpsolarTracerClient, ModbusBus, make_modbus_client
+from epsolar_tracer.collector import FIELD_REGISTERS
+from simulator.epsolar import EpsolarDevice, Simulator
+
+
+@pytest.fixture
+def strict_client():
+    simulator = Simulator({1: EpsolarDevice(strict=True)})
+    simulator.start()
+    bus = ModbusBus(make_modbus_client(simulator.url))
+    yield EpsolarTracerClient(unit=1, bus=bus)
+    bus.close()
+    simulator.stop()
+
+
+def test_rejected_blocks_are_read_as_gap_free_blocks(strict_client):
+    registers = list(FIELD_REGISTERS.values())
+    first = strict_client.read_registers(registers)
+    assert all(value.value is not None for value in first)
+    stats = strict_client.bus.get_stats()
+    assert stats["block_fallbacks"] == 1
+
+    strict_client.read_registers(registers)
+    again = strict_client.bus.get_stats()
+    # The rejected block isn't tried again
+    assert again["block_fallbacks"] == 1
+    assert again["error_responses"] == stats["error_responses"]
+    assert again["transactions"] - stats["transactions"] < len(registers)
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from epsolar_tracer.client import plan_block_reads
+from epsolar_tracer.collector import FIELD_REGISTERS
+from epsolar_tracer.registers import RTC, RealtimeStatus, SettingParameter
+
+
+def rtc_words(rng: random.Random):
+    """Words of a valid RTC reading, least significant word first"""
+    return [
+        rng.randrange(60) | rng.randrange(60) << 8,
+        rng.randrange(24) | rng.randrange(1, 29) << 8,
+        rng.randrange(1, 13) | rng.randrange(100) << 8,
+    ]
+
+
+def random_words(block, rng: random.Random):
+    words = [rng.randrange(0x10000) for _ in range(block.size)]
+    for register, offset in zip(block.registers, block.offsets):
+        if isinstance(register, RTC):
+            words[offset : offset + register.size] = rtc_words(rng)
+    return words
+
+
+def decoded(values):
+    return {
+        register: (value.raw_value, value.value) for register, value in values.items()
+    }
+
+
+@pytest.mark.parametrize(
+    "registers",
+    [
+        [*FIELD_REGISTERS.values(), RealtimeStatus.ChargingEquipmentStatus],
+        # A block ending with the RTC
+        [SettingParameter.DischargingLimitVoltage, SettingParameter.Clock],
+        [SettingParameter.Clock],
+    ],
+)
+def test_block_decoder_matches_decode_registers(registers):
+    rng = random.Random(0)
+    blocks = plan_block_reads(registers)
+    for block in blocks:
+        for _ in range(100):
+            words = random_words(block, rng)
+            assert decoded(block.decoder.decode(words)) == decoded(
+                {
+                    register: register.decode_registers(
+                        words[offset : offset + register.size]
+                    )
+                    for register, offset in zip(block.registers, block.offsets)
+                }
+            )